@@ -7,9 +7,10 @@
 ####################################################
 
 from datetime import datetime
+from functools import partial
 from os.path import realpath
 import subprocess
-import tempfile
+import argparse
 import shutil
 import signal
 import sys
@@ -18,13 +19,45 @@ import re
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--projects", 
+    required=False,
+    nargs="+",
+    action="store",
+    dest="prj_list",
+    help="Refresh only these projects (default: all projects)",
+)
+
+parser.add_argument(
+    "--profile", 
+    required=False,
+    action="store_true",
+    dest="profile",
+    help="Profile CPU time and allocations of every stage (saved next to the run report)"
+)
+args = parser.parse_args()
+
 from generate_primary_tags import PrimaryTags
 from generate_backlinks import Backlinks
+from page_index import PageIndex, index_path_of
+from redirects import RedirectTable, ensure_redirect_table
+from errors import WikiStatsError, LockError
+from filelock import stats_lock
 from cleanup import delete_temp_dir
-from symlink import symlink
+from snapshot_store import rotate_snapshot
+from staging import make_tmp_dir, staged_path, size_of, WriteBack
+from sharding import publish_shards, shards_dir_of
+from stats_io import open_stats
+from metrics import stage, save_report
+import profiling
 from config import *
 
-TMP_DIR = tempfile.mkdtemp(prefix="ws_bps_")
+if args.profile:
+    profiling.enable()
+
+TMP_DIR = make_tmp_dir("ws_bps_")
 
 signal.signal(signal.SIGINT, lambda sig, frame: delete_temp_dir(TMP_DIR))
 
@@ -34,11 +67,26 @@ if not os.path.exists(STATS_DIR):
 
 FILE_NAME_REG = re.compile(PAGES_ARTICLES_DUMP_REG)
 
+def acquire_or_exit(lock):
+    """
+    Acquires a lock (waits up to FILE_LOCK_TIMEOUT), exits on timeout.
+    """
+    try:
+        lock.acquire()
+    except LockError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        delete_temp_dir(TMP_DIR)
+        exit(1)
+    return lock
+
 print("Checking previous project files..")
 
 # Get the latest dump for each project
 dumps_info = {}
 for key, value in PROJECTS.items():
+    if args.prj_list and key not in args.prj_list:
+        continue
+
     check_dir = DUMP_DIR.format(value)
 
     if not os.path.exists(check_dir):
@@ -75,16 +123,53 @@ for prj, dump_info in dumps_info.items():
     dump_path = dump_info["path"]
     print(f"Current dump ({prj}):", dump_path)
 
-    bl = Backlinks(dump_path, f"{TMP_DIR}/{prj}/backlinks.tsv")
-    bl.generate_backlinks()
+    try:
+        # Index is built once per dump, redirects are then read from it
+        page_index = None
+        if PAGE_INDEX_DIR:
+            page_index = PageIndex(dump_path, index_path_of(dump_path, PAGE_INDEX_DIR)).ensure()
+
+        # Links are resolved to the final targets of redirects while counting
+        redirects = None
+        if REDIRECTS_DIR:
+            table_path = os.path.join(REDIRECTS_DIR, f"{prj}_redirects.tsv")
+            redirects = RedirectTable.load(ensure_redirect_table(dump_path, table_path, page_index))
+
+        bl = Backlinks(
+            dump_path,
+            f"{TMP_DIR}/{prj}/backlinks.tsv{STATS_COMPRESSION}",
+            page_index=page_index,
+            redirects=redirects
+        )
+        bl.generate_backlinks()
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        delete_temp_dir(TMP_DIR)
+        exit(1)
     del bl
 
     print("--------------------")
 
 
+# Rotates the symlinks to a new snapshot of a project (once written back)
+def publish_snapshot(prj:str, new_file_path:str) -> None:
+    with stage(f"rotate:{prj}"):
+        rotate_snapshot("bps", prj, new_file_path)
+    if STATS_SHARDS:
+        with stage(f"shard:{prj}"):
+            publish_shards(new_file_path, shards_dir_of(STATS_DIR, "bps", prj), STATS_SHARDS, STATS_COMPRESSION)
+
 print("Loading previous data")
 
+# New snapshots are copied to STATS_DIR in the background with staging,
+# the next project is merged meanwhile (lock released once rotated)
+write_back = WriteBack(STAGING_WRITE_BACK_THREADS if STAGING_DIR else 0)
+
 for prj in dumps_info.keys():
+    # Snapshot write and symlink rotation of the project
+    prj_lock = acquire_or_exit(stats_lock("bps", prj))
+    snapshot_stage = stage(f"snapshot:{prj}")
+    snapshot_metrics = snapshot_stage.start()
     
     out_data = {}
     STATS_HEAD = ""
@@ -92,7 +177,7 @@ for prj in dumps_info.keys():
     # Load previous data for project
     prev_file_path = os.path.join(STATS_DIR, f"bps/latest_{prj}_bps.tsv")
     
-    with open(prev_file_path, "r") as prev_file_in:          
+    with open_stats(prev_file_path, "r") as prev_file_in:          
         print(f"Loading {prev_file_path}")
         # Load head
         while (line := prev_file_in.readline()).strip() != "":
@@ -111,22 +196,25 @@ for prj in dumps_info.keys():
                 continue
             out_data[art_name] = [bl_count, pr_count]
 
-    bl_file = f"{TMP_DIR}/{prj}/backlinks.tsv"
+    bl_file = f"{TMP_DIR}/{prj}/backlinks.tsv{STATS_COMPRESSION}"
     
     new_file_path = os.path.join(
         STATS_DIR, 
-        f"bps/{datetime.now().strftime(FILE_DATE_FORMAT)}_{prj}_bps.tsv"
+        f"bps/{datetime.now().strftime(FILE_DATE_FORMAT)}_{prj}_bps.tsv{STATS_COMPRESSION}"
     )
     
+    staged_file_path = staged_path(new_file_path, size_of(prev_file_path))
+    
     print(f"Merging {prj}..")
     # Merge data with previous file
-    with open(new_file_path, "w") as file_out, open(bl_file, "r") as bl_in:
+    with open_stats(staged_file_path, "w") as file_out, open_stats(bl_file, "r") as bl_in:
             # Write head
             file_out.write(STATS_HEAD)
             if not STATS_HEAD.endswith("\n\n"):
                 file_out.write("\n")
 
             for line in bl_in:
+                snapshot_metrics.RECORDS += 1
                 values = [val.strip() for val in line.split("\t")]
                 art_name = values[0]
 
@@ -144,21 +232,32 @@ for prj in dumps_info.keys():
                 file_out.write(f"{art_name}\t{bl_count}\t{ps_count}\n") 
     
     
-    # Update symlinks (keep only last three versions of file)
-    latest_path = prev_file_path
-    previous_path = os.path.join(STATS_DIR, f"bps/previous_{prj}_bps.tsv")
-    second_previous_path = os.path.join(STATS_DIR, f"bps/second_previous_{prj}_bps.tsv")
-    
-    # Delete the last version
-    os.remove(realpath(second_previous_path)) if os.path.exists(realpath(second_previous_path)) else None
-    
-    # Shift symlinks 
-    symlink(realpath(previous_path), second_previous_path)
-    symlink(realpath(latest_path), previous_path)
-    symlink(realpath(new_file_path), latest_path)
-    
+    snapshot_stage.stop()
+
+    write_back.submit(
+        prj,
+        staged_file_path,
+        new_file_path,
+        on_done=partial(publish_snapshot, prj),
+        on_exit=prj_lock.release
+    )
 
+failed = write_back.wait()
+for prj, error in failed.items():
+    sys.stderr.write(f"Error: Snapshot of {prj} not published: {error}\n")
+
+report_prefix = os.path.join(STATS_DIR, "bps", "reports", datetime.now().strftime(FILE_DATE_FORMAT))
+save_report(
+    f"{report_prefix}_bps_report.json",
+    run="backlinks_primary_stats",
+    projects=list(dumps_info.keys()),
+    failed_projects=failed
+)
+profiling.save(f"{report_prefix}_bps_profile")
 delete_temp_dir(TMP_DIR)
+if failed:
+    print(f"Done, failed projects: {', '.join(failed)}")
+    exit(1)
 print("Done.")
 
 
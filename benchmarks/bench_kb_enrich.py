@@ -0,0 +1,111 @@
+#! /usr/bin/python3
+
+# Throughput of the KB stats insertion (serial vs. chunked parallel)
+# against KB size, on synthetic data.
+# Also checks that both paths produce byte-identical output.
+
+import argparse
+import tempfile
+import hashlib
+import random
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kb_enrich import insert_stats
+from kb_head import KB_HEAD_TEMPLATE
+
+def write_stats(path:str, titles:list, columns:int, rnd:random.Random) -> None:
+    with open(path, "w") as file_out:
+        file_out.write("BENCHMARK STATS\n\n")
+        for title in titles:
+            values = "\t".join(str(rnd.randint(0, 10000)) for _ in range(columns))
+            file_out.write(f"{title}\t{values}\n")
+
+def write_kb(path:str, lines:int, titles:list, rnd:random.Random) -> None:
+    with open(path, "w") as file_out:
+        for type, columns in KB_HEAD_TEMPLATE.items():
+            if type == "<__stats__>":
+                continue
+            file_out.write(type)
+            for column in columns:
+                file_out.write(column + "\t")
+            file_out.write("\n")
+        file_out.write("\n")
+
+        generic_num = len(KB_HEAD_TEMPLATE["<__generic__>"])
+        for i in range(lines):
+            columns = [f"value_{i}_{c}" for c in range(generic_num)]
+            columns[0] = str(i)
+            columns[1] = "person"
+            columns[8] = f"https://en.wikipedia.org/wiki/{rnd.choice(titles)}"
+            file_out.write("\t".join(columns) + "\n")
+
+def file_hash(path:str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as file_in:
+        while block := file_in.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        dest="sizes",
+        help="KB sizes (number of entity lines)"
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=os.cpu_count(),
+        dest="workers",
+        help="Number of worker processes for the parallel run"
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=8 * 1024 * 1024,
+        dest="chunk_size",
+        help="Chunk size in bytes"
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="ws_bench_kb_")
+    rnd = random.Random(42)
+    try:
+        print("lines\tsize_mb\tserial_s\tparallel_s\tserial_lines_s\tparallel_lines_s\tidentical")
+        for size in args.sizes:
+            titles = [f"Article_{i}" for i in range(max(size // 2, 1))]
+            pw_path = os.path.join(work_dir, "pw.tsv")
+            bps_path = os.path.join(work_dir, "bps.tsv")
+            kb_path = os.path.join(work_dir, "kb.tsv")
+            write_stats(pw_path, titles, 1, rnd)
+            write_stats(bps_path, titles[::2], 2, rnd)
+            write_kb(kb_path, size, titles, rnd)
+
+            results = []
+            for workers in (1, args.workers):
+                out_path = os.path.join(work_dir, f"out_{workers}.tsv")
+                start = time.perf_counter()
+                insert_stats(kb_path, pw_path, bps_path, out_path, workers=workers, chunk_size=args.chunk_size)
+                results.append((time.perf_counter() - start, file_hash(out_path)))
+                os.remove(out_path)
+
+            (serial_s, serial_hash), (parallel_s, parallel_hash) = results
+            size_mb = os.path.getsize(kb_path) / 2**20
+            print(
+                f"{size}\t{size_mb:.1f}\t{serial_s:.2f}\t{parallel_s:.2f}\t"
+                f"{size / serial_s:.0f}\t{size / parallel_s:.0f}\t{serial_hash == parallel_hash}"
+            )
+    finally:
+        shutil.rmtree(work_dir)
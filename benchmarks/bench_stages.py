@@ -0,0 +1,227 @@
+#! /usr/bin/python3
+
+# Per-stage throughput and peak memory of the extractors on synthetic
+# inputs (generators.py) at several scales:
+#   pageviews  -> PageViews on one day of hourly files (local mirror)
+#   pageviews_vectorized -> the same input, --engine vectorized
+#   backlinks  -> Backlinks.generate_backlinks
+#   ptags      -> PrimaryTags.generate_ptags
+#   merge      -> merge_stats.py
+#
+# Every benchmark runs in a fresh process (clean peak RSS), stage metrics
+# come from metrics.py. Results can be saved and compared with a saved
+# baseline, e.g. of the previous commit:
+#   git stash && python benchmarks/bench_stages.py --save base.json
+#   git stash pop && python benchmarks/bench_stages.py --compare base.json
+
+import multiprocessing
+import argparse
+import tempfile
+import logging
+import shutil
+import runpy
+import queue
+import json
+import sys
+import os
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generators import make_pageviews_mirror, write_pages_articles
+
+SCALES = {
+    "small": {"lines_per_hour": 20000, "pages": 2000},
+    "medium": {"lines_per_hour": 200000, "pages": 20000},
+    "large": {"lines_per_hour": 1000000, "pages": 200000}
+}
+
+BENCH_DATE = "2023-01-01"
+BENCHMARKS = ["pageviews", "pageviews_vectorized", "backlinks", "ptags", "merge"]
+
+# Seconds between checks of a running benchmark process
+RESULT_POLL_INTERVAL = 1
+
+
+def run_pageviews(inputs:dict, work_dir:str, options:dict) -> None:
+    from generate_pageviews import PageViews
+    pw = PageViews(
+        BENCH_DATE,
+        BENCH_DATE,
+        tmp_dir=os.path.join(work_dir, "pwtmp"),
+        output_dir=work_dir,
+        output_file="pageviews.tsv",
+        manifest_dir=os.path.join(work_dir, "manifest"),
+        sources=[inputs["mirror"]],
+        **options
+    )
+    pw.get_pageviews()
+
+def run_pageviews_vectorized(inputs:dict, work_dir:str, options:dict) -> None:
+    run_pageviews(inputs, work_dir, {**options, "engine": "vectorized"})
+
+def run_backlinks(inputs:dict, work_dir:str, options:dict) -> None:
+    from generate_backlinks import Backlinks
+    Backlinks(inputs["dump"], os.path.join(work_dir, "backlinks.tsv")).generate_backlinks()
+
+def run_ptags(inputs:dict, work_dir:str, options:dict) -> None:
+    from generate_primary_tags import PrimaryTags
+    PrimaryTags(inputs["dump"], os.path.join(work_dir, "ptags.tsv")).generate_ptags()
+
+def run_merge(inputs:dict, work_dir:str, options:dict) -> None:
+    sys.argv = [
+        "merge_stats.py",
+        "-bl", inputs["backlinks"],
+        "-pw", inputs["pageviews"],
+        "-pr", inputs["ptags"],
+        "-o", os.path.join(work_dir, "merged.tsv")
+    ]
+    runpy.run_path(os.path.join(REPO_DIR, "merge_stats.py"), run_name="__main__")
+
+RUNNERS = {
+    "pageviews": run_pageviews,
+    "pageviews_vectorized": run_pageviews_vectorized,
+    "backlinks": run_backlinks,
+    "ptags": run_ptags,
+    "merge": run_merge
+}
+
+def child(result_queue, bench:str, inputs:dict, work_dir:str, options:dict) -> None:
+    import metrics
+    logging.disable(logging.WARNING)
+    sys.stdout = open(os.devnull, "w")
+    RUNNERS[bench](inputs, work_dir, options)
+    result_queue.put(metrics.REPORT.to_dict())
+
+def run_bench(bench:str, inputs:dict, work_dir:str, options:dict={}) -> dict:
+    """
+    Runs one benchmark in a new process, returns its metrics report.
+    Raises RuntimeError if the process exits without a report.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    prcs = ctx.Process(target=child, args=(result_queue, bench, inputs, work_dir, options))
+    prcs.start()
+    # Waits for the report while the process runs (a failed one never sends it)
+    while True:
+        try:
+            report = result_queue.get(timeout=RESULT_POLL_INTERVAL)
+            break
+        except queue.Empty:
+            if not prcs.is_alive():
+                # The report may have been sent right before the exit
+                try:
+                    report = result_queue.get(timeout=RESULT_POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    raise RuntimeError(f"Benchmark {bench} failed (exit code {prcs.exitcode})")
+    prcs.join()
+    return report
+
+def make_inputs(scale:str, data_dir:str) -> dict:
+    params = SCALES[scale]
+    scale_dir = os.path.join(data_dir, scale)
+    inputs = {
+        "mirror": os.path.join(scale_dir, "mirror"),
+        "dump": os.path.join(scale_dir, "enwiki-20230101-pages-articles.xml")
+    }
+    make_pageviews_mirror(inputs["mirror"], BENCH_DATE, lines_per_hour=params["lines_per_hour"])
+    if not os.path.exists(inputs["dump"]):
+        write_pages_articles(inputs["dump"], params["pages"])
+    return inputs
+
+def print_report(scale:str, bench:str, report:dict, baseline:dict=None) -> None:
+    print(f"{scale}\t{bench}\t(total)\t{report['wall_s']:.2f}\t\t\t\t{report['peak_rss_mb']:.0f}" + (
+        f"\t{baseline['wall_s'] / report['wall_s']:.2f}x" if baseline and report["wall_s"] else ""
+    ))
+    for name, values in report["stages"].items():
+        line = (
+            f"{scale}\t{bench}\t{name}\t{values['wall_s']:.2f}\t{values['lines_per_s'] or 0:.0f}\t"
+            f"{values['records_per_s'] or 0:.0f}\t{values['mb_read_per_s'] or 0:.1f}\t{values['peak_rss_mb']:.0f}"
+        )
+        base_values = (baseline or {}).get("stages", {}).get(name)
+        if base_values and values["wall_s"]:
+            line += f"\t{base_values['wall_s'] / values['wall_s']:.2f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        choices=list(SCALES),
+        default=["small", "medium"],
+        dest="scales",
+        help="Input scales"
+    )
+
+    parser.add_argument(
+        "--bench",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=BENCHMARKS,
+        dest="benchmarks",
+        help="Benchmarks to run"
+    )
+
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        dest="data_dir",
+        help="Dir for generated inputs, kept between runs (default: temp dir)"
+    )
+
+    parser.add_argument(
+        "--save",
+        type=str,
+        dest="save_path",
+        help="Save results as JSON"
+    )
+
+    parser.add_argument(
+        "--compare",
+        type=str,
+        dest="baseline_path",
+        help="Baseline results (--save of another run) to compare with"
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline_path:
+        with open(args.baseline_path) as baseline_in:
+            baseline = json.load(baseline_in)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="ws_bench_data_")
+    work_dir = tempfile.mkdtemp(prefix="ws_bench_")
+    results = {}
+    try:
+        print("scale\tbench\tstage\twall_s\tlines_s\trecords_s\tmb_read_s\tpeak_rss_mb" + ("\tspeedup" if baseline else ""))
+        for scale in args.scales:
+            inputs = make_inputs(scale, data_dir)
+            results[scale] = {}
+            for bench in args.benchmarks:
+                # merge uses the outputs of the other benchmarks
+                if bench == "merge":
+                    for needed in ("pageviews", "backlinks", "ptags"):
+                        if needed not in results[scale]:
+                            results[scale][needed] = run_bench(needed, inputs, os.path.join(work_dir, needed))
+                    inputs["pageviews"] = os.path.join(work_dir, "pageviews", "en_pageviews.tsv")
+                    inputs["backlinks"] = os.path.join(work_dir, "backlinks", "backlinks.tsv")
+                    inputs["ptags"] = os.path.join(work_dir, "ptags", "ptags.tsv")
+
+                bench_dir = os.path.join(work_dir, bench)
+                shutil.rmtree(bench_dir, ignore_errors=True)
+                results[scale][bench] = run_bench(bench, inputs, bench_dir)
+                print_report(scale, bench, results[scale][bench], baseline.get(scale, {}).get(bench))
+    finally:
+        shutil.rmtree(work_dir)
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    if args.save_path:
+        with open(args.save_path, "w") as results_out:
+            json.dump(results, results_out, indent=2)
@@ -0,0 +1,129 @@
+# Deterministic synthetic inputs for the benchmarks
+#
+# - hourly pageview files ("<prj> <title> <count> 0", gzipped) in the
+#   dumps.wikimedia.org layout, usable as a local mirror source
+# - pages-articles XML dumps with configurable page size, link density
+#   and redirect ratio
+#
+# Titles follow a Zipf-like popularity, the same seed gives the same files.
+
+from datetime import datetime, timedelta
+import random
+import gzip
+import os
+
+# Share of lines per project code (the rest are untracked projects)
+PROJECT_WEIGHTS = {
+    "en": 0.45,
+    "en.m": 0.15,
+    "de": 0.12,
+    "cs": 0.04,
+    "sk": 0.01,
+    "fr": 0.08,
+    "ja": 0.07,
+    "commons.m": 0.08
+}
+
+# Share of titles in other namespaces (Talk:, Special:, ...)
+NAMESPACE_RATIO = 0.07
+NAMESPACES = ["Talk", "Special", "User", "File", "Category", "Wikipedia"]
+
+WORDS = [
+    "river", "house", "battle", "city", "album", "station", "church", "school",
+    "party", "island", "film", "club", "county", "bridge", "game", "song"
+]
+
+
+def title_of(idx:int) -> str:
+    """
+    Returns a title of the idx-th article (low idx -> popular).
+    """
+    word = WORDS[idx % len(WORDS)].capitalize()
+    if idx % 11 == 0:
+        return f"{word}_{idx}_(disambiguation)"
+    if idx % 7 == 0:
+        return f"{word}_{idx}_({WORDS[idx % 5]})"
+    if idx % 13 == 0:
+        return f"{word}_{idx},_{WORDS[idx % 3].capitalize()}"
+    return f"{word}_{idx}"
+
+def zipf_index(rnd:random.Random, titles_num:int) -> int:
+    """
+    Returns a random article index, P(idx) ~ 1 / (idx + 1).
+    """
+    return int(titles_num ** rnd.random()) - 1
+
+def write_hourly_pageviews(path:str, lines:int, titles_num:int, seed:int) -> None:
+    """
+    Writes one gzipped hourly pageview file.
+    """
+    rnd = random.Random(seed)
+    projects = list(PROJECT_WEIGHTS)
+    weights = list(PROJECT_WEIGHTS.values())
+    with gzip.open(path, "wt", compresslevel=1) as file_out:
+        for prj in rnd.choices(projects, weights, k=lines):
+            title = title_of(zipf_index(rnd, titles_num))
+            if rnd.random() < NAMESPACE_RATIO:
+                title = f"{rnd.choice(NAMESPACES)}:{title}"
+            count = 1 + int(rnd.expovariate(0.3))
+            file_out.write(f"{prj} {title} {count} 0\n")
+
+def make_pageviews_mirror(base_dir:str, start_date:str, days:int=1, hours:int=24,
+                          lines_per_hour:int=100000, titles_num:int=1000000, seed:int=0) -> list:
+    """
+    Generates hourly files of `days` days into base_dir/YYYY/YYYY-MM/.
+    Returns the generated paths.
+    """
+    paths = []
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    for day in range(days):
+        date = start + timedelta(days=day)
+        month_dir = os.path.join(base_dir, f"{date.year}/{date.year}-{str(date.month).zfill(2)}")
+        os.makedirs(month_dir, exist_ok=True)
+        for hour in range(hours):
+            path = os.path.join(month_dir, f"pageviews-{date.strftime('%Y%m%d')}-{str(hour).zfill(2)}0000.gz")
+            if not os.path.exists(path):
+                write_hourly_pageviews(path, lines_per_hour, titles_num, seed * 1000003 + day * 24 + hour)
+            paths.append(path)
+    return paths
+
+def write_pages_articles(path:str, pages:int, page_bytes:int=3000, links_per_kb:float=4.0,
+                         redirect_ratio:float=0.2, seed:int=0) -> None:
+    """
+    Writes a pages-articles XML dump.
+    page_bytes   -> average size of the page text
+    links_per_kb -> average number of [[links]] per 1000 bytes of text
+    """
+    rnd = random.Random(seed)
+    with open(path, "w") as file_out:
+        file_out.write('<mediawiki xml:lang="en">\n')
+        for idx in range(pages):
+            title = title_of(idx).replace("_", " ")
+            file_out.write("  <page>\n")
+            file_out.write(f"    <title>{title}</title>\n")
+            file_out.write("    <ns>0</ns>\n")
+            file_out.write(f"    <id>{idx + 1}</id>\n")
+
+            if idx and rnd.random() < redirect_ratio:
+                target = title_of(zipf_index(rnd, pages)).replace("_", " ")
+                text = f"#REDIRECT [[{target}]]"
+                file_out.write(f'    <redirect title="{target}" />\n')
+            else:
+                text_lines = []
+                size = 0
+                wanted = max(int(rnd.expovariate(1 / page_bytes)), 50)
+                while size < wanted:
+                    words = " ".join(rnd.choices(WORDS, k=12))
+                    if rnd.random() < links_per_kb * len(words) / 1000:
+                        link = title_of(zipf_index(rnd, pages)).replace("_", " ")
+                        words += f" [[{link}|{rnd.choice(WORDS)}]]" if rnd.random() < 0.3 else f" [[{link}]]"
+                    text_lines.append(words)
+                    size += len(words) + 1
+                text = "\n".join(text_lines)
+
+            file_out.write("    <revision>\n")
+            file_out.write(f"      <id>{1000000 + idx}</id>\n")
+            file_out.write(f'      <text bytes="{len(text)}" xml:space="preserve">{text}</text>\n')
+            file_out.write("    </revision>\n")
+            file_out.write("  </page>\n")
+        file_out.write("</mediawiki>\n")
@@ -6,6 +6,13 @@ DATA_FILE = WS_BASE_DIR + "data/last_update"
 DATA_DIR = WS_BASE_DIR + "data/"
 PROJECT_FILES = DATA_DIR + "project_files"
 
+# Stage state and intermediate outputs of refresh.py
+REFRESH_DIR = DATA_DIR + "refresh/"
+REFRESH_STATE_FILE = DATA_DIR + "refresh_state.json"
+
+# KB files to enrich with stats by refresh.py ({project: path}, empty -> no KB stage)
+KB_FILES = {}
+
 DUMP_DIR = "/mnt/minerva1/nlp/corpora_datasets/monolingual/{}/wikipedia"
 
 DATE_FORMAT = "%Y-%m-%d"
@@ -21,5 +28,63 @@ PROJECTS = {
 
 PAGES_ARTICLES_DUMP_REG = r"^(?:cs|en|sk)wiki-\d{8}-pages-articles.xml$"
 
+# Page indexes of the dumps (page_index.py), "" -> no index, every pass reads the XML
+PAGE_INDEX_DIR = DATA_DIR + "page_index/"
+
+# Transitive redirect tables per project (redirects.py), {prj}_redirects.tsv
+# "" -> backlinks of redirects are folded by a pass over the dump (one hop)
+REDIRECTS_DIR = DATA_DIR + "redirects/"
+
+# Count pageviews of redirects for their final targets (needs REDIRECTS_DIR)
+PAGEVIEWS_REDIRECTS = False
+
+# Pageview dump sources, tried in order (a local mirror dir can go first)
+PAGEVIEWS_SOURCES = ["https://dumps.wikimedia.org/other/pageviews"]
+
+# Keep only pageviews of titles present in the latest dump (title_filter.py)
+PAGEVIEWS_TITLE_FILTER = False
+
+# Parallel per-project merge and snapshot write of pageviews_stats.py (1 -> serial)
+PAGEVIEWS_MERGE_WORKERS = 3
+# New pageviews of projects whose merge failed, merged by the next run
+PAGEVIEWS_PENDING_DIR = DATA_DIR + "pageviews_pending/"
+
+# Storage of cumulative pageviews ("tsv" -> latest snapshot is loaded, merged and rewritten,
+# "sqlite" -> new counts are upserted into a database per project in PAGEVIEWS_DB_DIR,
+# snapshots are exported from it)
+PAGEVIEWS_BACKEND = "tsv"
+PAGEVIEWS_DB_DIR = DATA_DIR + "pageviews_db/"
+# SQLite backend: a new latest snapshot is exported every N-th run (1 -> every run,
+# 0 -> only on demand by stats_db.py export). Runs in between cost only the upserts
+# of the new range, but the latest snapshot stays behind the database until the next export.
+PAGEVIEWS_DB_EXPORT_EVERY = 1
+
+# Pageviews aggregation engine ("loop" or "vectorized" -> faster, needs more memory)
+PAGEVIEWS_ENGINE = "loop"
+
+# Compression of snapshots and intermediate files ("", ".gz", ".zst" -> needs zstandard)
+# Readers detect compressed files automatically
+STATS_COMPRESSION = ""
+
+# Delta-encoded snapshot history (snapshot_store.py), number of versions kept
+# 0 -> three full generations (latest/previous/second_previous symlinks)
+SNAPSHOT_HISTORY = 0
+# Base snapshot is rolled forward after this many versions beyond SNAPSHOT_HISTORY
+SNAPSHOT_COMPACT_EVERY = 10
+
+# Local staging tier (staging.py): temp dirs and new snapshots are written to this
+# local dir, snapshots are copied to STATS_DIR in the background and verified
+# before the symlinks are rotated ("" -> no staging)
+STAGING_DIR = ""
+# Staging is skipped if less space would be left on the local disk
+STAGING_MIN_FREE_GB = 20
+# Parallel write-backs of backlinks_primary_stats.py
+STAGING_WRITE_BACK_THREADS = 2
+
+# Hash-sharded copies of the latest snapshots (sharding.py) for parallel consumers
+# (merge_stats.py --shards, stats_to_kb.py -w), STATS_DIR/{family}/shards/latest_{prj}_{family}
+# 0 -> no shards are written
+STATS_SHARDS = 0
+
 FILE_LOCK_TIMEOUT = 600 # 10 minutes
 LOCKED_FILE_MESSAGE = "File Acquisition Timeout: Process Exiting with Failure"
@@ -0,0 +1,125 @@
+# Download layer for the hourly pageview dumps
+#
+# Manifest       -> sizes (from the month listing) and md5 checksums
+#                   (from md5sums.txt) of a month, fetched once
+#                   and cached as a local JSON file; fetched again
+#                   (load(force=True)) when a download does not match
+#                   it, as a file may have been republished
+# download_file  -> resumes partial files with HTTP Range requests and
+#                   verifies size and checksum before the file is used
+#
+# Partial files live in the temp dir of PageViews, which is wiped when
+# PageViews starts, so a download is only resumed within the same run
+# (retries of DWNLD_TRIES), not across runs.
+
+from errors import DownloadError
+import requests
+import hashlib
+import logging
+import json
+import os
+import re
+
+# Listing line, e.g.:
+# <a href="pageviews-20230101-000000.gz">pageviews-20230101-000000.gz</a>  01-Jan-2023 01:15  513435263
+LISTING_REG = re.compile(r"<a href=\"([^\"/]+\.gz)\">.*?(\d+)\s*$")
+CHECKSUM_FILE = "md5sums.txt"
+
+# Size of downloaded/hashed blocks
+BLOCK_SIZE = 1024 * 1024
+
+REQUEST_TIMEOUT = 60
+
+
+class Manifest():
+    # File sizes and checksums of one month of dumps
+    def __init__(self, base_url:str, year_month:str, cache_dir:str):
+        self.BASE_URL = base_url
+        self.YEAR_MONTH = year_month
+        self.CACHE_PATH = os.path.join(cache_dir, year_month.replace("/", "_") + ".json")
+        self.FILES = {}
+        if os.path.exists(self.CACHE_PATH):
+            with open(self.CACHE_PATH) as cache_in:
+                self.FILES = json.load(cache_in)
+
+    # Fetches the listing and checksums unless all wanted files are cached
+    # (the current month grows, so its manifest is refreshed when needed)
+    # force -> fetched even if cached (e.g. a file was republished)
+    def load(self, wanted:list=(), force:bool=False) -> "Manifest":
+        if not force and self.FILES and all(file_name in self.FILES for file_name in wanted):
+            return self
+        month_url = f"{self.BASE_URL}/{self.YEAR_MONTH}"
+        logging.info(f"Fetching manifest: {month_url}")
+
+        resp = requests.get(f"{month_url}/", timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        files = {}
+        for line in resp.text.splitlines():
+            match = LISTING_REG.search(line)
+            if match:
+                files[match.group(1)] = {"size": int(match.group(2)), "md5": None}
+
+        resp = requests.get(f"{month_url}/{CHECKSUM_FILE}", timeout=REQUEST_TIMEOUT)
+        if resp.status_code == 200:
+            for line in resp.text.splitlines():
+                values = line.split()
+                if len(values) == 2 and values[1] in files:
+                    files[values[1]]["md5"] = values[0]
+        else:
+            logging.warning(f"WARNING: No checksums for {self.YEAR_MONTH}, verifying sizes only")
+
+        self.FILES = files
+        os.makedirs(os.path.dirname(self.CACHE_PATH), exist_ok=True)
+        with open(self.CACHE_PATH, "w") as cache_out:
+            json.dump(files, cache_out)
+        return self
+
+    def get(self, file_name:str):
+        return self.FILES.get(file_name)
+
+
+def file_md5(path:str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as file_in:
+        while block := file_in.read(BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+def verify_file(path:str, entry:dict) -> bool:
+    """
+    Checks size and (if known) md5 of a downloaded file.
+    """
+    if os.path.getsize(path) != entry["size"]:
+        return False
+    return entry.get("md5") is None or file_md5(path) == entry["md5"]
+
+def download_file(url:str, path:str, entry:dict=None) -> None:
+    """
+    Downloads url to path, resumes a partial file if present.
+    Raises DownloadError if the result does not match the manifest entry
+    (corrupt files are removed, truncated ones are kept to be resumed).
+    """
+    offset = os.path.getsize(path) if entry and os.path.exists(path) else 0
+    if entry and offset > entry["size"]:
+        os.remove(path)
+        offset = 0
+
+    if not entry or offset < entry["size"]:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as resp:
+            if resp.status_code not in (200, 206):
+                raise DownloadError(f"HTTP {resp.status_code}: {url}")
+            # Server ignored the range -> whole file
+            mode = "ab" if resp.status_code == 206 else "wb"
+            with open(path, mode) as file_out:
+                for block in resp.iter_content(BLOCK_SIZE):
+                    file_out.write(block)
+
+    if not entry:
+        return
+    # Truncated transfer -> keep the partial file for the next try
+    if os.path.getsize(path) < entry["size"]:
+        raise DownloadError(f"Incomplete download: {url}")
+    if not verify_file(path, entry):
+        os.remove(path)
+        raise DownloadError(f"Size/checksum mismatch: {url}")
@@ -0,0 +1,28 @@
+from datetime import datetime
+from errors import InputError
+from config import *
+import re
+import os
+
+FILE_NAME_REG = re.compile(PAGES_ARTICLES_DUMP_REG)
+
+def latest_dump(prj:str) -> str:
+    """
+    Returns the path of the latest pages-articles dump of a project,
+    None if the dump dir contains no dump.
+    """
+    check_dir = DUMP_DIR.format(PROJECTS[prj])
+    if not os.path.exists(check_dir):
+        raise InputError(f"dump dir does not exist ({check_dir})")
+
+    dumps = [file for file in os.listdir(check_dir) if FILE_NAME_REG.match(file)]
+    if not dumps:
+        return None
+    return os.path.join(check_dir, sorted(dumps)[-1])
+
+def dump_date(dump_path:str) -> datetime:
+    """
+    Returns the date of a dump from its name (e.g. enwiki-20230701-...).
+    """
+    date = os.path.basename(dump_path).split("-")[1]
+    return datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
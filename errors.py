@@ -0,0 +1,25 @@
+# Exceptions raised by the extractors (Backlinks, PrimaryTags, PageViews)
+# CLIs catch WikiStatsError, print the message and exit with failure
+
+class WikiStatsError(Exception):
+    pass
+
+# Missing/invalid input or output files
+class InputError(WikiStatsError):
+    pass
+
+# Invalid or unavailable date range
+class DateRangeError(WikiStatsError):
+    pass
+
+# Download/fetch failures
+class DownloadError(WikiStatsError):
+    pass
+
+# Malformed or corrupt data
+class DataError(WikiStatsError):
+    pass
+
+# Lock could not be acquired in time
+class LockError(WikiStatsError):
+    pass
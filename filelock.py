@@ -0,0 +1,131 @@
+# Lock files usable on shared (NFS) storage
+#
+# A lock is a file created with O_EXCL holding the owner (host, pid).
+# The owner keeps touching it (heartbeat); a lock not touched for
+# `stale` seconds belongs to a dead process and can be taken over.
+
+from errors import LockError
+from config import FILE_LOCK_TIMEOUT, LOCKED_FILE_MESSAGE, DATA_FILE, STATS_DIR
+import threading
+import atexit
+import socket
+import time
+import os
+
+# Seconds between acquire attempts
+RETRY_INTERVAL = 1
+
+
+class LockFile():
+    def __init__(self, path:str, timeout:float=FILE_LOCK_TIMEOUT, stale:float=FILE_LOCK_TIMEOUT):
+        self.PATH = path
+        self.TIMEOUT = timeout
+        self.STALE = stale
+        self.OWNER = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+        self.__heartbeat = None
+        self.__stop = threading.Event()
+
+    # Single attempt, returns True if the lock was acquired
+    def try_acquire(self) -> bool:
+        try:
+            fd = os.open(self.PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self.__break_stale():
+                return self.try_acquire()
+            return False
+        with os.fdopen(fd, "w") as lock_out:
+            lock_out.write(self.OWNER)
+        self.__start_heartbeat()
+        # Released also when a script exits early
+        atexit.register(self.release)
+        return True
+
+    # Waits up to TIMEOUT seconds, raises LockError on timeout
+    def acquire(self) -> None:
+        deadline = time.time() + self.TIMEOUT
+        while not self.try_acquire():
+            if time.time() > deadline:
+                raise LockError(f"{LOCKED_FILE_MESSAGE} ({self.PATH})")
+            time.sleep(RETRY_INTERVAL)
+
+    def release(self) -> None:
+        atexit.unregister(self.release)
+        self.__stop.set()
+        if self.__heartbeat:
+            self.__heartbeat.join()
+            self.__heartbeat = None
+        if self.owned():
+            os.remove(self.PATH)
+
+    def owned(self) -> bool:
+        try:
+            with open(self.PATH) as lock_in:
+                return lock_in.read() == self.OWNER
+        except FileNotFoundError:
+            return False
+
+    # Moves away a lock not touched for STALE seconds
+    # Two processes may both see the same lock as stale, the later rename
+    # could then move away the fresh lock of the winner. The lock is renamed
+    # to a path of this process first and checked again there: if it is not
+    # the stale lock seen before (other owner or touched meanwhile), it is
+    # put back.
+    def __break_stale(self) -> bool:
+        try:
+            with open(self.PATH) as lock_in:
+                owner = lock_in.read()
+            if time.time() - os.path.getmtime(self.PATH) < self.STALE:
+                return False
+            stale_path = f"{self.PATH}.stale.{self.OWNER.replace(':', '_')}"
+            os.rename(self.PATH, stale_path)
+        except FileNotFoundError:
+            # Released meanwhile
+            return True
+
+        with open(stale_path) as lock_in:
+            moved_owner = lock_in.read()
+        if moved_owner == owner and time.time() - os.path.getmtime(stale_path) >= self.STALE:
+            os.remove(stale_path)
+            return True
+
+        # Not ours to break, restore it (unless yet another lock was created)
+        try:
+            os.link(stale_path, self.PATH)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+
+    def __start_heartbeat(self) -> None:
+        self.__stop.clear()
+        self.__heartbeat = threading.Thread(target=self.__touch, daemon=True)
+        self.__heartbeat.start()
+
+    def __touch(self) -> None:
+        while not self.__stop.wait(self.STALE / 3):
+            try:
+                os.utime(self.PATH)
+            except FileNotFoundError:
+                # Moved away for a moment by __break_stale of another process
+                continue
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def data_file_lock() -> LockFile:
+    """
+    Lock of the last_update data file.
+    """
+    return LockFile(DATA_FILE + ".lock")
+
+def stats_lock(family:str, prj:str) -> LockFile:
+    """
+    Lock of the snapshots and latest/previous/second_previous symlinks
+    of one stats family (pageviews, bps) and project.
+    """
+    return LockFile(os.path.join(STATS_DIR, family, f".{prj}_{family}.lock"))
@@ -4,6 +4,14 @@
 # Date:   7 Feb 2023                               #
 ####################################################
 
+from errors import WikiStatsError, InputError
+from stats_io import open_stats
+from metrics import stage, save_report, report_path
+from profiling import sampled
+from page_index import PageIndex
+from redirects import RedirectTable
+import profiling
+from collections import Counter
 import argparse
 import logging
 import os
@@ -23,47 +31,81 @@ class Backlinks():
     BL_DATA = dict()
     
     # Set all class attributes
+    # (output_file is only needed by generate_backlinks,
+    # with a redirect table links are resolved to their final targets while counting,
+    # otherwise redirects are read from page_index instead of the dump if it is current)
     def __init__(
         self,
         input_file:str,
-        output_file:str):
+        output_file:str=None,
+        page_index:PageIndex=None,
+        redirects:RedirectTable=None):
         self.INPUT_FILE = input_file
         self.OUTPUT_FILE = output_file
+        self.REDIRECTS = redirects
+        self.BL_DATA = Counter()
         self.__check_input_output()
 
+        self.PAGE_INDEX = page_index
+        if page_index and not page_index.is_current():
+            logging.warning(f"WARNING: Page index missing or stale ({page_index.INDEX_PATH}), reading the dump")
+            self.PAGE_INDEX = None
+
     # Check input, output files
-    # Returns error if input/output file does not exist
+    # Raises InputError if input file does not exist or output file exists
     def __check_input_output(self):
-        if not self.INPUT_FILE.endswith(".xml"):
+        if not self.INPUT_FILE.endswith((".xml", ".xml.gz", ".xml.zst")):
             logging.warning("WARNING: Input file might not be in correct format (wanted: XML)")
 
         if not os.path.exists(self.INPUT_FILE):
-            logging.error("ERROR: Input file not found")
-            exit(1)
+            raise InputError("Input file not found")
 
-        if os.path.exists(self.OUTPUT_FILE):
-            logging.error(f"ERROR: Output file '{self.OUTPUT_FILE}' already exists")
-            exit(1)
+        if self.OUTPUT_FILE and os.path.exists(self.OUTPUT_FILE):
+            raise InputError(f"Output file '{self.OUTPUT_FILE}' already exists")
                                                  
     # Saves generated data to a file
     def __save_to_file(self):
-        with open(self.OUTPUT_FILE, "w") as out_file:
+        if not self.OUTPUT_FILE:
+            raise InputError("No output file given")
+        with stage("backlinks:save") as metrics, open_stats(self.OUTPUT_FILE, "w") as out_file:
             for key, value in self.BL_DATA.items():
                 out_file.write(f"{key}\t{value}\n")
+            metrics.RECORDS += len(self.BL_DATA)
         self.BL_DATA.clear()
 
+    # Moves the backlinks of a redirect page to its target
+    # Returns True if the redirect page had backlinks
+    def __fold_redirect(self, redirect_from:str, redirect_to:str) -> bool:
+        redirect_to = redirect_to.replace(" ", "_")
+        redirect_from = redirect_from.replace(" ", "_")
+
+        if self.BL_DATA.get(redirect_from):
+            if not self.BL_DATA.get(redirect_to):
+                self.BL_DATA[redirect_to] = 0
+            self.BL_DATA[redirect_to] += self.BL_DATA.pop(redirect_from)
+            return True
+        return False
+
     # Goes through file and removes redirect pages 
     # from BL_DATA and adds the backlinks to the actual page
     def remove_redirects(self):
         REDIRECT_TO_REG = r"<redirect(?:.*)title=\"(.*)\"(?:.*)/>"
         REDIRECT_FROM_REG = r"<title>(.*)</title>"
 
-        with open(self.INPUT_FILE) as dump_file:
+        # Redirect pairs without a pass over the dump
+        if self.PAGE_INDEX:
+            redirects_num = 0
+            for redirect_from, redirect_to in self.PAGE_INDEX.iter_redirects():
+                if redirect_from and self.__fold_redirect(redirect_from, redirect_to):
+                    redirects_num += 1
+            return redirects_num
+
+        with open_stats(self.INPUT_FILE) as dump_file:
             in_page = False
             page_content = ""
             redirects_num = 0
 
-            for line in dump_file:
+            for line in sampled(dump_file):
                 
                 # Get page tag content
                 if line.strip() == "<page>":
@@ -76,13 +118,7 @@ class Backlinks():
                     redirect_from = re.search(REDIRECT_FROM_REG, page_content, re.MULTILINE)
 
                     if redirect_to and redirect_from:
-                        redirect_to = redirect_to.group(1).replace(" ", "_")
-                        redirect_from = redirect_from.group(1).replace(" ", "_")
-
-                        if self.BL_DATA.get(redirect_from):
-                            if not self.BL_DATA.get(redirect_to):
-                                self.BL_DATA[redirect_to] = 0
-                            self.BL_DATA[redirect_to] += self.BL_DATA.pop(redirect_from)
+                        if self.__fold_redirect(redirect_from.group(1), redirect_to.group(1)):
                             redirects_num += 1
 
                     page_content = ""
@@ -92,27 +128,50 @@ class Backlinks():
                     page_content += line
         return redirects_num
   
-    # Generates backlinks from a given input dump file
+    # Yields the article name of every backlink in the dump
     # (backlinks must match the search pattern)
+    def iter_links(self):
+        self.LINES_NUM = 0
+        with open_stats(self.INPUT_FILE) as dump_file:
+            for line in sampled(dump_file):
+                self.LINES_NUM += 1
+                for match in self.REGEX.findall(line):
+                    yield match.replace(" ", "_")
+
+    # Library API: counts backlinks, redirects are folded into their targets
+    # Returns Counter(article_name -> backlinks)
+    def count_backlinks(self) -> Counter:
+        with stage("backlinks:extract") as metrics:
+            links = self.iter_links()
+            if self.REDIRECTS is not None:
+                links = map(self.REDIRECTS.resolve, links)
+            self.BL_DATA = Counter(links)
+            self.VAL_COUNTER = sum(self.BL_DATA.values())
+            metrics.LINES += self.LINES_NUM
+            metrics.RECORDS += self.VAL_COUNTER
+
+        # Already resolved while counting
+        if self.REDIRECTS is not None:
+            return self.BL_DATA
+
+        logging.info("Removing redirects..")
+        with stage("backlinks:redirects") as metrics:
+            redirects_num = self.remove_redirects()
+            metrics.RECORDS += redirects_num
+        logging.info(f"Removed {redirects_num} redirects.")
+        return self.BL_DATA
+
+    # Library API: yields (article_name, backlinks) records
+    def iter_backlinks(self):
+        yield from self.count_backlinks().items()
+
+    # Generates backlinks from a given input dump file
+    # and saves them to the output file
     # Returns the number of generated values
     def generate_backlinks(self):
-        val_counter = 0
         logging.info("Generating backlinks..")
-        with open(self.INPUT_FILE) as dump_file:
-            for line in dump_file:
-                matches = self.REGEX.findall(line)
-                if matches:
-                    for match in matches:
-                        a_name = match.replace(" ", "_")
-                        if a_name not in self.BL_DATA:
-                            self.BL_DATA[a_name] = 1 
-                        else:
-                            self.BL_DATA[a_name] += 1
-                        val_counter += 1
-        
-        logging.info("Removing redirects..")
-        redirects_num = self.remove_redirects()
-        logging.info(f"Removed {redirects_num} redirects.")
+        self.count_backlinks()
+        val_counter = self.VAL_COUNTER
         self.__save_to_file()
         logging.info("Generation complete.")
         logging.info(f"Generated {val_counter} values.")
@@ -140,6 +199,41 @@ if __name__ == "__main__":
         help = "Output file",
     )
 
+    io_parser.add_argument(
+        "--index", 
+        type=str,
+        required=False,
+        action="store",
+        dest="index_path",
+        help="Page index of the input dump (page_index.py), used instead of a pass over the dump if current",
+    )
+
+    io_parser.add_argument(
+        "--redirects", 
+        type=str,
+        required=False,
+        action="store",
+        dest="redirects_path",
+        help="Redirect table of the input dump (redirects.py), links are counted for the final targets",
+    )
+
+    io_parser.add_argument(
+        "--profile", 
+        required=False,
+        action="store_true",
+        dest="profile",
+        help="Profile CPU time and allocations of every stage",
+    )
+
+    io_parser.add_argument(
+        "--profile-sample", 
+        type=str,
+        required=False,
+        action="store",
+        dest="profile_sample",
+        help="Profile only a sample of the input: first N MB of every input file (e.g. 500MB) or first N hours (e.g. 6h)",
+    )
+
     io_parser.add_argument(
         "-q","--quiet", 
         required=False,
@@ -158,8 +252,25 @@ if __name__ == "__main__":
     input_file = args.input_file
     output_file = args.output_file
 
+    page_index = PageIndex(input_file, args.index_path) if args.index_path else None
+
+    # Profiling (--profile-sample implies --profile)
+    if args.profile or args.profile_sample:
+        try:
+            profiling.enable(args.profile_sample)
+        except ValueError as e:
+            logging.error(f"ERROR: {e}")
+            exit(1)
+
     # Generate backlinks
     logging.info("Starting")
-    bl = Backlinks(input_file=input_file, output_file=output_file)
-    bl.generate_backlinks()
+    try:
+        redirects = RedirectTable.load(args.redirects_path) if args.redirects_path else None
+        bl = Backlinks(input_file=input_file, output_file=output_file, page_index=page_index, redirects=redirects)
+        bl.generate_backlinks()
+    except WikiStatsError as e:
+        logging.error(f"ERROR: {e}")
+        exit(1)
+    save_report(report_path(output_file), run="generate_backlinks")
+    profiling.save(profiling.profile_dir(output_file))
     logging.info("Finished.")
@@ -5,11 +5,28 @@
 ####################################################
 
 from datetime import datetime
+from urllib.parse import urlparse
+from errors import WikiStatsError, InputError, DateRangeError, DownloadError, DataError
+from dump_download import Manifest, download_file
+from collections import Counter
+from title_filter import load_title_filter
+from redirects import RedirectTable
+from stats_io import open_stats
+from metrics import stage, save_report, report_path
+from profiling import sampled, sampled_hours
+import profiling
+from sketch import TopN
+from pw_sample import HourSample, SampleEstimator
+import pw_vectorized
 import pandas as pd
 import subprocess
 import requests
+import threading
 import argparse
 import logging
+import shutil
+import queue
+import gzip
 import time
 import re
 import sys
@@ -20,6 +37,84 @@ log_level = logging.INFO
 # Log format -> display only message, no metadata
 logging.basicConfig(level=log_level, format='%(message)s')
 
+class HttpBackend():
+    # Fetches dumps over HTTP(S) into a temp dir
+    # (resumable, verified against the cached month manifests)
+    LOCAL = False
+
+    def __init__(self, base_url:str, manifest_dir:str):
+        self.BASE_URL = base_url.rstrip("/")
+        self.MANIFEST_DIR = manifest_dir
+        self.MANIFESTS = {}
+        # Months whose manifest was fetched again in this run
+        self.REFRESHED = set()
+
+    # Returns the files of a month available on the server
+    # Raises requests.RequestException if the manifest can not be fetched
+    def available(self, year_month:str, file_names:list) -> set:
+        manifest = Manifest(self.BASE_URL, year_month, self.MANIFEST_DIR).load(file_names)
+        self.MANIFESTS[year_month] = manifest
+        return {file_name for file_name in file_names if manifest.get(file_name) is not None}
+
+    # Downloads a file into out_dir, returns its path
+    # A file not matching the cached manifest may have been republished:
+    # the manifest of its month is fetched again (once per run) and the
+    # download retried if the entry changed
+    # Raises DownloadError or requests.RequestException on failure
+    def fetch(self, year_month:str, file_name:str, out_dir:str) -> str:
+        path = f"{out_dir}/{file_name}"
+        url = f"{self.BASE_URL}/{year_month}/{file_name}"
+        manifest = self.MANIFESTS[year_month]
+        entry = manifest.get(file_name)
+        try:
+            download_file(url, path, entry)
+        except DownloadError:
+            if year_month in self.REFRESHED:
+                raise
+            self.REFRESHED.add(year_month)
+            if manifest.load([file_name], force=True).get(file_name) == entry:
+                raise
+            logging.info(f"Manifest entry of {file_name} changed, downloading again..")
+            if os.path.exists(path):
+                os.remove(path)
+            download_file(url, path, manifest.get(file_name))
+        return path
+
+
+class LocalMirrorBackend():
+    # Reads dumps in place from a local (e.g. NFS) mirror
+    # with the same layout as the server: <base>/<year>/<year-month>/<file>
+    LOCAL = True
+
+    def __init__(self, base_dir:str):
+        self.BASE_DIR = base_dir.rstrip("/")
+
+    def available(self, year_month:str, file_names:list) -> set:
+        return {
+            file_name for file_name in file_names 
+            if os.path.isfile(f"{self.BASE_DIR}/{year_month}/{file_name}")
+        }
+
+    def fetch(self, year_month:str, file_name:str, out_dir:str) -> str:
+        path = f"{self.BASE_DIR}/{year_month}/{file_name}"
+        if not os.path.isfile(path):
+            raise DownloadError(f"File missing in mirror: {path}")
+        return path
+
+
+def get_backend(source:str, manifest_dir:str):
+    """
+    Returns a fetch backend for a source URL (chosen by URL scheme),
+    plain paths are treated as file:// sources.
+    """
+    url = urlparse(source)
+    if url.scheme in ("http", "https"):
+        return HttpBackend(source, manifest_dir)
+    if url.scheme in ("file", ""):
+        return LocalMirrorBackend(url.path if url.scheme else source)
+    raise ValueError(f"Unsupported source: {source}")
+
+
 class PageViews():
     # Base url for wm dumps
     WM_DUMP_BASE_URL = "https://dumps.wikimedia.org/other/pageviews"
@@ -34,6 +129,12 @@ class PageViews():
     OUTPUT_DIR = "pageviews"
     OUTPUT_FILE = ""
 
+    # Dir for cached remote manifests (sizes, checksums)
+    MANIFEST_DIR = "pwmanifest"
+
+    # Dump sources, tried in order (e.g. a local mirror first, then the server)
+    SOURCES = [WM_DUMP_BASE_URL]
+
     # Num of tries, if download fails
     DWNLD_TRIES = 3
 
@@ -47,6 +148,35 @@ class PageViews():
     START_DATE = ""
     END_DATE = ""
 
+    # Top-N mode (0 -> exact counts for all titles)
+    TOP_N = 0
+
+    # Title filter files per project (only known article titles are kept)
+    TITLE_FILTERS = {}
+
+    # Redirect tables per project (redirects.py), pageviews of redirects
+    # are counted for their final targets
+    REDIRECTS = {}
+
+    # Overlap downloading and parsing of days
+    PIPELINE = False
+    # Max number of downloaded days waiting to be parsed
+    PIPELINE_DEPTH = 1
+
+    # Extension of daily and default-named output files ("", ".gz", ".zst")
+    COMPRESSION = ""
+
+    # Aggregation engine: "loop" -> line by line (REGEX),
+    # "vectorized" -> columnar blocks and group-by sums (pw_vectorized.py)
+    ENGINES = ["loop", "vectorized"]
+    ENGINE = "loop"
+
+    # Quick-estimate mode (pw_sample.py): "every:K" or "random:N" hours
+    # are counted and scaled to estimates with confidence intervals
+    # ("" -> exact counts of all hours)
+    SAMPLE = ""
+    SAMPLE_SEED = 0
+
     # Set class attributes and perform neccessary checks and cleanups
     def __init__(
         self,
@@ -55,7 +185,17 @@ class PageViews():
         tmp_dir:str=TMP_DIR,
         output_dir:str=OUTPUT_DIR,
         output_file:str=OUTPUT_FILE,
-        projects:list=PROJECTS
+        projects:list=PROJECTS,
+        top_n:int=TOP_N,
+        title_filters:dict=TITLE_FILTERS,
+        redirects:dict=REDIRECTS,
+        pipeline:bool=PIPELINE,
+        manifest_dir:str=MANIFEST_DIR,
+        sources:list=SOURCES,
+        compression:str=COMPRESSION,
+        engine:str=ENGINE,
+        sample:str=SAMPLE,
+        sample_seed:int=SAMPLE_SEED
     ):
         self.START_DATE = start_date
         self.END_DATE = end_date
@@ -63,24 +203,63 @@ class PageViews():
 
 
         self.TMP_DIR = tmp_dir
+        self.MANIFEST_DIR = manifest_dir
         self.OUTPUT_DIR = output_dir
         self.OUTPUT_FILE = output_file
+        self.COMPRESSION = compression
         self.PROJECTS = projects
         self.__tmp_cleanup()
         self.__check_dirs()
 
         self.REGEX_DICT =  {prj:f"^{prj} {self.REGEX}" for prj in projects}
+
+        self.TOP_N = top_n
+        self.TOP_N_DATA = {prj: TopN(top_n) for prj in projects} if top_n else {}
+
+        if engine not in self.ENGINES:
+            raise InputError(f"Unknown engine '{engine}', expected one of: {', '.join(self.ENGINES)}")
+        if engine == "vectorized" and top_n:
+            raise InputError("The vectorized engine does not support the top-N mode")
+        self.ENGINE = engine
+
+        self.SAMPLE = sample
+        self.SAMPLE_SEED = sample_seed
+        self.HOUR_SAMPLE = None
+        if sample:
+            if top_n:
+                raise InputError("The sample mode does not support the top-N mode")
+            try:
+                self.HOUR_SAMPLE = HourSample.parse(sample, sample_seed)
+            except ValueError as e:
+                raise InputError(str(e))
+
+        self.TITLE_FILTERS = title_filters
+        self.__load_title_filters()
+
+        self.REDIRECTS = redirects
+        self.__load_redirects()
+
+        self.PIPELINE = pipeline
+        self.SKIPPED_FILES = []
+        self.STAGE_STATS = {}
         
+        self.SOURCES = sources
+        try:
+            self.BACKENDS = [get_backend(source, manifest_dir) for source in sources]
+        except ValueError as e:
+            raise InputError(str(e))
+
         self.__get_dwnld_data()
+        self.__sample_dwnld_data()
         self.__check_if_available()
     
-    # Checks for possible errors in inputed dates, exits on incorrect date formats or future dates
+    # Checks for possible errors in inputed dates
+    # Raises DateRangeError on incorrect date formats or future dates
     def __check_date_range(self):
         if  (not re.match(self.CORRECT_DATE_FORMAT, self.START_DATE) or
             not re.match(self.CORRECT_DATE_FORMAT, self.END_DATE)):
 
-            logging.error("ERROR: Date format incorrect, expected YYYY-MM-DD")
-            exit(1)
+            raise DateRangeError("Date format incorrect, expected YYYY-MM-DD")
 
         try:
             start_year = int(self.START_DATE.split("-")[0])
@@ -91,39 +270,33 @@ class PageViews():
             end_month = int(self.END_DATE.split("-")[1])
             end_day = int(self.END_DATE.split("-")[2])
         except IndexError:
-            logging.error("ERROR: Date format incorrect, expected YYYY-MM-DD")
-            exit(1)
+            raise DateRangeError("Date format incorrect, expected YYYY-MM-DD")
 
         except ValueError:
-            logging.error("ERROR: Unwanted characters in date, expected, YYYY-MM-DD")
-            exit(1)
+            raise DateRangeError("Unwanted characters in date, expected, YYYY-MM-DD")
         try:
             start_date = datetime(start_year, start_month, start_day)
             end_date = datetime(end_year, end_month, end_day)
         except ValueError:
-            logging.error("ERROR: Date value out of range")
-            exit(1)
+            raise DateRangeError("Date value out of range")
 
         if start_date > end_date:
-            logging.error("ERROR: Date range error")
-            exit(1)
+            raise DateRangeError("Date range error")
 
         if start_date < self.START_DATE_MINIMUM:
-            logging.error("ERROR: Start date too low, minimum: 2015-05-01")
-            exit(1)
+            raise DateRangeError("Start date too low, minimum: 2015-05-01")
         
         if end_date > datetime.now():
-            logging.error("ERROR: End date is in the future")
-            exit(1)
+            raise DateRangeError("End date is in the future")
 
         try:
              self.DATE_RANGE = pd.date_range(self.START_DATE, self.END_DATE)
         except Exception as e:
-            logging.error(f"ERROR: Date range error {e}")
-            exit(1)
+            raise DateRangeError(f"Date range error {e}")
     
     # Checks if all files for the given date range are available
-    # Exits with error if not
+    # in at least one of the sources, assigns a backend to every file
+    # Raises DateRangeError if not
     def __check_if_available(self):
         dwnld_data_keys = list(self.DWNLD_DATA.keys())
         first_year_month = dwnld_data_keys[0]
@@ -131,21 +304,50 @@ class PageViews():
         # Special case for start of pageviews dumps
         if "20150501-000000" in self.DWNLD_DATA[first_year_month][0]:
             self.DWNLD_DATA[first_year_month] = self.DWNLD_DATA[first_year_month][1:]
-        
-        first_file_name = self.DWNLD_DATA[first_year_month][0]
 
-        last_year_month = dwnld_data_keys[-1]
-        last_file_name = self.DWNLD_DATA[last_year_month][-1]
+        self.FILE_BACKENDS = {}
+        for year_month, file_names in self.DWNLD_DATA.items():
+            missing = list(file_names)
+            for backend in self.BACKENDS:
+                try:
+                    available = backend.available(year_month, missing)
+                except requests.RequestException as e:
+                    raise DownloadError(f"Unable to fetch the manifest of {year_month} ({e})")
+                for file_name in available:
+                    self.FILE_BACKENDS[file_name] = backend
+                missing = [file_name for file_name in missing if file_name not in available]
+                if not missing:
+                    break
 
-        req_url_first = f"{self.WM_DUMP_BASE_URL}/{first_year_month}/{first_file_name}"
-        req_url_last = f"{self.WM_DUMP_BASE_URL}/{last_year_month}/{last_file_name}"
+            if missing:
+                raise DateRangeError("The whole date range is not yet available on the server")
 
-        resp_first = requests.head(req_url_first).status_code
-        resp_last = requests.head(req_url_last).status_code
+        local_num = sum(backend.LOCAL for backend in self.FILE_BACKENDS.values())
+        if local_num:
+            logging.info(f"{local_num}/{len(self.FILE_BACKENDS)} files read from local mirrors")
 
-        if resp_first != 200 or resp_last != 200:
-            sys.stderr.write("ERROR: The whole date range is not yet available on the server\n")
-            exit(1)
+    # Loads title filters, raises InputError on missing filter files
+    def __load_title_filters(self):
+        self.FILTERS = {}
+        for prj, filter_path in self.TITLE_FILTERS.items():
+            if prj not in self.PROJECTS:
+                logging.warning(f"WARNING: Title filter for untracked project '{prj}' ignored")
+                continue
+            if not os.path.exists(filter_path):
+                raise InputError(f"Title filter not found: {filter_path}")
+            logging.info(f"Loading title filter ({prj}): {filter_path}")
+            self.FILTERS[prj] = load_title_filter(filter_path)
+
+    # Loads redirect tables, raises InputError on missing tables
+    def __load_redirects(self):
+        self.REDIRECT_TABLES = {}
+        for prj, table_path in self.REDIRECTS.items():
+            if prj not in self.PROJECTS:
+                logging.warning(f"WARNING: Redirect table for untracked project '{prj}' ignored")
+                continue
+            logging.info(f"Loading redirect table ({prj}): {table_path}")
+            # Pageview titles are not XML-escaped
+            self.REDIRECT_TABLES[prj] = RedirectTable.load(table_path, unescape=True)
 
     # Deletes files in a temp dir
     # Necessary before/after the script
@@ -188,126 +390,415 @@ class PageViews():
                 file_name = f"pageviews-{year}{month}{day}-{hour}0000.gz"
                 self.DWNLD_DATA[year_month].append(file_name)
     
-    # Unzips downloaded pageviews data for one day
-    # Merges them into one file
-    # Exits with error on fail
-    def __prcs_files(self, out_file_name:str):
-        logging.info("Unzipping files")
-        prcs = subprocess.run(f"gunzip {self.TMP_DIR}/prcs/*.gz --force", shell=True)
-        if prcs.returncode != 0:
-            sys.stderr.write("FAILED TO UNZIP FILES")
-            exit(1)
-        
-        logging.info("Unzipped.")
+    # Sample mode: keeps only the sampled hours in the download data,
+    # TOTAL_HOURS -> number of hours of the whole range
+    def __sample_dwnld_data(self):
+        file_names = [
+            (year_month, file_name)
+            for year_month, files in self.DWNLD_DATA.items()
+            for file_name in files
+            # No dump of the first hour (see __check_if_available)
+            if "20150501-000000" not in file_name
+        ]
+        self.TOTAL_HOURS = len(file_names)
+        if not self.HOUR_SAMPLE:
+            return
 
-        files =  sorted([file for file in os.listdir(f"{self.TMP_DIR}/prcs")])
+        selected = set(self.HOUR_SAMPLE.select([file_name for _, file_name in file_names]))
+        self.DWNLD_DATA = {}
+        for year_month, file_name in file_names:
+            if file_name in selected:
+                self.DWNLD_DATA.setdefault(year_month, []).append(file_name)
+        if not self.DWNLD_DATA:
+            raise InputError(f"Sample {self.HOUR_SAMPLE} selects no hours of the date range")
+        logging.info(f"Sample {self.HOUR_SAMPLE}: {len(selected)}/{self.TOTAL_HOURS} hours")
 
-        data = {}
-        for file_name in files:
-            logging.info(f"Extracting data: {file_name}")
-            with open(f"{self.TMP_DIR}/prcs/{file_name}") as file_in:
-                for line in file_in:
-                    line = line.strip()
-                    for prj, reg in self.REGEX_DICT.items():
-                        if not prj in data:
-                            data[prj] = {}
-                        match = re.match(reg, line)
-                        if match:
-                            article_name = match.group(1)
-                            page_count = int(match.group(2))
-                            if not article_name in data[prj]:
-                                data[prj][article_name] = 0
-                            data[prj][article_name] += page_count
+    # Streams gzipped hourly files line by line
+    # (downloaded ones from prcs_dir, mirrored ones in place)
+    # Raises DataError on a corrupt file
+    def __read_files(self, paths:list, mode:str=""):
+        for path in sorted(paths, key=os.path.basename):
+            logging.info(f"Extracting data{mode}: {os.path.basename(path)}")
+            try:
+                with gzip.open(path, "rt") as file_in:
+                    yield from sampled(file_in)
+            except (OSError, EOFError) as e:
+                raise DataError(f"Failed to unzip file {path} ({e})")
+
+    # Counts pageviews of one day
+    # Returns {prj: Counter(article_name -> pageviews)}
+    # (vectorized engine: {prj: Series(article_name -> pageviews)})
+    def __count_day(self, paths:list) -> dict:
+        if self.ENGINE == "vectorized":
+            with stage("pageviews:parse") as metrics:
+                data, metrics.LINES = pw_vectorized.count_hourly(paths, self.PROJECTS, self.FILTERS, self.REDIRECT_TABLES)
+                metrics.RECORDS += sum(len(counts) for counts in data.values())
+            return data
+
+        data = {prj: Counter() for prj in self.REGEX_DICT}
+        with stage("pageviews:parse") as metrics:
+            lines_num = 0
+            for line in self.__read_files(paths):
+                lines_num += 1
+                line = line.strip()
+                for prj, reg in self.REGEX_DICT.items():
+                    match = re.match(reg, line)
+                    if match:
+                        article_name = match.group(1)
+                        if prj in self.REDIRECT_TABLES:
+                            article_name = self.REDIRECT_TABLES[prj].resolve(article_name)
+                        if prj in self.FILTERS and article_name not in self.FILTERS[prj]:
+                            continue
+                        data[prj][article_name] += int(match.group(2))
+            metrics.LINES += lines_num
+            metrics.RECORDS += sum(len(counts) for counts in data.values())
+        return data
+
+    # Extracts pageviews data of one day
+    # Saves them into one file per project
+    def __prcs_files(self, out_file_name:str, paths:list):
+        if self.TOP_N:
+            self.__prcs_top_n(paths, out_file_name)
+            return
+
+        data = self.__count_day(paths)
         logging.info("Saving..")
-        for prj, values in data.items():
-            with open(f"{self.TMP_DIR}/pw/{prj}/{prj}_{out_file_name}", "w") as file_out:
-                for article_name, pw_count in values.items():
-                    file_out.write(f"{article_name}\t{pw_count}\n")
-        logging.debug("Removing tmp files")
-        subprocess.run(f"rm -rf {self.TMP_DIR}/prcs/*", shell=True)
+        with stage("pageviews:save_daily") as metrics:
+            for prj, values in data.items():
+                with open_stats(f"{self.TMP_DIR}/pw/{prj}/{prj}_{out_file_name}{self.COMPRESSION}", "w") as file_out:
+                    if self.ENGINE == "vectorized":
+                        pw_vectorized.write_counts(values, file_out)
+                    else:
+                        for article_name, pw_count in values.items():
+                            file_out.write(f"{article_name}\t{pw_count}\n")
+                metrics.RECORDS += len(values)
     
+    # Top-N mode: counts one day into fixed-memory sketches (per project),
+    # saves the daily top-N and merges the day into the range sketches
+    def __prcs_top_n(self, paths:list, out_file_name:str):
+        day = out_file_name.split("-")[1].split(".")[0]
+        day_data = {prj: TopN(self.TOP_N) for prj in self.PROJECTS}
+
+        with stage("pageviews:parse_top_n") as metrics:
+            lines_num = records_num = 0
+            for line in self.__read_files(paths, f" (top-{self.TOP_N})"):
+                lines_num += 1
+                # Same lines as REGEX: "<prj> <title without ':'> <count> 0"
+                values = line.rstrip("\n").split(" ")
+                if len(values) != 4 or values[3] != "0" or values[0] not in day_data:
+                    continue
+                if ":" in values[1] or not values[2].isdigit():
+                    continue
+                if values[0] in self.REDIRECT_TABLES:
+                    values[1] = self.REDIRECT_TABLES[values[0]].resolve(values[1])
+                if values[0] in self.FILTERS and values[1] not in self.FILTERS[values[0]]:
+                    continue
+                day_data[values[0]].add(values[1], int(values[2]))
+                records_num += 1
+            metrics.LINES += lines_num
+            metrics.RECORDS += records_num
+
+        for prj, top_n in day_data.items():
+            self.__save_top_n(top_n, f"{prj}_top{self.TOP_N}_{day}.tsv{self.COMPRESSION}")
+            self.TOP_N_DATA[prj].merge(top_n)
+
+    # Saves top-N titles: title, estimate (upper bound), lower bound
+    def __save_top_n(self, top_n:TopN, out_file_name:str):
+        logging.info(f"Saving {out_file_name} (count-min error bound: {top_n.SKETCH.error_bound()})")
+        with open_stats(f"{self.OUTPUT_DIR}/{out_file_name}", "w") as file_out:
+            for article_name, estimate, lower in top_n.top():
+                file_out.write(f"{article_name}\t{estimate}\t{lower}\n")
+
+    # Top-N mode: saves the top-N of the whole date range
+    def __final_top_n(self):
+        for prj, top_n in self.TOP_N_DATA.items():
+            out_file_name = f"{prj}_top{self.TOP_N}_{self.START_DATE}_{self.END_DATE}.tsv{self.COMPRESSION}"
+            if self.OUTPUT_FILE:
+                out_file_name = f"{prj}_top{self.TOP_N}_{self.OUTPUT_FILE}"
+            self.__save_top_n(top_n, out_file_name)
+        self.__tmp_cleanup()
+
+    # Sums the daily files of one project
+    # Returns {article_name: pageviews}
+    def __merge_daily(self, prj_dir:str, files:list, metrics) -> dict:
+        data_out = {}
+        for file_name in files:
+            logging.info(f"Processing file: {file_name}")
+
+            with open_stats(f"{prj_dir}/{file_name}") as file_in:
+                for line in file_in:
+                    metrics.LINES += 1
+                    line_data = line.strip().split("\t")
+                    article_name = line_data[0]
+
+                    # Empty line
+                    if(len(line_data) == 0): 
+                        continue
+
+                    try:
+                        pw_value = int(line_data[-1])
+                    except ValueError:
+                        raise DataError(f"Value not number: {line.strip()}")
+                    except IndexError:
+                        sys.stderr.write(f"Unable to load this line: {line.strip()}")
+                        continue
+
+                    if not article_name in data_out:
+                        data_out[article_name] = 0 
+                    data_out[article_name] += pw_value
+        return data_out
+
     # Merges all daily files into one file
     def __final_merge(self):
+        with stage("pageviews:merge") as metrics:
+            for prj in self.PROJECTS:
+                prj_dir = f"{self.TMP_DIR}/pw/{prj}"
+                files = os.listdir(prj_dir)
 
-        for prj in self.PROJECTS:
-            prj_dir = f"{self.TMP_DIR}/pw/{prj}"
-            files = os.listdir(prj_dir)
+                if self.ENGINE == "vectorized":
+                    data_out, lines_num = pw_vectorized.sum_daily([f"{prj_dir}/{file_name}" for file_name in files])
+                    metrics.LINES += lines_num
+                else:
+                    data_out = self.__merge_daily(prj_dir, files, metrics)
 
-            data_out = {}
+                logging.info(f"Saving project {prj}...")
+                out_file_name = f"{prj}_{self.START_DATE}_{self.END_DATE}.tsv{self.COMPRESSION}"
+                if self.OUTPUT_FILE:
+                    out_file_name = f"{prj}_{self.OUTPUT_FILE}"
+                with open_stats(f"{self.OUTPUT_DIR}/{out_file_name}", "w") as file_out:
+                    if self.ENGINE == "vectorized":
+                        pw_vectorized.write_counts(data_out, file_out)
+                    else:
+                        for key, value in data_out.items():
+                            file_out.write(f"{key}\t{value}\n")
+                metrics.RECORDS += len(data_out)
+      
+        self.__tmp_cleanup()
+    
+    # Groups download data by day
+    # Returns [(out_file_name, [(year_month, file_name), ...]), ...]
+    def __get_days(self):
+        days = {}
+        for year_month, files in self.DWNLD_DATA.items():
             for file_name in files:
-                logging.info(f"Processing file: {file_name}")
+                day = "-".join(file_name.split("-")[:2])
+                days.setdefault(day, []).append((year_month, file_name))
+        return sampled_hours([(f"{day}.tsv", day_files) for day, day_files in days.items()])
 
-                with open(f"{prj_dir}/{file_name}") as file_in:
-                    for line in file_in:
-                        line_data = line.strip().split("\t")
-                        article_name = line_data[0]
+    # Fetches one hourly file using its backend
+    # (downloads into out_dir, mirrored files are used in place)
+    # Returns the path of the file, None if the file had to be skipped
+    def __dwnld_file(self, year_month:str, file_name:str, out_dir:str):
+        backend = self.FILE_BACKENDS[file_name]
 
-                        # Empty line
-                        if(len(line_data) == 0): 
-                            continue
+        # Partial files are resumed, corrupt ones are fetched again
+        for try_n in range(self.DWNLD_TRIES):
+            try:
+                return backend.fetch(year_month, file_name, out_dir)
+            except (DownloadError, requests.RequestException) as e:
+                logging.info(f"Download of {file_name} unsuccessful ({e}), trying again..")
+                time.sleep(10)
 
-                        try:
-                            pw_value = int(line_data[-1])
-                        except ValueError:
-                            sys.stderr.write("Error: value not number")
-                            exit(1)
-                        except IndexError:
-                            sys.stderr.write(f"Unable to load this line: {line.strip()}")
-                            continue
+        self.SKIPPED_FILES.append(f"{year_month}/{file_name}")
+        logging.warning(f"Warning: Skipped file: {year_month}/{file_name}")
+        if os.path.exists(f"{out_dir}/{file_name}"):
+            os.remove(f"{out_dir}/{file_name}")
+        return None
 
-                        if not article_name in data_out:
-                            data_out[article_name] = 0 
-                        data_out[article_name] += pw_value
+    # Fetches all files of one day, returns their paths
+    def __dwnld_day(self, day_files:list, out_dir:str) -> list:
+        paths = []
+        with stage("pageviews:fetch") as metrics:
+            for i, (year_month, file_name) in enumerate(day_files):
+                logging.info(f"Num: {i+1}, Downloading {file_name}")
+                path = self.__dwnld_file(year_month, file_name, out_dir)
+                if path:
+                    paths.append(path)
+            metrics.RECORDS += len(paths)
+        return paths
 
-            logging.info(f"Saving project {prj}...")
-            out_file_name = f"{prj}_{self.START_DATE}_{self.END_DATE}.tsv"
-            if self.OUTPUT_FILE:
-                out_file_name = f"{prj}_{self.OUTPUT_FILE}"
-            with open(f"{self.OUTPUT_DIR}/{out_file_name}", "w") as file_out:
-                for key, value in data_out.items():
-                    file_out.write(f"{key}\t{value}\n")
-      
+    # Fetches hourly data from the specified date range day by day
+    # Yields (out_file_name, paths, prcs_dir) of every fetched day,
+    # downloaded files are removed once the consumer is done with the day
+    def __iter_fetched_days(self):
+        self.SKIPPED_FILES = []
+        if self.PIPELINE:
+            yield from self.__iter_fetched_days_pipelined()
+        else:
+            prcs_dir = f"{self.TMP_DIR}/prcs"
+            for out_file_name, day_files in self.__get_days():
+                yield out_file_name, self.__dwnld_day(day_files, prcs_dir), prcs_dir
+                logging.debug("Removing tmp files")
+                subprocess.run(f"rm -rf {prcs_dir}/*", shell=True)
+        logging.info("Download finished.")
+        logging.warning(f"Skipped files: {self.SKIPPED_FILES}")
+
+    # Producer/consumer version of __iter_fetched_days:
+    # a download thread fetches day N+1 while the consumer parses day N,
+    # at most PIPELINE_DEPTH downloaded days wait in the queue
+    def __iter_fetched_days_pipelined(self):
+        day_queue = queue.Queue(maxsize=self.PIPELINE_DEPTH)
+        stop = threading.Event()
+        busy = {"download": 0.0, "parse": 0.0}
+        waiting = {"download": 0.0, "parse": 0.0}
+
+        # Blocks on a full queue, returns False when the consumer stopped
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    day_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        # Stops downloading as soon as the consumer stopped, a day not
+        # handed over is removed
+        def producer():
+            try:
+                for out_file_name, day_files in self.__get_days():
+                    if stop.is_set():
+                        return
+                    day_dir = f"{self.TMP_DIR}/prcs/{out_file_name[:-len('.tsv')]}"
+                    os.makedirs(day_dir, exist_ok=True)
+
+                    start = time.perf_counter()
+                    paths = self.__dwnld_day(day_files, day_dir)
+                    busy["download"] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    if not put((out_file_name, paths, day_dir)):
+                        shutil.rmtree(day_dir, ignore_errors=True)
+                        return
+                    waiting["download"] += time.perf_counter() - start
+                put(None)
+            except BaseException as e:
+                put(e)
+
+        wall_start = time.perf_counter()
+        dwnld_thread = threading.Thread(target=producer, daemon=True)
+        dwnld_thread.start()
+        day_dir = None
+        try:
+            while True:
+                start = time.perf_counter()
+                item = day_queue.get()
+                waiting["parse"] += time.perf_counter() - start
+
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                out_file_name, paths, day_dir = item
+                start = time.perf_counter()
+                yield item
+                busy["parse"] += time.perf_counter() - start
+                shutil.rmtree(day_dir, ignore_errors=True)
+                day_dir = None
+        finally:
+            # Consumer stopped (also early): the producer finishes the day in
+            # progress at most, downloaded days left in the queue are removed
+            stop.set()
+            dwnld_thread.join()
+            if day_dir:
+                shutil.rmtree(day_dir, ignore_errors=True)
+            while not day_queue.empty():
+                item = day_queue.get_nowait()
+                if isinstance(item, tuple):
+                    shutil.rmtree(item[2], ignore_errors=True)
+
+        wall = time.perf_counter() - wall_start
+        self.STAGE_STATS = {
+            stage: {
+                "busy": busy[stage],
+                "waiting": waiting[stage],
+                "utilisation": busy[stage] / wall if wall else 0.0
+            }
+            for stage in busy
+        }
+        self.STAGE_STATS["wall"] = wall
+        logging.info(f"Pipeline finished in {wall:.1f} s")
+        for stage in busy:
+            logging.info(
+                f"  {stage}: busy {busy[stage]:.1f} s, waiting {waiting[stage]:.1f} s, "
+                f"utilisation {100 * self.STAGE_STATS[stage]['utilisation']:.1f} %"
+            )
+
+    # Sample mode: counts every sampled hour separately
+    # Returns SampleEstimator of the sampled hours
+    def __estimate(self) -> SampleEstimator:
+        estimator = SampleEstimator(self.PROJECTS)
+        for _, paths, _ in self.__iter_fetched_days():
+            for path in sorted(paths, key=os.path.basename):
+                estimator.add_hour(self.__count_day([path]))
+        return estimator
+
+    # Sample mode: saves estimates of the whole date range
+    # (title, estimate, lower bound, upper bound; highest estimates first)
+    def __save_estimates(self, estimator:SampleEstimator):
+        logging.info(f"Estimating from {estimator.HOURS}/{self.TOTAL_HOURS} hours")
+        if estimator.HOURS < 2:
+            logging.warning("WARNING: Less than 2 sampled hours, no confidence intervals")
+        with stage("pageviews:estimate") as metrics:
+            for prj in self.PROJECTS:
+                out_file_name = f"{prj}_{self.START_DATE}_{self.END_DATE}_estimate.tsv{self.COMPRESSION}"
+                if self.OUTPUT_FILE:
+                    out_file_name = f"{prj}_estimate_{self.OUTPUT_FILE}"
+                rows = estimator.estimates(prj, self.TOTAL_HOURS)
+                with open_stats(f"{self.OUTPUT_DIR}/{out_file_name}", "w") as file_out:
+                    for article_name, estimate, lower, upper in rows:
+                        file_out.write(f"{article_name}\t{estimate}\t{'NF' if lower is None else lower}\t{'NF' if upper is None else upper}\n")
+                metrics.RECORDS += len(rows)
         self.__tmp_cleanup()
-    
+
     # Download hourly data from the specified date range
     # Merge them into daily data
     # Finally merge into one file
     def __dwnld_files(self):
-        skipped_files = []
-        for year_month in self.DWNLD_DATA:
-            for i, file_name in enumerate(self.DWNLD_DATA[year_month]):  
-                
-                dwnld_link =  f"{self.WM_DUMP_BASE_URL}/{year_month}/{file_name}"
-                logging.info(f"Num: {i+1}, Downloading {file_name}")
+        if self.HOUR_SAMPLE:
+            self.__save_estimates(self.__estimate())
+            return
+
+        for out_file_name, paths, _ in self.__iter_fetched_days():
+            logging.info("Processing files..")
+            self.__prcs_files(out_file_name, paths)
+
+        if self.TOP_N:
+            self.__final_top_n()
+            return
 
-                for try_n in range(self.DWNLD_TRIES):
-                    prcs = subprocess.run(
-                        f"wget \"{dwnld_link}\" -O {self.TMP_DIR}/prcs/{file_name} --quiet",
-                        shell=True,
-                        executable="/bin/bash")
-                    
-                    if prcs.returncode == 0:
-                        break
-                    else:
-                        logging.info(f"Download of {file_name} unsuccessful, trying again..")
-                        time.sleep(10)
-                    if prcs.returncode != 0 and try_n == self.DWNLD_TRIES - 1:
-                        skipped_files.append(dwnld_link)
-                        logging.warning(f"Warning: Skipped file: {dwnld_link}")
-                        os.remove(f"{self.TMP_DIR}/prcs/{file_name}")
-                
-
-                if (i+1) % 24 == 0:
-                    logging.info("Processing files..")
-                    out_file_name = "-".join(file_name.split("-")[:2]) + ".tsv"
-                    self.__prcs_files(out_file_name) 
-        logging.info("Download finished.")
-        logging.warning(f"Skipped files: {skipped_files}")
-        
         logging.info("Merging files")
         self.__final_merge()
         logging.info("Merging finished.")
 
+    # Library API: yields (day, {prj: Counter(article_name -> pageviews)})
+    # for every day of the range (exact counts, no output files)
+    def iter_days(self):
+        for out_file_name, paths, _ in self.__iter_fetched_days():
+            day = out_file_name[:-len(".tsv")].split("-")[1]
+            data = self.__count_day(paths)
+            if self.ENGINE == "vectorized":
+                data = {prj: Counter(counts.to_dict()) for prj, counts in data.items()}
+            yield day, data
+
+    # Library API: returns {prj: Counter(article_name -> pageviews)}
+    # for the whole date range
+    def count_pageviews(self) -> dict:
+        data = {prj: Counter() for prj in self.PROJECTS}
+        for _, day_data in self.iter_days():
+            for prj, counts in day_data.items():
+                data[prj].update(counts)
+        return data
+
+    # Library API (sample mode): returns {prj: [(article_name, estimate, lower, upper)]}
+    # for the whole date range, highest estimates first
+    def estimate_pageviews(self) -> dict:
+        if not self.HOUR_SAMPLE:
+            raise InputError("Estimates need the sample mode (sample=\"every:K\" or \"random:N\")")
+        estimator = self.__estimate()
+        return {prj: estimator.estimates(prj, self.TOTAL_HOURS) for prj in self.PROJECTS}
+
     # Runs the dwnld_files method
     def get_pageviews(self):
         self.__dwnld_files()
@@ -353,6 +844,24 @@ if __name__ == "__main__":
         help="Temp dir for (for storing unprocessed data)"
     )
 
+    parser.add_argument(
+        "--source", 
+        required=False,
+        nargs="+",
+        action="store", 
+        dest="sources",
+        help="Dump sources tried in order: http(s):// URL or file:// / directory mirror (default: dumps.wikimedia.org)"
+    )
+
+    parser.add_argument(
+        "--manifest-dir", 
+        type=str,
+        required=False,
+        action="store", 
+        dest="manifest_dir",
+        help="Dir for cached dump manifests (sizes, checksums)"
+    )
+
     parser.add_argument(
         "--projects", 
         required=False,
@@ -362,6 +871,96 @@ if __name__ == "__main__":
         help="List of projects",
     )
 
+    parser.add_argument(
+        "--top-n", 
+        type=int,
+        required=False,
+        action="store",
+        dest="top_n",
+        help="Only output the approx. top N titles per day and range (fixed memory, with error bounds)"
+    )
+
+    parser.add_argument(
+        "--title-filters", 
+        required=False,
+        nargs="+",
+        action="store",
+        dest="title_filters",
+        help="Keep only known article titles, filter files per project (e.g. en=en_titles.bloom), see title_filter.py",
+    )
+
+    parser.add_argument(
+        "--redirects", 
+        required=False,
+        nargs="+",
+        action="store",
+        dest="redirects",
+        help="Count pageviews of redirects for their targets, redirect tables per project (e.g. en=en_redirects.tsv), see redirects.py",
+    )
+
+    parser.add_argument(
+        "--pipeline", 
+        required=False,
+        action="store_true",
+        dest="pipeline",
+        help="Download the next day while the current one is being parsed",
+    )
+
+    parser.add_argument(
+        "--compress", 
+        required=False,
+        choices=["gz", "zst"],
+        action="store",
+        dest="compress",
+        help="Compress daily and output files (zst needs the zstandard module)",
+    )
+
+    parser.add_argument(
+        "--engine", 
+        required=False,
+        choices=PageViews.ENGINES,
+        default=PageViews.ENGINE,
+        action="store",
+        dest="engine",
+        help="Aggregation engine: loop (line by line) or vectorized (columnar blocks, needs more memory)",
+    )
+
+    parser.add_argument(
+        "--sample", 
+        type=str,
+        required=False,
+        action="store",
+        dest="sample",
+        help="Quick estimates from a sample of hours: every:K (every K-th hour of a day, random start hour per day) or random:N (N hours per day), output: title, estimate, 95%% lower and upper bound (assume a random sample of hours)",
+    )
+
+    parser.add_argument(
+        "--sample-seed", 
+        type=int,
+        required=False,
+        default=PageViews.SAMPLE_SEED,
+        action="store",
+        dest="sample_seed",
+        help="Seed of the sampled hours (same seed -> same hours)",
+    )
+
+    parser.add_argument(
+        "--profile", 
+        required=False,
+        action="store_true",
+        dest="profile",
+        help="Profile CPU time and allocations of every stage",
+    )
+
+    parser.add_argument(
+        "--profile-sample", 
+        type=str,
+        required=False,
+        action="store",
+        dest="profile_sample",
+        help="Profile only a sample of the input: first N MB of every input file (e.g. 500MB) or first N hours (e.g. 6h)",
+    )
+
     parser.add_argument(
         "--quiet", 
         required=False,
@@ -386,18 +985,58 @@ if __name__ == "__main__":
         tmp_dir = args.tmp_dir
     if args.prj_list:
         prj_list = args.prj_list
+
+    title_filters = {}
+    for value in args.title_filters or []:
+        prj, _, filter_path = value.partition("=")
+        if not filter_path:
+            sys.stderr.write(f"Error: Invalid title filter '{value}', expected PROJECT=FILE\n")
+            exit(1)
+        title_filters[prj] = filter_path
+
+    redirects = {}
+    for value in args.redirects or []:
+        prj, _, table_path = value.partition("=")
+        if not table_path:
+            sys.stderr.write(f"Error: Invalid redirect table '{value}', expected PROJECT=FILE\n")
+            exit(1)
+        redirects[prj] = table_path
     
     # Do not print anything
     if args.quiet:
         logging.basicConfig(level=logging.CRITICAL+1)
 
+    # Profiling (--profile-sample implies --profile)
+    if args.profile or args.profile_sample:
+        try:
+            profiling.enable(args.profile_sample)
+        except ValueError as e:
+            sys.stderr.write(f"Error: {e}\n")
+            exit(1)
+
     # Generate pageviews
-    pw = PageViews(
-        start_date=start_date, 
-        end_date=end_date,
-        tmp_dir=tmp_dir,
-        output_dir=out_dir,
-        projects=prj_list
-    )
-    pw.get_pageviews()
+    try:
+        pw = PageViews(
+            start_date=start_date, 
+            end_date=end_date,
+            tmp_dir=tmp_dir,
+            output_dir=out_dir,
+            projects=prj_list,
+            top_n=args.top_n or 0,
+            title_filters=title_filters,
+            redirects=redirects,
+            pipeline=args.pipeline,
+            manifest_dir=args.manifest_dir or PageViews.MANIFEST_DIR,
+            sources=args.sources or PageViews.SOURCES,
+            compression=f".{args.compress}" if args.compress else "",
+            engine=args.engine,
+            sample=args.sample or "",
+            sample_seed=args.sample_seed
+        )
+        pw.get_pageviews()
+    except WikiStatsError as e:
+        logging.error(f"ERROR: {e}")
+        exit(1)
+    save_report(report_path(out_dir), run="generate_pageviews", skipped_files=pw.SKIPPED_FILES, pipeline=pw.STAGE_STATS)
+    profiling.save(profiling.profile_dir(out_dir))
    
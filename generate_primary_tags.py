@@ -4,6 +4,12 @@
 # Date:   7 Feb 2023                               #
 ####################################################
 
+from errors import WikiStatsError, InputError
+from stats_io import open_stats
+from metrics import stage, save_report, report_path
+from profiling import sampled
+from page_index import PageIndex
+import profiling
 import argparse
 import logging
 import sys
@@ -27,33 +33,43 @@ class PrimaryTags():
     PT_DATA = dict()
 
     # Set all class attributes
+    # (output_file is only needed by generate_ptags,
+    # titles are read from page_index instead of the dump if it is current)
     def __init__(
         self,
         input_file:str,
-        output_file:str):
+        output_file:str=None,
+        page_index:PageIndex=None):
         self.INPUT_FILE = input_file
         self.OUTPUT_FILE = output_file
+        self.PT_DATA = dict()
         self.__check_input_output()
+
+        self.PAGE_INDEX = page_index
+        if page_index and not page_index.is_current():
+            logging.warning(f"WARNING: Page index missing or stale ({page_index.INDEX_PATH}), reading the dump")
+            self.PAGE_INDEX = None
     
     # Check input, output files
-    # Returns error if input/output file does not exist
+    # Raises InputError if input file does not exist or output file exists
     def __check_input_output(self):
-        if not self.INPUT_FILE.endswith(".xml"):
+        if not self.INPUT_FILE.endswith((".xml", ".xml.gz", ".xml.zst")):
             logging.warning("WARNING: Input file might not be in correct format (wanted: XML)")
 
         if not os.path.exists(self.INPUT_FILE):
-            logging.error("ERROR: Input file not found")
-            exit(1)
+            raise InputError("Input file not found")
 
-        if os.path.exists(self.OUTPUT_FILE):
-            logging.error(f"ERROR: Output file '{self.OUTPUT_FILE}' already exists")
-            exit(1)
+        if self.OUTPUT_FILE and os.path.exists(self.OUTPUT_FILE):
+            raise InputError(f"Output file '{self.OUTPUT_FILE}' already exists")
     
     # Saves generated data to a file
     def __save_to_file(self):
-        with open(self.OUTPUT_FILE, "w") as out_file:
+        if not self.OUTPUT_FILE:
+            raise InputError("No output file given")
+        with stage("ptags:save") as metrics, open_stats(self.OUTPUT_FILE, "w") as out_file:
             for key, value in self.PT_DATA.items():
                 out_file.write(f"{key}\t{value}\n")
+            metrics.RECORDS += len(self.PT_DATA)
         self.PT_DATA.clear()
     
     @staticmethod
@@ -62,23 +78,44 @@ class PrimaryTags():
             return False
         return True
 
-    # Generates primary tags from a given input dump file
-    # (primary tags must match the search pattern)
+    # Library API: yields (article_name, primary tag) for every title
+    # in the dump (primary tags must match the search pattern)
     # (also must not contain "(" or ",_" ... else not a primary link
+    def iter_ptags(self):
+        self.LINES_NUM = 0
+        for line in self.__iter_title_lines():
+            self.LINES_NUM += 1
+            match = self.REGEX.match(line.strip())
+            if match:
+                a_name = match.group(1).replace(" ", "_")   
+                if self.is_primary(a_name):
+                    yield a_name, 0
+                else:
+                    yield a_name, 1
+
+    # Yields the lines of the dump, or only the <title> lines
+    # rebuilt from the page index (same matches of the search pattern)
+    def __iter_title_lines(self):
+        if self.PAGE_INDEX:
+            for entry in self.PAGE_INDEX.iter_pages():
+                yield f"<title>{entry.title}</title>"
+            return
+
+        with open_stats(self.INPUT_FILE) as dump_file:
+            yield from sampled(dump_file)
+
+    # Generates primary tags from a given input dump file
+    # and saves them to the output file
     # Returns the number of generated values
     def generate_ptags(self):
         val_counter = 0
         logging.info("Generating primary tags..")
-        with open(self.INPUT_FILE) as dump_file:
-            for line in dump_file:
-                match = self.REGEX.match(line.strip())
-                if match:
-                    a_name = match.group(1).replace(" ", "_")   
-                    if self.is_primary(a_name):
-                        self.PT_DATA[a_name] = 0
-                    else:
-                        self.PT_DATA[a_name] = 1
-                    val_counter += 1
+        with stage("ptags:extract") as metrics:
+            for a_name, ptag in self.iter_ptags():
+                self.PT_DATA[a_name] = ptag
+                val_counter += 1
+            metrics.LINES += self.LINES_NUM
+            metrics.RECORDS += val_counter
         self.__save_to_file()
         logging.info("Generation complete.")
         logging.info(f"Generated {val_counter} values.")
@@ -107,6 +144,32 @@ if __name__ == "__main__":
         help = "Output file",
     )
 
+    io_parser.add_argument(
+        "--index", 
+        type=str,
+        required=False,
+        action="store",
+        dest="index_path",
+        help="Page index of the input dump (page_index.py), used instead of a pass over the dump if current",
+    )
+
+    io_parser.add_argument(
+        "--profile", 
+        required=False,
+        action="store_true",
+        dest="profile",
+        help="Profile CPU time and allocations of every stage",
+    )
+
+    io_parser.add_argument(
+        "--profile-sample", 
+        type=str,
+        required=False,
+        action="store",
+        dest="profile_sample",
+        help="Profile only a sample of the input: first N MB of every input file (e.g. 500MB) or first N hours (e.g. 6h)",
+    )
+
     io_parser.add_argument(
         "-q","--quiet", 
         required=False,
@@ -123,8 +186,24 @@ if __name__ == "__main__":
     input_file = args.input_file
     output_file = args.output_file
 
+    page_index = PageIndex(input_file, args.index_path) if args.index_path else None
+
+    # Profiling (--profile-sample implies --profile)
+    if args.profile or args.profile_sample:
+        try:
+            profiling.enable(args.profile_sample)
+        except ValueError as e:
+            logging.error(f"ERROR: {e}")
+            exit(1)
+
     # Generate primary tags
     logging.info("Starting")
-    pt = PrimaryTags(input_file=input_file, output_file=output_file)
-    pt.generate_ptags()
+    try:
+        pt = PrimaryTags(input_file=input_file, output_file=output_file, page_index=page_index)
+        pt.generate_ptags()
+    except WikiStatsError as e:
+        logging.error(f"ERROR: {e}")
+        exit(1)
+    save_report(report_path(output_file), run="generate_primary_tags")
+    profiling.save(profiling.profile_dir(output_file))
     logging.info("Finished.")
@@ -0,0 +1,322 @@
+# Chunked (optionally parallel) insertion of stats into a KB
+#
+# Stats from the pageviews and bps files are joined once into a sorted,
+# read-only table file, which every worker memory-maps (no per-worker copies).
+# The KB body is split into line-aligned byte ranges, every range is enriched
+# separately and the chunks are concatenated back in their original order.
+# The serial path (workers=1) runs the very same code over a single range,
+# so both paths produce byte-identical output.
+#
+# Sharded pageviews and bps stats (sharding.py) with the same number of
+# shards are joined shard by shard in parallel into one table per shard,
+# lookups go to the table of the shard the title hashes to.
+#
+# This is a separate writer, not KnowledgeBase.insert_stats (kb_metrics):
+# its output was only compared between worker counts, not with insert_stats.
+# It handles plain KBs only: a head block with the "<__generic__>" line and
+# its WIKIPEDIA URL column, no stats columns yet; the "<__stats__>" head
+# line is added and backlinks, pageviews and primary sense ("NF" if not
+# found) are appended to every entity line. Other layouts (e.g. a KB that
+# already has stats) are refused (check_kb_layout).
+
+from concurrent.futures import ProcessPoolExecutor
+from kb_head import KB_HEAD_TEMPLATE
+from stats_io import load_stats
+import sharding
+import tempfile
+import io
+import logging
+import shutil
+import struct
+import mmap
+import zlib
+import os
+import re
+
+# Table file layout:
+#   header  -> magic, number of records
+#   offsets -> uint64 offset of every record (relative to the records start)
+#   records -> b"title\tbacklinks\tpageviews\tprimary\n" sorted by title
+TABLE_MAGIC = b"WSSTATS1"
+TABLE_HEADER = struct.Struct("<8sQ")
+
+# Value used for titles not found in the stats
+NOT_FOUND = b"NF"
+
+STATS_TYPE = "<__stats__>"
+GENERIC_TYPE = "<__generic__>"
+WIKI_URL_COLUMN = "WIKIPEDIA URL"
+
+# Default chunk size (bytes of the KB body per task)
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Column modifiers, e.g. "{m}ALIASES" -> "ALIASES"
+COLUMN_MODIFIER_REG = re.compile(r"^\{.*?\}")
+
+
+class StatsTable():
+    # Read-only, memory-mapped view of a table file
+    def __init__(self, path:str):
+        self.PATH = path
+        self.__file = open(path, "rb")
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.SIZE = TABLE_HEADER.unpack_from(self.__mm, 0)
+        if magic != TABLE_MAGIC:
+            raise ValueError(f"Not a stats table: {path}")
+
+        offsets_start = TABLE_HEADER.size
+        self.__records_start = offsets_start + 8 * self.SIZE
+        self.__offsets = memoryview(self.__mm)[offsets_start:self.__records_start].cast("Q")
+
+    # Builds a table file from the pageviews and bps stats files
+    @staticmethod
+    def build(pw_path:str, bps_path:str, table_path:str) -> int:
+        _, pw_data = load_stats(pw_path)
+        _, bps_data = load_stats(bps_path)
+
+        records = {}
+        for title in pw_data.keys() | bps_data.keys():
+            pw_values = pw_data.get(title) or ["NF"]
+            bps_values = bps_data.get(title) or ["NF", "NF"]
+            bl_count = bps_values[0] if len(bps_values) > 0 else "NF"
+            ps_count = bps_values[1] if len(bps_values) > 1 else "NF"
+            records[title.encode()] = f"{bl_count}\t{pw_values[0]}\t{ps_count}".encode()
+        del pw_data, bps_data
+
+        keys = sorted(records)
+        with open(table_path, "wb") as table_out:
+            table_out.write(TABLE_HEADER.pack(TABLE_MAGIC, len(keys)))
+            offset = 0
+            offsets = []
+            for key in keys:
+                offsets.append(offset)
+                offset += len(key) + len(records[key]) + 2
+            table_out.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+            for key in keys:
+                table_out.write(key + b"\t" + records[key] + b"\n")
+        return len(keys)
+
+    # Returns the record key at the given index
+    def __key(self, idx:int) -> bytes:
+        start = self.__records_start + self.__offsets[idx]
+        return self.__mm[start:self.__mm.find(b"\t", start)]
+
+    # Returns b"backlinks\tpageviews\tprimary" for a title, None if missing
+    def get(self, title:bytes):
+        low, high = 0, self.SIZE
+        while low < high:
+            mid = (low + high) // 2
+            if self.__key(mid) < title:
+                low = mid + 1
+            else:
+                high = mid
+        if low == self.SIZE or self.__key(low) != title:
+            return None
+        start = self.__records_start + self.__offsets[low] + len(title) + 1
+        return self.__mm[start:self.__mm.find(b"\n", start)]
+
+    def close(self):
+        self.__offsets.release()
+        self.__mm.close()
+        self.__file.close()
+
+
+class ShardedStatsTable():
+    # One StatsTable per shard (a dir of table-NNNNN files)
+    def __init__(self, path:str):
+        self.PATH = path
+        names = sorted(name for name in os.listdir(path) if name.startswith("table-"))
+        self.TABLES = [StatsTable(os.path.join(path, name)) for name in names]
+        self.SIZE = sum(table.SIZE for table in self.TABLES)
+
+    # Returns b"backlinks\tpageviews\tprimary" for a title, None if missing
+    def get(self, title:bytes):
+        return self.TABLES[zlib.crc32(title) % len(self.TABLES)].get(title)
+
+    def close(self):
+        for table in self.TABLES:
+            table.close()
+
+def open_table(table_path:str):
+    """
+    Opens a table file, or a dir of tables built per shard.
+    """
+    if os.path.isdir(table_path):
+        return ShardedStatsTable(table_path)
+    return StatsTable(table_path)
+
+def build_table(pw_path:str, bps_path:str, work_dir:str, workers:int=1) -> tuple:
+    """
+    Builds the stats table in work_dir, one table per shard if both
+    stats are sharded with the same number of shards.
+    Returns (table path, number of records).
+    """
+    shards = sharding.shards_num(pw_path)
+    if not shards or shards != sharding.shards_num(bps_path):
+        table_path = os.path.join(work_dir, "stats.table")
+        return table_path, StatsTable.build(pw_path, bps_path, table_path)
+
+    table_path = os.path.join(work_dir, "stats.tables")
+    os.makedirs(table_path)
+    table_paths = [os.path.join(table_path, f"table-{i:05d}") for i in range(shards)]
+    logging.info(f"Joining {shards} shards ({workers} workers)..")
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        records = executor.map(
+            StatsTable.build,
+            sharding.shard_paths(pw_path),
+            sharding.shard_paths(bps_path),
+            table_paths
+        )
+        return table_path, sum(records)
+
+
+# Table opened once per worker process (see _init_worker)
+_TABLE = None
+
+def _init_worker(table_path:str):
+    global _TABLE
+    _TABLE = open_table(table_path)
+
+def wiki_url_column(head:str) -> int:
+    """
+    Returns the index of the WIKIPEDIA URL column from the KB head.
+    """
+    for line in head.splitlines():
+        if line.startswith(GENERIC_TYPE):
+            columns = line[len(GENERIC_TYPE):].rstrip("\n").split("\t")
+            for idx, column in enumerate(columns):
+                if COLUMN_MODIFIER_REG.sub("", column) == WIKI_URL_COLUMN:
+                    return idx
+    raise ValueError(f"KB head does not contain the '{WIKI_URL_COLUMN}' column")
+
+def check_kb_layout(head:str) -> None:
+    """
+    Raises ValueError for KB layouts the chunked writer does not handle
+    (no "<__generic__>" line with the WIKIPEDIA URL column, stats already present).
+    """
+    wiki_url_column(head)
+    if any(line.startswith(STATS_TYPE) for line in head.splitlines()):
+        raise ValueError("KB already contains stats, use KnowledgeBase.insert_stats (kb_metrics)")
+
+def stats_head(head:str) -> str:
+    """
+    Returns the KB head with the stats columns declared.
+    """
+    head_line = STATS_TYPE + "".join(f"{column}\t" for column in KB_HEAD_TEMPLATE[STATS_TYPE])
+    return head + head_line + "\n"
+
+def read_kb_head(kb_path:str) -> tuple:
+    """
+    Returns (head, byte offset of the first entity line) of a KB file.
+    """
+    head = b""
+    with open(kb_path, "rb") as kb_in:
+        while (line := kb_in.readline()).strip() != b"":
+            head += line
+        return head.decode(), kb_in.tell()
+
+def chunk_ranges(kb_path:str, start:int, chunk_size:int=CHUNK_SIZE) -> list:
+    """
+    Splits the KB body into line-aligned (start, end) byte ranges.
+    """
+    size = os.path.getsize(kb_path)
+    ranges = []
+    with open(kb_path, "rb") as kb_in:
+        while start < size:
+            kb_in.seek(min(start + chunk_size, size))
+            kb_in.readline()
+            end = min(kb_in.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def enrich_lines(lines, table, url_idx:int):
+    """
+    Appends backlinks, pageviews and primary sense to every KB line.
+    """
+    missing = b"\t".join([NOT_FOUND] * 3)
+    for line in lines:
+        body = line.rstrip(b"\n")
+        if body == b"":
+            yield line
+            continue
+        columns = body.split(b"\t")
+        stats = None
+        if len(columns) > url_idx:
+            stats = table.get(columns[url_idx].rsplit(b"/", 1)[-1])
+        yield body + b"\t" + (stats or missing) + line[len(body):]
+
+def enrich_chunk(kb_path:str, start:int, end:int, out_path:str, url_idx:int, table=None) -> int:
+    """
+    Enriches one byte range of the KB, returns the number of lines.
+    """
+    table = table or _TABLE
+    lines_num = 0
+    with open(kb_path, "rb") as kb_in, open(out_path, "wb") as chunk_out:
+        kb_in.seek(start)
+        chunk = kb_in.read(end - start)
+        for line in enrich_lines(io.BytesIO(chunk), table, url_idx):
+            chunk_out.write(line)
+            lines_num += 1
+    return lines_num
+
+def insert_stats(
+    kb_path:str,
+    pw_path:str,
+    bps_path:str,
+    output_path:str,
+    workers:int=1,
+    chunk_size:int=CHUNK_SIZE,
+    tmp_dir:str=None
+) -> int:
+    """
+    Inserts stats into a KB, returns the number of enriched lines.
+    Raises ValueError for KB layouts it does not handle (check_kb_layout).
+    """
+    head, body_start = read_kb_head(kb_path)
+    check_kb_layout(head)
+    work_dir = tempfile.mkdtemp(prefix="ws_kb_", dir=tmp_dir)
+    try:
+        logging.info("Building stats table..")
+        table_path, records_num = build_table(pw_path, bps_path, work_dir, workers)
+        logging.info(f"Stats table: {records_num} titles")
+
+        url_idx = wiki_url_column(head)
+        ranges = chunk_ranges(kb_path, body_start, chunk_size)
+        chunk_paths = [os.path.join(work_dir, f"chunk_{i:06d}") for i in range(len(ranges))]
+        logging.info(f"Enriching {len(ranges)} chunks ({workers} workers)..")
+
+        if workers <= 1:
+            table = open_table(table_path)
+            try:
+                lines_num = sum(
+                    enrich_chunk(kb_path, start, end, chunk_path, url_idx, table)
+                    for (start, end), chunk_path in zip(ranges, chunk_paths)
+                )
+            finally:
+                table.close()
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(table_path,)
+            ) as executor:
+                futures = [
+                    executor.submit(enrich_chunk, kb_path, start, end, chunk_path, url_idx)
+                    for (start, end), chunk_path in zip(ranges, chunk_paths)
+                ]
+                lines_num = sum(future.result() for future in futures)
+
+        # Write chunks back in their original order
+        logging.info("Saving..")
+        with open(output_path, "wb") as kb_out:
+            kb_out.write(stats_head(head).encode())
+            kb_out.write(b"\n")
+            for chunk_path in chunk_paths:
+                with open(chunk_path, "rb") as chunk_in:
+                    shutil.copyfileobj(chunk_in, kb_out)
+                os.remove(chunk_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return lines_num
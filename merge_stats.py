@@ -5,7 +5,16 @@
 ############################################
 
 from kb_head import KB_HEAD_TEMPLATE
+from stats_io import open_stats, read_head
+from metrics import stage, save_report, report_path, RunReport, REPORT
+from profiling import sampled
+from concurrent.futures import ProcessPoolExecutor
+from errors import WikiStatsError
+import multiprocessing
+import profiling
+import sharding
 import argparse
+import shutil
 import time
 import csv
 import sys
@@ -52,6 +61,42 @@ io_parser.add_argument(
 )
 
 
+io_parser.add_argument(
+    "--profile", 
+    required=False,
+    action="store_true",
+    dest="profile",
+    help="Profile CPU time and allocations of every stage",
+)
+
+io_parser.add_argument(
+    "--profile-sample", 
+    type=str,
+    required=False,
+    action="store",
+    dest="profile_sample",
+    help="Profile only a sample of the input: first N MB of every input file (e.g. 500MB) or first N hours (e.g. 6h)",
+)
+
+io_parser.add_argument(
+    "--shards", 
+    type=int,
+    required=False,
+    action="store",
+    dest="shards",
+    help="Write the output as N hash shards (sharding.py) merged in parallel, sharded inputs with N shards are merged shard by shard",
+)
+
+io_parser.add_argument(
+    "-w","--workers", 
+    type=int,
+    required=False,
+    default=os.cpu_count(),
+    action="store",
+    dest="workers",
+    help="Number of processes merging shards (only with --shards)",
+)
+
 args = io_parser.parse_args()
 
 bl_file = args.bl_file
@@ -59,46 +104,136 @@ pw_file = args.pw_file
 pr_file = args.pr_file
 out_file = args.out_file
 
+# Profiling (--profile-sample implies --profile)
+if args.profile or args.profile_sample:
+    try:
+        profiling.enable(args.profile_sample)
+    except ValueError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
+
 
 # OUTPUT FILE FORMAT
 # ARTICLE_NAME \t BACKLINKS \t PAGEVIEWS \t PRIMARY
- 
-out_data = {}
 
-print("Starting")
-with open(bl_file) as bl_in, open(pw_file) as pw_in, open(pr_file) as pr_in:
-    
-    # Files in order of output format
-    in_files_list = [bl_in, pw_in, pr_in]
-
-    for idx, file in enumerate(in_files_list, start=0):
-        in_data = csv.reader(file, delimiter="\t")
-        for val in in_data:
-            art_name = val[0]
-            try:
-                count = int(val[1])
-            except ValueError:
-                continue
-
-            if art_name not in out_data:
-                out_data[art_name] = ["NF", "NF", "NF"]
-            out_data[art_name][idx] = count
-
-print("Saving data..")
-with open(out_file, "w") as file_out:
-    # KB HEAD
-    for type, columns in KB_HEAD_TEMPLATE.items():
-        file_out.write(type)
-        for column in columns:
-            file_out.write(column + "\t")
+def load_inputs(in_files_list:list, report:RunReport=REPORT, head:bool=False) -> dict:
+    """
+    Loads input files (in order of the output format) into {title: [values]}.
+    head -> the files start with a head block (parts of sharded stats)
+    """
+    out_data = {}
+    with report.stage("merge:load") as metrics:
+        for idx, path in enumerate(in_files_list, start=0):
+            with open_stats(path) as file:
+                if head:
+                    read_head(file)
+                in_data = csv.reader(sampled(file), delimiter="\t")
+                for val in in_data:
+                    metrics.LINES += 1
+                    art_name = val[0]
+                    try:
+                        count = int(val[1])
+                    except ValueError:
+                        continue
+
+                    if art_name not in out_data:
+                        out_data[art_name] = ["NF", "NF", "NF"]
+                    out_data[art_name][idx] = count
+    return out_data
+
+def save_merged(out_data:dict, out_path:str, report:RunReport=REPORT) -> None:
+    with report.stage("merge:save") as metrics, open_stats(out_path, "w") as file_out:
+        metrics.RECORDS += len(out_data)
+        # KB HEAD
+        for type, columns in KB_HEAD_TEMPLATE.items():
+            file_out.write(type)
+            for column in columns:
+                file_out.write(column + "\t")
+            file_out.write("\n")
         file_out.write("\n")
-    file_out.write("\n")
 
-    # KB DATA
-    for key, values in out_data.items():
-        file_out.write(key)
-        for value in values:
-            file_out.write(f"\t{value}")
-        file_out.write("\n")
+        # KB DATA
+        for key, values in out_data.items():
+            file_out.write(key)
+            for value in values:
+                file_out.write(f"\t{value}")
+            file_out.write("\n")
+
+def merge_shard(part_paths:list, heads:list, out_path:str) -> tuple:
+    """
+    Merges shard i of all inputs into one output part (in a worker process).
+    Returns (number of records, stage metrics).
+    """
+    report = RunReport()
+    out_data = {}
+    for idx, (path, head) in enumerate(zip(part_paths, heads)):
+        part_data = load_inputs([path], report, head)
+        for art_name, values in part_data.items():
+            out_data.setdefault(art_name, ["NF", "NF", "NF"])[idx] = values[0]
+    save_merged(out_data, out_path, report)
+    return len(out_data), list(report.STAGES.values())
+
+def merge_sharded(in_files_list:list, out_dir:str, shards:int, workers:int) -> dict:
+    """
+    Merges inputs into a sharded output dir, returns its manifest.
+    Inputs which are not sharded with the same number of shards are split first.
+    """
+    tmp_dir = sharding.tmp_dir_of(out_dir)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        inputs = []
+        for idx, path in enumerate(in_files_list):
+            if sharding.shards_num(path) != shards:
+                split_dir = os.path.join(tmp_dir, f"input_{idx}")
+                print(f"Splitting {os.path.basename(path)} into {shards} shards..")
+                with stage("merge:split") as metrics:
+                    metrics.RECORDS += sharding.split_stats(path, split_dir, shards)["records"]
+                path = split_dir
+            inputs.append((sharding.shard_paths(path), sharding.read_manifest(path)["head"]))
+
+        parts = [{"name": sharding.part_name(i), "records": 0} for i in range(shards)]
+        heads = [head for _, head in inputs]
+        # Fork keeps the parsed arguments and the sample limit in the workers
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = [
+                executor.submit(
+                    merge_shard,
+                    [paths[i] for paths, _ in inputs],
+                    heads,
+                    os.path.join(tmp_dir, parts[i]["name"])
+                )
+                for i in range(shards)
+            ]
+            for part, future in zip(parts, futures):
+                part["records"], stages = future.result()
+                for stage_metrics in stages:
+                    REPORT.add(stage_metrics)
+
+        for idx in range(len(in_files_list)):
+            shutil.rmtree(os.path.join(tmp_dir, f"input_{idx}"), ignore_errors=True)
+        return sharding.finish_shards(tmp_dir, out_dir, parts, head=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
 
+
+print("Starting")
+# Files in order of output format
+in_files_list = [bl_file, pw_file, pr_file]
+
+if args.shards:
+    try:
+        manifest = merge_sharded(in_files_list, out_file, args.shards, args.workers)
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
+    print(f"Merged {manifest['records']} titles into {args.shards} shards")
+else:
+    out_data = load_inputs(in_files_list)
+    print("Saving data..")
+    save_merged(out_data, out_file)
+
+save_report(report_path(out_file), run="merge_stats")
+profiling.save(profiling.profile_dir(out_file))
 print("Finished.")
\ No newline at end of file
@@ -0,0 +1,177 @@
+# Per-stage metrics and JSON run reports
+#
+#   with stage("pageviews:parse") as st:
+#       ...
+#       st.LINES += lines_num
+#       st.RECORDS += records_num
+#   save_report("out/run_report.json")
+#
+# Every stage records wall time, CPU time and bytes read/written of the
+# thread running it (stages of the pipelined download thread do not mix
+# with the parsing thread), peak RSS of the process at the end of the
+# stage and the given line/record counts. Stages with the same name are
+# summed up.
+
+from datetime import datetime
+import threading
+import resource
+import json
+import time
+import sys
+import os
+
+THREAD_IO_FILE = "/proc/thread-self/io"
+
+# ru_maxrss is in bytes on macOS, in KiB elsewhere
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+# Stage profiler (profiling.enable), None -> stages are not profiled
+PROFILER = None
+
+
+def thread_io() -> tuple:
+    """
+    Returns (bytes read, bytes written) by the current thread,
+    (0, 0) where /proc is not available.
+    """
+    try:
+        with open(THREAD_IO_FILE) as io_in:
+            values = dict(line.split(":", 1) for line in io_in)
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 2**20
+
+
+class StageMetrics():
+    # Counters of one stage
+    def __init__(self, name:str):
+        self.NAME = name
+        self.CALLS = 0
+        self.WALL = 0.0
+        self.CPU = 0.0
+        self.BYTES_READ = 0
+        self.BYTES_WRITTEN = 0
+        self.LINES = 0
+        self.RECORDS = 0
+        self.PEAK_RSS_MB = 0.0
+
+    def merge(self, other:"StageMetrics") -> None:
+        self.CALLS += other.CALLS
+        self.WALL += other.WALL
+        self.CPU += other.CPU
+        self.BYTES_READ += other.BYTES_READ
+        self.BYTES_WRITTEN += other.BYTES_WRITTEN
+        self.LINES += other.LINES
+        self.RECORDS += other.RECORDS
+        self.PEAK_RSS_MB = max(self.PEAK_RSS_MB, other.PEAK_RSS_MB)
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.CALLS,
+            "wall_s": round(self.WALL, 3),
+            "cpu_s": round(self.CPU, 3),
+            "bytes_read": self.BYTES_READ,
+            "bytes_written": self.BYTES_WRITTEN,
+            "lines": self.LINES,
+            "records": self.RECORDS,
+            "lines_per_s": round(self.LINES / self.WALL, 1) if self.WALL else None,
+            "records_per_s": round(self.RECORDS / self.WALL, 1) if self.WALL else None,
+            "mb_read_per_s": round(self.BYTES_READ / 2**20 / self.WALL, 2) if self.WALL else None,
+            "peak_rss_mb": round(self.PEAK_RSS_MB, 1)
+        }
+
+
+class Stage():
+    # Measures one run of a stage, used as a context manager
+    # (or start()/stop() where a with block does not fit)
+    def __init__(self, report:"RunReport", name:str):
+        self.REPORT = report
+        self.METRICS = StageMetrics(name)
+
+    def start(self) -> StageMetrics:
+        self.__wall_start = time.perf_counter()
+        self.__cpu_start = time.thread_time()
+        self.__read_start, self.__written_start = thread_io()
+        if PROFILER:
+            PROFILER.start(self.METRICS.NAME)
+        return self.METRICS
+
+    def stop(self) -> None:
+        read, written = thread_io()
+        self.METRICS.CALLS = 1
+        self.METRICS.WALL = time.perf_counter() - self.__wall_start
+        self.METRICS.CPU = time.thread_time() - self.__cpu_start
+        self.METRICS.BYTES_READ = read - self.__read_start
+        self.METRICS.BYTES_WRITTEN = written - self.__written_start
+        self.METRICS.PEAK_RSS_MB = peak_rss_mb()
+        self.REPORT.add(self.METRICS)
+        if PROFILER:
+            PROFILER.stop(self.METRICS.NAME)
+
+    def __enter__(self) -> StageMetrics:
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class RunReport():
+    # Metrics of all stages of one run
+    def __init__(self):
+        self.STAGES = {}
+        self.STARTED = datetime.now()
+        self.__wall_start = time.perf_counter()
+        self.__cpu_start = time.process_time()
+        self.__lock = threading.Lock()
+
+    def stage(self, name:str) -> "Stage":
+        return Stage(self, name)
+
+    def add(self, metrics:StageMetrics) -> None:
+        with self.__lock:
+            self.STAGES.setdefault(metrics.NAME, StageMetrics(metrics.NAME)).merge(metrics)
+
+    def to_dict(self, **info) -> dict:
+        with self.__lock:
+            stages = {name: metrics.to_dict() for name, metrics in self.STAGES.items()}
+        return {
+            **info,
+            "argv": sys.argv,
+            "host": os.uname().nodename,
+            "pid": os.getpid(),
+            "started": self.STARTED.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "wall_s": round(time.perf_counter() - self.__wall_start, 3),
+            "cpu_s": round(time.process_time() - self.__cpu_start, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "stages": stages
+        }
+
+    def save(self, path:str, **info) -> dict:
+        report = self.to_dict(**info)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w") as report_out:
+            json.dump(report, report_out, indent=2)
+        os.replace(path + ".tmp", path)
+        return report
+
+
+# Report of the current process, filled by the extractors and scripts
+REPORT = RunReport()
+
+def stage(name:str) -> Stage:
+    return REPORT.stage(name)
+
+def save_report(path:str, **info) -> dict:
+    return REPORT.save(path, **info)
+
+def report_path(output_path:str) -> str:
+    """
+    Returns the report path next to an output file or in an output dir.
+    """
+    if os.path.isdir(output_path):
+        return os.path.join(output_path, "run_report.json")
+    return output_path + ".report.json"
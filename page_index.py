@@ -0,0 +1,250 @@
+#! /bin/python3
+
+# Sidecar page index of a pages-articles dump
+#
+# One pass over the dump writes (TSV, compressed by extension):
+#   dump       <file name>          -> head block (stats_io.read_head),
+#   size       <dump size>             used to detect a stale index
+#   mtime_ns   <dump mtime>
+#
+#   offset  length  id  ns  revision  title  redirect    -> one row per <page>
+#
+# offset/length are bytes of the <page> ... </page> block in the (decompressed)
+# dump, titles and redirect targets are kept as they are in the XML (same
+# as PrimaryTags and Backlinks read them). Metadata-only stages (titles,
+# redirects) read the index instead of the XML, read_page() seeks straight
+# to a page (uncompressed dumps only).
+#
+#   page_index.py build -i enwiki-...-pages-articles.xml
+#   page_index.py lookup -i enwiki-...-pages-articles.xml "Prague" --xml
+
+from errors import WikiStatsError, InputError, DataError
+from stats_io import open_stats, read_head, compression_of
+from metrics import stage
+from collections import namedtuple
+import argparse
+import logging
+import sys
+import os
+import re
+
+PageEntry = namedtuple("PageEntry", ["offset", "length", "page_id", "ns", "revision", "title", "redirect"])
+
+INDEX_SUFFIX = ".index.tsv"
+
+TITLE_REG = re.compile(rb"<title>(.*)</title>")
+REDIRECT_REG = re.compile(rb"<redirect(?:.*)title=\"(.*)\"(?:.*)/>")
+ID_REG = re.compile(rb"<id>(\d+)</id>")
+NS_REG = re.compile(rb"<ns>(-?\d+)</ns>")
+
+
+def index_path_of(dump_path:str, index_dir:str=None) -> str:
+    """
+    Returns the default index path of a dump (next to it or in index_dir).
+    """
+    if index_dir:
+        return os.path.join(index_dir, os.path.basename(dump_path) + INDEX_SUFFIX)
+    return dump_path + INDEX_SUFFIX
+
+def int_or_none(value:str):
+    return int(value) if value else None
+
+
+class PageIndex():
+    # Index of one dump, built by build() and read by the other methods
+    def __init__(self, dump_path:str, index_path:str=None):
+        self.DUMP_PATH = dump_path
+        self.INDEX_PATH = index_path or index_path_of(dump_path)
+
+    # Returns the head fields describing the current dump file
+    def __dump_head(self) -> dict:
+        if not os.path.exists(self.DUMP_PATH):
+            raise InputError(f"Dump not found: {self.DUMP_PATH}")
+        dump_stat = os.stat(self.DUMP_PATH)
+        return {
+            "dump": os.path.basename(self.DUMP_PATH),
+            "size": str(dump_stat.st_size),
+            "mtime_ns": str(dump_stat.st_mtime_ns)
+        }
+
+    # Returns the head of the index file as a dict
+    def __read_head(self, file_in) -> dict:
+        head = {}
+        for line in read_head(file_in).splitlines():
+            key, _, value = line.partition("\t")
+            head[key] = value
+        return head
+
+    # True if the index exists and was built from the current dump file
+    def is_current(self) -> bool:
+        if not os.path.exists(self.INDEX_PATH) or not os.path.exists(self.DUMP_PATH):
+            return False
+        with open_stats(self.INDEX_PATH) as index_in:
+            head = self.__read_head(index_in)
+        dump_head = self.__dump_head()
+        return all(head.get(key) == value for key, value in dump_head.items())
+
+    # Yields PageEntry of every <page> of the dump (one pass over the XML)
+    def scan(self):
+        with open_stats(self.DUMP_PATH, "rb") as dump_file:
+            offset = 0
+            page = None
+            for line in dump_file:
+                line_start = offset
+                offset += len(line)
+                stripped = line.strip()
+
+                if page is None:
+                    if stripped == b"<page>":
+                        page = {"offset": line_start, "revision": None, "in_revision": False}
+                    continue
+
+                if stripped == b"</page>":
+                    yield PageEntry(
+                        page["offset"],
+                        offset - page["offset"],
+                        page.get("id"),
+                        page.get("ns"),
+                        page["revision"],
+                        page.get("title", ""),
+                        page.get("redirect", "")
+                    )
+                    page = None
+                    continue
+
+                # Page text is skipped once the revision id is known
+                if page["revision"] is not None or not stripped.startswith(b"<"):
+                    continue
+
+                if stripped == b"<revision>":
+                    page["in_revision"] = True
+                elif stripped.startswith(b"<id>"):
+                    match = ID_REG.match(stripped)
+                    if match and page["in_revision"]:
+                        page["revision"] = int(match.group(1))
+                    elif match and "id" not in page:
+                        page["id"] = int(match.group(1))
+                elif stripped.startswith(b"<title>") and "title" not in page:
+                    match = TITLE_REG.match(stripped)
+                    if match:
+                        page["title"] = match.group(1).decode("utf-8", "replace")
+                elif stripped.startswith(b"<ns>"):
+                    match = NS_REG.match(stripped)
+                    if match:
+                        page["ns"] = int(match.group(1))
+                elif stripped.startswith(b"<redirect"):
+                    match = REDIRECT_REG.search(stripped)
+                    if match:
+                        page["redirect"] = match.group(1).decode("utf-8", "replace")
+
+    # Builds the index file, returns the number of pages
+    def build(self) -> int:
+        dump_head = self.__dump_head()
+        index_dir = os.path.dirname(os.path.abspath(self.INDEX_PATH))
+        os.makedirs(index_dir, exist_ok=True)
+
+        tmp_path = f"{self.INDEX_PATH}.tmp{os.getpid()}{os.path.splitext(self.INDEX_PATH)[1]}"
+        pages_num = 0
+        with stage("index:build") as metrics:
+            with open_stats(tmp_path, "w") as index_out:
+                for key, value in dump_head.items():
+                    index_out.write(f"{key}\t{value}\n")
+                index_out.write("\n")
+                for entry in self.scan():
+                    index_out.write("\t".join("" if value is None else str(value) for value in entry) + "\n")
+                    pages_num += 1
+            os.replace(tmp_path, self.INDEX_PATH)
+            metrics.RECORDS += pages_num
+        logging.info(f"Indexed {pages_num} pages: {self.INDEX_PATH}")
+        return pages_num
+
+    # Builds the index unless a current one exists, returns self
+    def ensure(self) -> "PageIndex":
+        if not self.is_current():
+            self.build()
+        return self
+
+    # Yields PageEntry of every indexed page (in dump order)
+    # Raises InputError on a missing index, DataError on a corrupt one
+    def iter_pages(self):
+        if not os.path.exists(self.INDEX_PATH):
+            raise InputError(f"Page index not found: {self.INDEX_PATH} (run page_index.py build)")
+        with open_stats(self.INDEX_PATH) as index_in:
+            self.__read_head(index_in)
+            for line in index_in:
+                values = line.rstrip("\n").split("\t")
+                if len(values) != len(PageEntry._fields):
+                    raise DataError(f"Corrupt page index line: {line.strip()}")
+                offset, length, page_id, ns, revision, title, redirect = values
+                yield PageEntry(
+                    int(offset),
+                    int(length),
+                    int_or_none(page_id),
+                    int_or_none(ns),
+                    int_or_none(revision),
+                    title,
+                    redirect
+                )
+
+    # Yields (title, redirect target) of every redirect page
+    def iter_redirects(self):
+        for entry in self.iter_pages():
+            if entry.redirect:
+                yield entry.title, entry.redirect
+
+    # Returns {title: PageEntry} of the given titles found in the index
+    def lookup(self, titles:list) -> dict:
+        wanted = set(titles)
+        return {entry.title: entry for entry in self.iter_pages() if entry.title in wanted}
+
+    # Returns the <page> XML of an entry
+    # Raises InputError for compressed dumps (no random access)
+    def read_page(self, entry:PageEntry) -> str:
+        if compression_of(self.DUMP_PATH):
+            raise InputError(f"Random access needs an uncompressed dump: {self.DUMP_PATH}")
+        with open(self.DUMP_PATH, "rb") as dump_file:
+            dump_file.seek(entry.offset)
+            return dump_file.read(entry.length).decode("utf-8", "replace")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Index a dump")
+    lookup_parser = subparsers.add_parser("lookup", help="Print index entries (or XML) of pages")
+
+    for sub in (build_parser, lookup_parser):
+        sub.add_argument("-i", "--input", type=str, required=True, dest="dump_path", help="pages-articles dump")
+        sub.add_argument("--index", type=str, dest="index_path", help=f"Index file (default: <dump>{INDEX_SUFFIX})")
+
+    build_parser.add_argument("--force", action="store_true", dest="force", help="Rebuild a current index")
+    lookup_parser.add_argument("titles", nargs="+", help="Page titles (as in the dump)")
+    lookup_parser.add_argument("--xml", action="store_true", dest="xml", help="Print the <page> XML")
+    args = parser.parse_args()
+
+    page_index = PageIndex(args.dump_path, args.index_path)
+    try:
+        if args.command == "build":
+            if not args.force and page_index.is_current():
+                logging.info(f"Index is current: {page_index.INDEX_PATH}")
+            else:
+                page_index.build()
+
+        if args.command == "lookup":
+            if not page_index.is_current():
+                raise InputError(f"Page index missing or stale: {page_index.INDEX_PATH}")
+            entries = page_index.lookup(args.titles)
+            for title in args.titles:
+                entry = entries.get(title)
+                if entry is None:
+                    sys.stderr.write(f"Not found: {title}\n")
+                elif args.xml:
+                    print(page_index.read_page(entry), end="")
+                else:
+                    print("\t".join("" if value is None else str(value) for value in entry))
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
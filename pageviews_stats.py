@@ -6,10 +6,13 @@
 # Date:   15 Jul 2023                              #
 ####################################################
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from os.path import realpath
+import multiprocessing
 import subprocess
-import tempfile
+import argparse
+import shutil
 import signal
 import sys
 import os
@@ -17,12 +20,46 @@ import re
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "-e", "--end", 
+    type=str,
+    required=False,
+    action="store", 
+    dest="end_date",
+    help="Ingest pageviews up to this day (YYYY-MM-DD), without waiting for new dumps"
+)
+
+parser.add_argument(
+    "--profile", 
+    required=False,
+    action="store_true",
+    dest="profile",
+    help="Profile CPU time and allocations of every stage (saved next to the run report)"
+)
+args = parser.parse_args()
+
 from generate_pageviews import PageViews
+from errors import WikiStatsError, LockError
+from filelock import data_file_lock, stats_lock
+from title_filter import build_title_filter
+from redirects import ensure_redirect_table
+from page_index import PageIndex, index_path_of
 from cleanup import delete_temp_dir
-from symlink import symlink
+from snapshot_store import rotate_snapshot
+from sharding import publish_shards, shards_dir_of
+from stats_db import StatsDB
+from staging import make_tmp_dir, staged_path, size_of, copy_verified
+from stats_io import open_stats
+from metrics import save_report, RunReport, REPORT
+import profiling
 from config import *
 
-TMP_DIR = tempfile.mkdtemp(prefix="ws_pw_")
+if args.profile:
+    profiling.enable()
+
+TMP_DIR = make_tmp_dir("ws_pw_")
 os.mkdir(f"{TMP_DIR}/pwtemp")
 os.mkdir(f"{TMP_DIR}/pwout")
 
@@ -30,10 +67,29 @@ if not os.path.exists(STATS_DIR):
     print("Error: Stats directory does not exits, exiting.")
     exit(1)
 
+if PAGEVIEWS_BACKEND not in ["tsv", "sqlite"]:
+    sys.stderr.write(f"Error: Unknown PAGEVIEWS_BACKEND '{PAGEVIEWS_BACKEND}' (tsv or sqlite)\n")
+    exit(1)
+
 signal.signal(signal.SIGINT, lambda sig, frame: delete_temp_dir(TMP_DIR))
 
 FILE_NAME_REG = re.compile(PAGES_ARTICLES_DUMP_REG)
 
+# Seconds between progress reports of the per-project merge
+MERGE_PROGRESS_INTERVAL = 30
+
+def acquire_or_exit(lock):
+    """
+    Acquires a lock (waits up to FILE_LOCK_TIMEOUT), exits on timeout.
+    """
+    try:
+        lock.acquire()
+    except LockError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        delete_temp_dir(TMP_DIR)
+        exit(1)
+    return lock
+
 def load_prev_date() -> datetime:
     with open(DATA_FILE, "r") as file_in:
         
@@ -51,8 +107,12 @@ def load_prev_date() -> datetime:
     return last_update
 
 def update_date(new_date:datetime) -> None:
-    with open(DATA_FILE, "w") as file_out:
+    with open(DATA_FILE + ".tmp", "w") as file_out:
         file_out.write(new_date.strftime(DATE_FORMAT))
+    os.replace(DATA_FILE + ".tmp", DATA_FILE)
+
+# last_update is read now and advanced at the end, held for the whole run
+acquire_or_exit(data_file_lock())
 
 # Get the latest dump for each project
 dumps_info = {}
@@ -78,27 +138,38 @@ for key, value in PROJECTS.items():
     latest_dump_timestamp = datetime(year, month, day)
     last_timestamp = load_prev_date()
     
-    # Compare if new dumps exist
-    if latest_dump_timestamp > last_timestamp:
+    # Compare if new dumps exist (any dump is fine with an explicit end date)
+    if latest_dump_timestamp > last_timestamp or args.end_date:
         print(f"Latest dump ({key}): {latest_dump}")
         dumps_info[key] = {
                 "path":f"{check_dir}/{latest_dump}", 
                 "latest_timestamp": latest_dump_timestamp
             }
 
-if len(dumps_info) == 0:
-    print("Everything up to date.")
-    exit(0)
+# Date range from the last update until now                  
+start_date = load_prev_date()
 
-# Every project must have a new dump in order for the script to run
-if len(dumps_info) != len(PROJECTS):
-    sys.stderr.write("Error: not all dumps are yet available\n")
-    exit(1)
+if args.end_date:
+    try:
+        end_date = datetime.strptime(args.end_date, DATE_FORMAT)
+    except ValueError:
+        sys.stderr.write("Error: End date format incorrect, expected YYYY-MM-DD\n")
+        exit(1)
 
+    if end_date < start_date:
+        print("Everything up to date.")
+        exit(0)
+else:
+    if len(dumps_info) == 0:
+        print("Everything up to date.")
+        exit(0)
+
+    # Every project must have a new dump in order for the script to run
+    if len(dumps_info) != len(PROJECTS):
+        sys.stderr.write("Error: not all dumps are yet available\n")
+        exit(1)
 
-# Date range from the last update until now                  
-start_date = load_prev_date()
-end_date = min([item["latest_timestamp"] for item in list(dumps_info.values())])-timedelta(days=1)
+    end_date = min([item["latest_timestamp"] for item in list(dumps_info.values())])-timedelta(days=1)
 
 start_date_str = start_date.strftime(DATE_FORMAT)
 end_date_str = end_date.strftime(DATE_FORMAT)
@@ -106,35 +177,81 @@ end_date_str = end_date.strftime(DATE_FORMAT)
 print("Date range:", start_date_str, end_date_str)
 print("Generating pageviews")                   
 
+# Title filters from the latest dumps
+title_filters = {}
+if PAGEVIEWS_TITLE_FILTER:
+    for prj, dump_info in dumps_info.items():
+        print(f"Building title filter ({prj})")
+        title_filters[prj] = f"{TMP_DIR}/{prj}/titles.bloom"
+        build_title_filter(dump_info["path"], title_filters[prj], bloom=True)
+
+# Redirect tables of the latest dumps (shared with backlinks_primary_stats.py)
+redirects = {}
+if PAGEVIEWS_REDIRECTS and REDIRECTS_DIR:
+    try:
+        for prj, dump_info in dumps_info.items():
+            page_index = None
+            if PAGE_INDEX_DIR:
+                page_index = PageIndex(dump_info["path"], index_path_of(dump_info["path"], PAGE_INDEX_DIR))
+            redirects[prj] = ensure_redirect_table(
+                dump_info["path"],
+                os.path.join(REDIRECTS_DIR, f"{prj}_redirects.tsv"),
+                page_index
+            )
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        delete_temp_dir(TMP_DIR)
+        exit(1)
+
 # Generate pageviews
-pw = PageViews(start_date_str, end_date_str, tmp_dir=f"{TMP_DIR}/pwtemp", output_dir=f"{TMP_DIR}/pwout", output_file="pageviews.tsv")
-pw.get_pageviews()
+try:
+    pw = PageViews(
+        start_date_str, 
+        end_date_str, 
+        tmp_dir=f"{TMP_DIR}/pwtemp", 
+        output_dir=f"{TMP_DIR}/pwout", 
+        output_file=f"pageviews.tsv{STATS_COMPRESSION}",
+        title_filters=title_filters,
+        redirects=redirects,
+        pipeline=True,
+        compression=STATS_COMPRESSION,
+        manifest_dir=os.path.join(DATA_DIR, "pw_manifest"),
+        sources=PAGEVIEWS_SOURCES,
+        engine=PAGEVIEWS_ENGINE
+    )
+    pw.get_pageviews()
+except WikiStatsError as e:
+    sys.stderr.write(f"Error: {e}\n")
+    delete_temp_dir(TMP_DIR)
+    exit(1)
 
 
 # Move generated pageviews to a temp dir
 for prj in PROJECTS.keys():
-    prcs = subprocess.run(f"mv {TMP_DIR}/pwout/{prj}_pageviews.tsv {TMP_DIR}/{prj}", shell=True)
+    prcs = subprocess.run(f"mv {TMP_DIR}/pwout/{prj}_pageviews.tsv{STATS_COMPRESSION} {TMP_DIR}/{prj}", shell=True)
     if prcs.returncode != 0:
         sys.stderr.write("Error while moving pageviews data\n")
         exit(1)
 
-print("Loading previous data")
-
-for prj in dumps_info.keys():
+# Merges the previous snapshot with pageview files into a new snapshot (TSV backend)
+# Whole snapshot is loaded, merged and rewritten
+def merge_tsv(prj:str, prev_file_path:str, pw_files:list, new_file_path:str, progress, report:RunReport) -> None:
+    snapshot_stage = report.stage(f"snapshot:{prj}")
+    snapshot_metrics = snapshot_stage.start()
     
     out_data = {}
     STATS_HEAD = ""
 
     # Load previous data for project    
-    prev_file_path = os.path.join(STATS_DIR, f"pageviews/latest_{prj}_pageviews.tsv")
+    progress[prj] = "loading"
 
-    with open(realpath(prev_file_path), "r") as prev_file_in:
+    with open_stats(realpath(prev_file_path), "r") as prev_file_in:
         # Load head
         while (line := prev_file_in.readline()).strip() != "":
             STATS_HEAD += line
                 
         # Load data
-        print(f"Loading {prj}: {prev_file_path}")
+        print(f"Loading {prj}: {prev_file_path}", flush=True)
         for line in prev_file_in:
             in_data = [val.strip() for val in line.split("\t")]      
             try:
@@ -146,41 +263,37 @@ for prj in dumps_info.keys():
             
             out_data[art_name] = pw_count    
     
-    pw_file = f"{TMP_DIR}/{prj}/{prj}_pageviews.tsv"
-    
     # Merge data with previous file
-    print(f"Merging {prj}")
-    with open(pw_file, "r") as pw_in:
-        for line in pw_in:
-            values = [val.strip() for val in line.split("\t")]
-            art_name = values[0]
-
-            # Get stat value
-            try:
-                count = int(values[1])
-
-            # Invalid stat --> ignore
-            except ValueError:
-                continue
-            
-            # If pw_count --> add values
-            # Else -> rewrite them
-            if art_name not in out_data:
-                out_data[art_name] = count            
-            else:
-                if out_data[art_name] == "NF":
-                    out_data[art_name] = count
+    progress[prj] = "merging"
+    for pw_file, _ in pw_files:
+        print(f"Merging {prj}: {os.path.basename(pw_file)}", flush=True)
+        with open_stats(pw_file, "r") as pw_in:
+            for line in pw_in:
+                values = [val.strip() for val in line.split("\t")]
+                art_name = values[0]
+
+                # Get stat value
+                try:
+                    count = int(values[1])
+
+                # Invalid stat --> ignore
+                except (ValueError, IndexError):
+                    continue
+                
+                # If pw_count --> add values
+                # Else -> rewrite them
+                if art_name not in out_data:
+                    out_data[art_name] = count            
                 else:
-                    prev_pw_count = int(out_data[art_name])
-                    out_data[art_name] = prev_pw_count+count
-
-    new_file_path = os.path.join(
-        STATS_DIR, 
-        f"pageviews/{datetime.now().strftime(FILE_DATE_FORMAT)}_{prj}_pageviews.tsv"
-    )
+                    if out_data[art_name] == "NF":
+                        out_data[art_name] = count
+                    else:
+                        prev_pw_count = int(out_data[art_name])
+                        out_data[art_name] = prev_pw_count+count
     
-    print("Saving data..")
-    with open(new_file_path, "w") as file_out:
+    print(f"Saving {prj}..", flush=True)
+    progress[prj] = "saving"
+    with open_stats(new_file_path, "w") as file_out:
         # Write head
         file_out.write(STATS_HEAD)
         if not STATS_HEAD.endswith("\n\n"):
@@ -190,24 +303,219 @@ for prj in dumps_info.keys():
         for article, value in out_data.items():
             file_out.write(f"{article}\t{value}\n")
     
-    
-    # Update symlinks (keep only last three versions of file)
-    latest_path = prev_file_path
-    previous_path = os.path.join(STATS_DIR, f"pageviews/previous_{prj}_pageviews.tsv")
-    second_previous_path = os.path.join(STATS_DIR, f"pageviews/second_previous_{prj}_pageviews.tsv")
-    
-    # Delete the last version
-    os.remove(realpath(second_previous_path)) if os.path.exists(realpath(second_previous_path)) else None
-    
-    # Shift symlinks 
-    symlink(realpath(previous_path), second_previous_path)
-    symlink(realpath(latest_path), previous_path)
-    symlink(realpath(new_file_path), latest_path)
-        
+    snapshot_metrics.RECORDS += len(out_data)
+    snapshot_stage.stop()
+
+# Adds pageview files to the database of a project and exports a new snapshot (SQLite backend)
+# Only titles of the new files are touched, the db is (re)imported from the
+# previous snapshot if it does not match it
+# Returns False if the export was left for a later run (PAGEVIEWS_DB_EXPORT_EVERY)
+def merge_db(prj:str, prev_file_path:str, pw_files:list, new_file_path:str, progress, report:RunReport) -> bool:
+    with StatsDB(db_path_of(prj), report) as db:
+        if not db.matches(realpath(prev_file_path)):
+            progress[prj] = "loading"
+            if db.unexported_runs():
+                print(f"Warning: Counts of {db.unexported_runs()} runs not exported from {db.PATH} are replaced", flush=True)
+            print(f"Importing {prj}: {prev_file_path}", flush=True)
+            db.import_tsv(realpath(prev_file_path))
+
+        progress[prj] = "merging"
+        for pw_file, batch in pw_files:
+            print(f"Merging {prj}: {os.path.basename(pw_file)}", flush=True)
+            db.upsert_file(pw_file, batch)
+
+        runs = db.unexported_runs() + 1
+        if not PAGEVIEWS_DB_EXPORT_EVERY or runs < PAGEVIEWS_DB_EXPORT_EVERY:
+            db.set_unexported_runs(runs)
+            print(f"Export of {prj} skipped ({runs} runs not exported)", flush=True)
+            return False
+
+        print(f"Saving {prj}..", flush=True)
+        progress[prj] = "saving"
+        db.export_tsv(new_file_path)
+    return True
+
+def db_path_of(prj:str) -> str:
+    return os.path.join(PAGEVIEWS_DB_DIR, f"{prj}_pageviews.sqlite")
+
+# Merges the new pageviews of a project (and pending ones of earlier failed runs)
+# into a new snapshot and rotates the symlinks
+# Returns the stage metrics of the project (run in a worker process)
+def merge_project(prj:str, progress) -> list:
+    report = RunReport()
+    prj_lock = stats_lock("pageviews", prj)
+    prj_lock.acquire()
+    try:
+        prev_file_path = os.path.join(STATS_DIR, f"pageviews/latest_{prj}_pageviews.tsv")
+        new_file_path = os.path.join(
+            STATS_DIR, 
+            f"pageviews/{datetime.now().strftime(FILE_DATE_FORMAT)}_{prj}_pageviews.tsv{STATS_COMPRESSION}"
+        )
+
+        # (file, date range) pairs
+        pending_files = pending_pageviews(prj)
+        pw_files = [(pw_file, pending_range(prj, pw_file)) for pw_file in pending_files]
+        pw_files.append((f"{TMP_DIR}/{prj}/{prj}_pageviews.tsv{STATS_COMPRESSION}", f"{start_date_str}_{end_date_str}"))
+
+        # New snapshot is written locally with staging, then copied to STATS_DIR
+        staged_file_path = staged_path(new_file_path, size_of(prev_file_path))
+        if PAGEVIEWS_BACKEND == "sqlite":
+            if not merge_db(prj, prev_file_path, pw_files, staged_file_path, progress, report):
+                # New pageviews are in the db (recorded as applied), the latest
+                # snapshot is kept until an export
+                remove_pending(pending_files)
+                progress[prj] = "done"
+                return list(report.STAGES.values())
+        else:
+            merge_tsv(prj, prev_file_path, pw_files, staged_file_path, progress, report)
+
+        if staged_file_path != new_file_path:
+            progress[prj] = "writing back"
+            try:
+                with report.stage(f"write_back:{prj}"):
+                    copy_verified(staged_file_path, new_file_path)
+            except WikiStatsError:
+                # New pageviews are kept pending, the staged snapshot is not needed
+                os.remove(staged_file_path)
+                raise
+
+        progress[prj] = "rotating"
+        with report.stage(f"rotate:{prj}"):
+            rotate_snapshot("pageviews", prj, new_file_path)
+
+        # The new snapshot is the latest one now, nothing below fails the project
+        # (its pageviews must not be kept pending and added again)
+
+        # Pending pageviews are part of the new snapshot now
+        remove_pending(pending_files)
+
+        if PAGEVIEWS_BACKEND == "sqlite":
+            try:
+                with StatsDB(db_path_of(prj), report) as db:
+                    db.set_snapshot(new_file_path)
+            except Exception as e:
+                print(f"Warning: Database of {prj} not marked as matching {new_file_path}, it is imported again by the next run ({e})", flush=True)
+        if STATS_SHARDS:
+            progress[prj] = "sharding"
+            try:
+                with report.stage(f"shard:{prj}"):
+                    publish_shards(new_file_path, shards_dir_of(STATS_DIR, "pageviews", prj), STATS_SHARDS, STATS_COMPRESSION)
+            except Exception as e:
+                print(f"Warning: Shards of {prj} not published ({e})", flush=True)
+    finally:
+        prj_lock.release()
+
+    progress[prj] = "done"
+    return list(report.STAGES.values())
+
+def pending_range(prj:str, pw_file:str) -> str:
+    """
+    Returns the date range of a pending pageviews file ("{start}_{end}").
+    """
+    return os.path.basename(pw_file)[len(prj) + 1:].split("_pageviews")[0]
+
+def pending_pageviews(prj:str) -> list:
+    """
+    Returns pageview files of a project left by earlier runs whose merge failed.
+    """
+    if not os.path.isdir(PAGEVIEWS_PENDING_DIR):
+        return []
+    return sorted(
+        os.path.join(PAGEVIEWS_PENDING_DIR, file_name)
+        for file_name in os.listdir(PAGEVIEWS_PENDING_DIR)
+        if file_name.startswith(f"{prj}_")
+    )
+
+def remove_pending(pending_files:list) -> None:
+    """
+    Removes merged pending files (a failed removal is only reported).
+    """
+    for pw_file in pending_files:
+        try:
+            os.remove(pw_file)
+        except OSError as e:
+            print(f"Warning: Unable to remove merged pending file {pw_file} ({e})", flush=True)
+
+def keep_pending(prj:str) -> None:
+    """
+    Keeps the new pageviews of a failed project for the next run
+    (last_update moves on for all projects). Only for projects that failed
+    before their new snapshot was rotated in (merge_project).
+    """
+    os.makedirs(PAGEVIEWS_PENDING_DIR, exist_ok=True)
+    pending_path = os.path.join(
+        PAGEVIEWS_PENDING_DIR,
+        f"{prj}_{start_date_str}_{end_date_str}_pageviews.tsv{STATS_COMPRESSION}"
+    )
+    shutil.move(f"{TMP_DIR}/{prj}/{prj}_pageviews.tsv{STATS_COMPRESSION}", pending_path)
+    print(f"Pageviews of {prj} kept for the next run: {pending_path}")
+
+def print_progress(progress) -> None:
+    print("Progress: " + ", ".join(f"{prj} {phase}" for prj, phase in sorted(progress.items())), flush=True)
+
+# Per-project merge, write and rotation in parallel workers
+# (in-process with 1 worker), a failed project does not stop the others
+print("Loading previous data")
+projects = list(dumps_info.keys())
+failed = {}
+workers = max(1, min(PAGEVIEWS_MERGE_WORKERS, len(projects)))
+
+if workers == 1:
+    progress = {prj: "waiting" for prj in projects}
+    for prj in projects:
+        try:
+            for stage_metrics in merge_project(prj, progress):
+                REPORT.add(stage_metrics)
+        except Exception as e:
+            progress[prj] = "failed"
+            failed[prj] = str(e)
+        print_progress(progress)
+else:
+    manager = multiprocessing.Manager()
+    progress = manager.dict({prj: "waiting" for prj in projects})
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {executor.submit(merge_project, prj, progress): prj for prj in projects}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=MERGE_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                prj = futures[future]
+                try:
+                    for stage_metrics in future.result():
+                        REPORT.add(stage_metrics)
+                except Exception as e:
+                    progress[prj] = "failed"
+                    failed[prj] = str(e)
+            print_progress(progress)
+    progress = dict(progress)
+    manager.shutdown()
+
+for prj, error in failed.items():
+    sys.stderr.write(f"Error: Merge of {prj} failed: {error}\n")
+    try:
+        keep_pending(prj)
+    except OSError as e:
+        sys.stderr.write(f"Error: Unable to keep pageviews of {prj} ({e}), the date range has to be reprocessed\n")
+        delete_temp_dir(TMP_DIR)
+        exit(1)
+
 print("Finished. Updating date.")
 update_date(end_date+timedelta(days=1))
 print("Date updated.")
 
+report_prefix = os.path.join(STATS_DIR, "pageviews", "reports", datetime.now().strftime(FILE_DATE_FORMAT))
+save_report(
+    f"{report_prefix}_pageviews_report.json",
+    run="pageviews_stats",
+    date_range=[start_date_str, end_date_str],
+    skipped_files=pw.SKIPPED_FILES,
+    pipeline=pw.STAGE_STATS,
+    failed_projects=failed
+)
+profiling.save(f"{report_prefix}_pageviews_profile")
 delete_temp_dir(TMP_DIR)
+if failed:
+    print(f"Done, failed projects: {', '.join(failed)}")
+    exit(1)
 print("Done.")
 
@@ -0,0 +1,186 @@
+# Opt-in CPU profiling and allocation tracking of metrics stages
+#
+# enable() hooks into metrics.py: every stage (e.g. "backlinks:extract")
+# runs under its own cProfile profiler, tracemalloc records the peak and
+# the top allocation sites at the end of the stage. save() writes
+#   <out_dir>/<stage>.prof         -> pstats dump (pstats, snakeviz, ...)
+#   <out_dir>/<stage>.txt          -> top functions by cumulative time
+#   <out_dir>/allocations.txt      -> peak and top allocation sites per stage
+#
+# A sample limits the inputs of a profiling run:
+#   "500MB" -> only the first 500 MB of every input file are processed
+#   "6h"    -> only the first 6 hourly pageview files are processed
+# (outputs of a sampled run are partial)
+
+import tracemalloc
+import threading
+import cProfile
+import logging
+import pstats
+import metrics
+import re
+import os
+
+SAMPLE_REG = re.compile(r"^(\d+)\s*(MB|h)$", re.IGNORECASE)
+
+# Number of listed functions / allocation sites
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 20
+
+# Frames kept per allocation traceback
+TRACEMALLOC_FRAMES = 5
+
+# Input limits of a sampled run (None -> no limit)
+SAMPLE_BYTES = None
+SAMPLE_HOURS = None
+
+
+class StageProfiler():
+    # Per-stage profilers, called by metrics.Stage
+    def __init__(self):
+        self.PROFILES = {}
+        self.ALLOCATIONS = {}
+        self.__active = threading.local()
+        self.__lock = threading.Lock()
+
+    def start(self, name:str) -> None:
+        # Nested stages are part of the outer stage profile
+        if getattr(self.__active, "name", None):
+            return
+        self.__active.name = name
+        with self.__lock:
+            profile = self.PROFILES.setdefault(name, cProfile.Profile())
+        tracemalloc.reset_peak()
+        profile.enable()
+
+    def stop(self, name:str) -> None:
+        if getattr(self.__active, "name", None) != name:
+            return
+        self.PROFILES[name].disable()
+        self.__active.name = None
+
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+        with self.__lock:
+            prev = self.ALLOCATIONS.get(name)
+            if prev is None or peak >= prev["peak"]:
+                self.ALLOCATIONS[name] = {
+                    "peak": peak,
+                    "top": snapshot.statistics("traceback")[:TOP_ALLOCATIONS]
+                }
+
+    def save(self, out_dir:str) -> None:
+        os.makedirs(out_dir, exist_ok=True)
+        for name, profile in self.PROFILES.items():
+            file_name = name.replace(":", "_").replace("/", "_")
+            profile.dump_stats(os.path.join(out_dir, f"{file_name}.prof"))
+            with open(os.path.join(out_dir, f"{file_name}.txt"), "w") as file_out:
+                stats = pstats.Stats(profile, stream=file_out)
+                stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+        with open(os.path.join(out_dir, "allocations.txt"), "w") as file_out:
+            for name, allocations in self.ALLOCATIONS.items():
+                file_out.write(f"== {name} (traced peak {allocations['peak'] / 2**20:.1f} MB)\n")
+                for stat in allocations["top"]:
+                    file_out.write(f"{stat.size / 2**20:10.2f} MB {stat.count:10} blocks\n")
+                    for line in stat.traceback.format(limit=TRACEMALLOC_FRAMES):
+                        file_out.write(f"    {line}\n")
+                file_out.write("\n")
+        logging.info(f"Profiles saved: {out_dir}")
+
+
+def parse_sample(sample:str) -> tuple:
+    """
+    Parses a sample limit, returns (bytes, hours), one of them None.
+    Raises ValueError on an invalid limit.
+    """
+    match = SAMPLE_REG.match(sample.strip())
+    if not match:
+        raise ValueError(f"Invalid profile sample '{sample}', expected e.g. 500MB or 6h")
+    value = int(match.group(1))
+    if match.group(2).lower() == "mb":
+        return value * 2**20, None
+    return None, value
+
+def enable(sample:str=None) -> StageProfiler:
+    """
+    Starts profiling of all following stages.
+    """
+    global SAMPLE_BYTES, SAMPLE_HOURS
+    if sample:
+        SAMPLE_BYTES, SAMPLE_HOURS = parse_sample(sample)
+        logging.warning(f"WARNING: Profiling a sample ({sample}), outputs are partial")
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    metrics.PROFILER = StageProfiler()
+    return metrics.PROFILER
+
+def save(out_dir:str) -> None:
+    if metrics.PROFILER:
+        metrics.PROFILER.save(out_dir)
+
+def profile_dir(output_path:str) -> str:
+    """
+    Returns the profile dir next to an output file or in an output dir.
+    """
+    if os.path.isdir(output_path):
+        return os.path.join(output_path, "profile")
+    return output_path + ".profile"
+
+def sampled(file_in):
+    """
+    Returns the lines of a file, limited to the first SAMPLE_BYTES.
+    """
+    if SAMPLE_BYTES is None:
+        return file_in
+    return _sampled_lines(file_in, SAMPLE_BYTES)
+
+def _sampled_lines(file_in, limit:int):
+    for line in file_in:
+        if limit <= 0:
+            return
+        limit -= len(line)
+        yield line
+
+class SampledReader():
+    # File-like wrapper returning only the first `limit` characters of a file
+    # (for readers which call read() instead of iterating lines)
+    def __init__(self, file_in, limit:int):
+        self.FILE = file_in
+        self.REMAINING = limit
+
+    def read(self, size:int=-1) -> str:
+        if self.REMAINING <= 0:
+            return self.FILE.read(0)
+        if size < 0 or size > self.REMAINING:
+            size = self.REMAINING
+        data = self.FILE.read(size)
+        self.REMAINING -= len(data)
+        return data
+
+    def __iter__(self):
+        return _sampled_lines(self.FILE, self.REMAINING)
+
+def sampled_reader(file_in):
+    """
+    Returns a file limited to the first SAMPLE_BYTES (read() interface).
+    """
+    if SAMPLE_BYTES is None:
+        return file_in
+    return SampledReader(file_in, SAMPLE_BYTES)
+
+def sampled_hours(day_files:list) -> list:
+    """
+    Limits [(day, [hourly files])] to the first SAMPLE_HOURS files.
+    """
+    if SAMPLE_HOURS is None:
+        return day_files
+    sample = []
+    remaining = SAMPLE_HOURS
+    for day, files in day_files:
+        if remaining <= 0:
+            break
+        sample.append((day, files[:remaining]))
+        remaining -= len(files[:remaining])
+    return sample
@@ -0,0 +1,130 @@
+# Sampled quick estimates of PageViews (--sample)
+#
+# Only a deterministic subset of the hourly files of the range is fetched
+# and counted, picked by generators seeded with (seed, day), the same
+# hours on every run:
+#   every:K   -> every K-th hour of every day, from a random start hour of
+#                the day (0..K-1), a fixed stride over the whole range would
+#                hit the same hours of the day (e.g. only nights with K = 24)
+#   random:N  -> N random hours of every day
+# Every hour of the range is sampled with the same probability.
+#
+# Every sampled hour is counted separately, per title the sum S1 and the
+# sum of squares S2 of its hourly counts are kept. The sampled hours are
+# treated as a simple random sample of n out of the N hours of the range
+# (the intervals assume random sampling, for the day-stratified samples
+# above they are only approximate):
+#   estimate = N/n * S1
+#   variance = N^2 * (1 - n/N) * s^2 / n,   s^2 = (S2 - S1^2/n) / (n - 1)
+#   interval = estimate +- Z * sqrt(variance)  (lower bound at least S1)
+# Hours where a title has no views count as zeros.
+
+from collections import Counter
+import pandas as pd
+import numpy as np
+import pw_vectorized
+import random
+
+# Normal quantile of the confidence intervals (95 %)
+Z = 1.96
+
+SAMPLE_METHODS = ["every", "random"]
+
+
+class HourSample():
+    # Selection of sampled hours
+    def __init__(self, method:str, value:int, seed:int=0):
+        if method not in SAMPLE_METHODS:
+            raise ValueError(f"Unknown sample method '{method}', expected one of: {', '.join(SAMPLE_METHODS)}")
+        if method == "every" and value < 1:
+            raise ValueError("Sample step must be at least 1")
+        if method == "random" and not 1 <= value <= 24:
+            raise ValueError("Sampled hours per day must be between 1 and 24")
+        self.METHOD = method
+        self.VALUE = value
+        self.SEED = seed
+
+    # Parses "every:K" or "random:N"
+    # Raises ValueError on an invalid spec
+    @classmethod
+    def parse(cls, spec:str, seed:int=0) -> "HourSample":
+        method, _, value = spec.partition(":")
+        if not value.isdigit():
+            raise ValueError(f"Invalid sample '{spec}', expected every:K or random:N")
+        return cls(method, int(value), seed)
+
+    def __str__(self) -> str:
+        return f"{self.METHOD}:{self.VALUE}"
+
+    # Returns the sampled hourly file names (pageviews-YYYYMMDD-HH0000.gz)
+    # of the whole range, in the given order
+    def select(self, file_names:list) -> list:
+        days = {}
+        for name in file_names:
+            days.setdefault(name.split("-")[1], []).append(name)
+        selected = set()
+        for day, day_names in days.items():
+            picker = random.Random(f"{self.SEED}-{day}")
+            if self.METHOD == "every":
+                offset = picker.randrange(self.VALUE)
+                selected.update(name for name in day_names if int(name.split("-")[2][:2]) % self.VALUE == offset)
+            else:
+                selected.update(picker.sample(day_names, min(self.VALUE, len(day_names))))
+        return [name for name in file_names if name in selected]
+
+
+class SampleEstimator():
+    # Per-title sums of sampled hourly counts of every project
+    def __init__(self, projects:list):
+        self.HOURS = 0
+        self.SUMS = {prj: Counter() for prj in projects}
+        self.SQUARES = {prj: Counter() for prj in projects}
+        # Vectorized engine: Series parts, combined in estimates()
+        self.__parts = {prj: ([], []) for prj in projects}
+
+    # Adds the counts of one hour ({prj: Counter or Series(title -> count)})
+    def add_hour(self, data:dict) -> None:
+        self.HOURS += 1
+        for prj, counts in data.items():
+            if isinstance(counts, pd.Series):
+                sums, squares = self.__parts[prj]
+                pw_vectorized.add_part(sums, counts)
+                pw_vectorized.add_part(squares, counts * counts)
+                continue
+            for title, count in counts.items():
+                self.SUMS[prj][title] += count
+                self.SQUARES[prj][title] += count * count
+
+    # Returns (titles, S1, S2) of a project
+    def __sums(self, prj:str) -> tuple:
+        sums, squares = self.__parts[prj]
+        if sums:
+            s1 = pw_vectorized.combine(sums)
+            s2 = pw_vectorized.combine(squares).reindex(s1.index)
+            return s1.index.tolist(), s1.to_numpy(dtype=np.float64), s2.to_numpy(dtype=np.float64)
+        titles = list(self.SUMS[prj].keys())
+        s1 = np.fromiter(self.SUMS[prj].values(), dtype=np.float64, count=len(titles))
+        s2 = np.fromiter((self.SQUARES[prj][title] for title in titles), dtype=np.float64, count=len(titles))
+        return titles, s1, s2
+
+    # Returns [(title, estimate, lower, upper)] of a project, highest estimates first
+    # total_hours -> number of hours of the whole range (N)
+    # Bounds are None with fewer than 2 sampled hours
+    def estimates(self, prj:str, total_hours:int) -> list:
+        titles, s1, s2 = self.__sums(prj)
+        n = self.HOURS
+        if not titles or not n:
+            return []
+
+        estimate = total_hours / n * s1
+        if n > 1:
+            variance = (s2 - s1 * s1 / n) / (n - 1)
+            spread = Z * np.sqrt(np.maximum(variance, 0) * total_hours ** 2 * max(0.0, 1 - n / total_hours) / n)
+            lower = np.maximum(estimate - spread, s1).round().astype(np.int64).tolist()
+            upper = (estimate + spread).round().astype(np.int64).tolist()
+        else:
+            lower = upper = [None] * len(titles)
+
+        order = np.argsort(-s1, kind="stable")
+        estimate = estimate.round().astype(np.int64).tolist()
+        return [(titles[idx], estimate[idx], lower[idx], upper[idx]) for idx in order.tolist()]
@@ -0,0 +1,283 @@
+#! /bin/python3
+
+# Date-range sharding of PageViews across nodes
+#
+# All nodes share one dir (e.g. on NFS):
+#   shards.json       -> date range, projects, sources and the shard list
+#   locks/<id>.lock   -> claim of a shard by a worker (filelock.py)
+#   out/<id>/         -> finished shard, {prj}_pageviews.tsv
+#
+# init    -> (coordinator) splits the date range into shards
+# work    -> (any node) claims and processes shards until none is left,
+#            a shard of a dead worker is taken over after FILE_LOCK_TIMEOUT
+# reduce  -> merges the shard outputs into {prj}_{start}_{end}.tsv
+# local   -> init + N local worker processes + reduce (single node/testing)
+
+from datetime import datetime, timedelta
+from generate_pageviews import PageViews
+from errors import WikiStatsError, InputError, DataError
+from filelock import LockFile
+from stats_io import open_stats
+from collections import Counter
+from config import DATE_FORMAT
+import multiprocessing
+import argparse
+import tempfile
+import logging
+import shutil
+import socket
+import json
+import time
+import sys
+import os
+
+SPEC_FILE = "shards.json"
+SHARD_OUTPUT_FILE = "pageviews.tsv"
+
+# Default shard length in days
+SHARD_DAYS = 7
+
+# Seconds between claim attempts when all pending shards are claimed
+CLAIM_INTERVAL = 30
+
+
+def split_range(start_date:str, end_date:str, shard_days:int) -> list:
+    """
+    Splits a date range into [{"id", "start", "end"}, ...] of shard_days days.
+    """
+    start = datetime.strptime(start_date, DATE_FORMAT)
+    end = datetime.strptime(end_date, DATE_FORMAT)
+    shards = []
+    while start <= end:
+        shard_end = min(start + timedelta(days=shard_days - 1), end)
+        shards.append({
+            "id": str(len(shards)).zfill(5),
+            "start": start.strftime(DATE_FORMAT),
+            "end": shard_end.strftime(DATE_FORMAT)
+        })
+        start = shard_end + timedelta(days=1)
+    return shards
+
+def load_spec(shared_dir:str) -> dict:
+    spec_path = os.path.join(shared_dir, SPEC_FILE)
+    if not os.path.exists(spec_path):
+        raise InputError(f"No shards in {shared_dir} (run init first)")
+    with open(spec_path) as spec_in:
+        return json.load(spec_in)
+
+def shard_dir(shared_dir:str, shard:dict) -> str:
+    return os.path.join(shared_dir, "out", shard["id"])
+
+def is_done(shared_dir:str, shard:dict) -> bool:
+    return os.path.isdir(shard_dir(shared_dir, shard))
+
+# Coordinator: writes the shard list into the shared dir
+def init_shards(shared_dir:str, start_date:str, end_date:str, projects:list, sources:list, shard_days:int=SHARD_DAYS) -> dict:
+    spec_path = os.path.join(shared_dir, SPEC_FILE)
+    if os.path.exists(spec_path):
+        raise InputError(f"Shards already initialized: {spec_path}")
+
+    spec = {
+        "start": start_date,
+        "end": end_date,
+        "projects": projects,
+        "sources": sources,
+        "shards": split_range(start_date, end_date, shard_days)
+    }
+    os.makedirs(os.path.join(shared_dir, "locks"), exist_ok=True)
+    os.makedirs(os.path.join(shared_dir, "out"), exist_ok=True)
+    with open(spec_path + ".tmp", "w") as spec_out:
+        json.dump(spec, spec_out, indent=2)
+    os.replace(spec_path + ".tmp", spec_path)
+    logging.info(f"{len(spec['shards'])} shards: {start_date} - {end_date}")
+    return spec
+
+# Runs PageViews on one shard
+# Output goes to a private dir renamed into place when complete
+# (the rename fails if another worker finished the shard first)
+def process_shard(shared_dir:str, spec:dict, shard:dict, tmp_dir:str) -> bool:
+    owner = f"{socket.gethostname()}_{os.getpid()}"
+    partial_dir = f"{shard_dir(shared_dir, shard)}.{owner}.partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+
+    started = time.time()
+    pw = PageViews(
+        shard["start"],
+        shard["end"],
+        tmp_dir=os.path.join(tmp_dir, "pwtmp"),
+        output_dir=partial_dir,
+        output_file=SHARD_OUTPUT_FILE,
+        projects=spec["projects"],
+        manifest_dir=os.path.join(tmp_dir, "manifest"),
+        sources=spec["sources"]
+    )
+    pw.get_pageviews()
+
+    with open(os.path.join(partial_dir, "shard.json"), "w") as info_out:
+        json.dump({**shard, "worker": owner, "seconds": round(time.time() - started, 1)}, info_out)
+    try:
+        os.rename(partial_dir, shard_dir(shared_dir, shard))
+    except OSError:
+        logging.warning(f"WARNING: Shard {shard['id']} finished by another worker, discarding")
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        return False
+    return True
+
+# Worker: claims pending shards until all are done
+# Returns the number of shards processed by this worker
+def run_worker(shared_dir:str, tmp_dir:str=None, wait:bool=True) -> int:
+    spec = load_spec(shared_dir)
+    own_tmp = tmp_dir is None
+    if own_tmp:
+        tmp_dir = tempfile.mkdtemp(prefix="pwshard_")
+
+    processed = 0
+    # Shards failed in this worker are left to the others
+    failed = set()
+    try:
+        while True:
+            pending = [
+                shard for shard in spec["shards"]
+                if shard["id"] not in failed and not is_done(shared_dir, shard)
+            ]
+            if not pending:
+                break
+
+            claimed = False
+            for shard in pending:
+                lock = LockFile(os.path.join(shared_dir, "locks", f"{shard['id']}.lock"))
+                if not lock.try_acquire():
+                    continue
+                claimed = True
+                try:
+                    # Finished between listing and claiming
+                    if is_done(shared_dir, shard):
+                        continue
+                    logging.info(f"Shard {shard['id']}: {shard['start']} - {shard['end']}")
+                    if process_shard(shared_dir, spec, shard, tmp_dir):
+                        processed += 1
+                except WikiStatsError as e:
+                    logging.error(f"ERROR: Shard {shard['id']} failed: {e}")
+                    failed.add(shard["id"])
+                finally:
+                    lock.release()
+
+            if not claimed:
+                if not wait:
+                    break
+                time.sleep(CLAIM_INTERVAL)
+    finally:
+        if own_tmp:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return processed
+
+# Reducer: sums the shard outputs per project
+# Raises DataError if some shard is not finished
+def reduce_shards(shared_dir:str, output_dir:str, output_file:str="") -> list:
+    spec = load_spec(shared_dir)
+    pending = [shard["id"] for shard in spec["shards"] if not is_done(shared_dir, shard)]
+    if pending:
+        raise DataError(f"{len(pending)} shards not finished: {', '.join(pending[:10])}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    out_paths = []
+    for prj in spec["projects"]:
+        data_out = Counter()
+        for shard in spec["shards"]:
+            in_path = os.path.join(shard_dir(shared_dir, shard), f"{prj}_{SHARD_OUTPUT_FILE}")
+            logging.info(f"Processing file: {in_path}")
+            with open_stats(in_path) as file_in:
+                for line in file_in:
+                    line_data = line.rstrip("\n").split("\t")
+                    if len(line_data) < 2:
+                        continue
+                    try:
+                        data_out[line_data[0]] += int(line_data[-1])
+                    except ValueError:
+                        raise DataError(f"Value not number: {line.strip()}")
+
+        logging.info(f"Saving project {prj}...")
+        out_file_name = f"{prj}_{spec['start']}_{spec['end']}.tsv"
+        if output_file:
+            out_file_name = f"{prj}_{output_file}"
+        out_paths.append(os.path.join(output_dir, out_file_name))
+        with open_stats(out_paths[-1], "w") as file_out:
+            for key, value in data_out.items():
+                file_out.write(f"{key}\t{value}\n")
+    return out_paths
+
+def local_worker(shared_dir:str) -> None:
+    logging.basicConfig(level=logging.INFO, format=f"[{os.getpid()}] %(message)s", force=True)
+    try:
+        run_worker(shared_dir)
+    except WikiStatsError as e:
+        logging.error(f"ERROR: {e}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="Split a date range into shards (coordinator)")
+    work_parser = subparsers.add_parser("work", help="Claim and process shards (worker)")
+    reduce_parser = subparsers.add_parser("reduce", help="Merge the finished shards (reducer)")
+    local_parser = subparsers.add_parser("local", help="init, N local workers and reduce")
+
+    for sub in (init_parser, work_parser, reduce_parser, local_parser):
+        sub.add_argument(
+            "--shared",
+            type=str,
+            required=True,
+            dest="shared_dir",
+            help="Dir shared by all nodes"
+        )
+
+    for sub in (init_parser, local_parser):
+        sub.add_argument("-s", "--start", type=str, required=True, dest="start_date", help="Start date (YYYY-MM-DD)")
+        sub.add_argument("-e", "--end", type=str, required=True, dest="end_date", help="End date (YYYY-MM-DD)")
+        sub.add_argument("--shard-days", type=int, default=SHARD_DAYS, dest="shard_days", help="Days per shard")
+        sub.add_argument("--projects", nargs="+", default=PageViews.PROJECTS, dest="prj_list", help="List of projects")
+        sub.add_argument(
+            "--source",
+            nargs="+",
+            default=PageViews.SOURCES,
+            dest="sources",
+            help="Dump sources tried in order, must be reachable from all nodes"
+        )
+
+    for sub in (reduce_parser, local_parser):
+        sub.add_argument("-o", "--output", type=str, required=True, dest="out_dir", help="Output dir")
+        sub.add_argument("-f", "--file", type=str, default="", dest="out_file", help="Output file name suffix ({prj}_FILE)")
+
+    work_parser.add_argument("--tmp", type=str, dest="tmp_dir", help="Local temp dir (default: new temp dir)")
+    work_parser.add_argument("--no-wait", action="store_true", dest="no_wait", help="Exit when all pending shards are claimed")
+    local_parser.add_argument("-w", "--workers", type=int, default=2, dest="workers", help="Number of local worker processes")
+    args = parser.parse_args()
+
+    try:
+        if args.command in ("init", "local"):
+            init_shards(args.shared_dir, args.start_date, args.end_date, args.prj_list, args.sources, args.shard_days)
+
+        if args.command == "work":
+            processed = run_worker(args.shared_dir, args.tmp_dir, wait=not args.no_wait)
+            logging.info(f"Processed {processed} shards")
+
+        if args.command == "local":
+            workers = [
+                multiprocessing.Process(target=local_worker, args=(args.shared_dir,))
+                for _ in range(args.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        if args.command in ("reduce", "local"):
+            for out_path in reduce_shards(args.shared_dir, args.out_dir, args.out_file):
+                logging.info(f"Saved: {out_path}")
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
@@ -0,0 +1,199 @@
+#! /bin/python3
+
+# Transitive redirect table of a pages-articles dump
+#
+# Every redirect title is resolved to its final target (A -> B -> C gives
+# A -> C and B -> C). Redirects ending in a cycle (A -> B -> A) are left
+# out, their titles keep their own counts. The table is stored as TSV
+# with a head block (stats_io.read_head) describing the dump it was built
+# from, then "redirect title \t final target" rows (titles with "_").
+#
+# Backlinks and PageViews resolve every title while counting, so counts of
+# redirects end up at their targets without a pass over the dump.
+#
+#   redirects.py build -i enwiki-...-pages-articles.xml -o en_redirects.tsv
+#   redirects.py resolve -t en_redirects.tsv "Redirect_title"
+
+from errors import WikiStatsError, InputError, DataError
+from stats_io import open_stats, read_head
+from page_index import PageIndex
+from metrics import stage
+import argparse
+import logging
+import html
+import sys
+import os
+
+
+def resolve_chains(pairs:dict) -> tuple:
+    """
+    Resolves {redirect: target} to {redirect: final target}.
+    Returns (resolved table, number of redirects left out due to cycles).
+    """
+    resolved = {}
+    # Titles whose chain ends in a cycle
+    cyclic = set()
+
+    for source in pairs:
+        if source in resolved or source in cyclic:
+            continue
+
+        chain = []
+        on_chain = set()
+        node = source
+        while node in pairs and node not in resolved and node not in cyclic:
+            if node in on_chain:
+                break
+            chain.append(node)
+            on_chain.add(node)
+            node = pairs[node]
+
+        if node in on_chain or node in cyclic:
+            cyclic.update(chain)
+            continue
+
+        final = resolved.get(node, node)
+        for title in chain:
+            resolved[title] = final
+    return resolved, len(cyclic)
+
+
+class RedirectTable():
+    # {redirect title: final target}, loaded into one dict
+    # (targets are interned, many redirects share one target string)
+    def __init__(self, table:dict=None, head:dict=None):
+        self.TABLE = table or {}
+        self.HEAD = head or {}
+
+    def __len__(self) -> int:
+        return len(self.TABLE)
+
+    def __contains__(self, title:str) -> bool:
+        return title in self.TABLE
+
+    # Returns the final target of a title (the title itself if not a redirect)
+    def resolve(self, title:str) -> str:
+        return self.TABLE.get(title, title)
+
+    # Builds the table from a dump (from its page index if current)
+    @classmethod
+    def build(cls, dump_path:str, page_index:PageIndex=None) -> "RedirectTable":
+        if not os.path.exists(dump_path):
+            raise InputError(f"Dump not found: {dump_path}")
+
+        with stage("redirects:build") as metrics:
+            if page_index and page_index.is_current():
+                redirects = page_index.iter_redirects()
+            else:
+                redirects = (
+                    (entry.title, entry.redirect)
+                    for entry in PageIndex(dump_path).scan() if entry.redirect
+                )
+
+            pairs = {}
+            for title, target in redirects:
+                if title:
+                    pairs[title.replace(" ", "_")] = target.replace(" ", "_")
+            table, cycles = resolve_chains(pairs)
+            metrics.RECORDS += len(table)
+
+        if cycles:
+            logging.warning(f"WARNING: {cycles} redirects left out (cycles)")
+        dump_stat = os.stat(dump_path)
+        head = {
+            "dump": os.path.basename(dump_path),
+            "size": str(dump_stat.st_size),
+            "mtime_ns": str(dump_stat.st_mtime_ns),
+            "redirects": str(len(table)),
+            "cycles": str(cycles)
+        }
+        return cls(table, head)
+
+    # Saves the table (atomically)
+    def save(self, path:str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}{os.path.splitext(path)[1]}"
+        with open_stats(tmp_path, "w") as file_out:
+            for key, value in self.HEAD.items():
+                file_out.write(f"{key}\t{value}\n")
+            file_out.write("\n")
+            for title, target in self.TABLE.items():
+                file_out.write(f"{title}\t{target}\n")
+        os.replace(tmp_path, path)
+
+    # Loads a saved table
+    # unescape -> XML entities in titles are decoded (for pageview titles)
+    # Raises InputError on a missing table, DataError on a corrupt one
+    @classmethod
+    def load(cls, path:str, unescape:bool=False) -> "RedirectTable":
+        if not os.path.exists(path):
+            raise InputError(f"Redirect table not found: {path}")
+        table = {}
+        targets = {}
+        with open_stats(path) as file_in:
+            head = {}
+            for line in read_head(file_in).splitlines():
+                key, _, value = line.partition("\t")
+                head[key] = value
+            for line in file_in:
+                title, sep, target = line.rstrip("\n").partition("\t")
+                if not sep:
+                    raise DataError(f"Corrupt redirect table line: {line.strip()}")
+                if unescape and "&" in line:
+                    title, target = html.unescape(title), html.unescape(target)
+                table[title] = targets.setdefault(target, target)
+        return cls(table, head)
+
+    # True if the table was built from the current version of a dump
+    def is_current(self, dump_path:str) -> bool:
+        if not os.path.exists(dump_path):
+            return False
+        dump_stat = os.stat(dump_path)
+        return (
+            self.HEAD.get("dump") == os.path.basename(dump_path) and
+            self.HEAD.get("size") == str(dump_stat.st_size) and
+            self.HEAD.get("mtime_ns") == str(dump_stat.st_mtime_ns)
+        )
+
+def ensure_redirect_table(dump_path:str, table_path:str, page_index:PageIndex=None) -> str:
+    """
+    Builds and saves the redirect table of a dump unless a current one exists.
+    Returns table_path.
+    """
+    if os.path.exists(table_path) and RedirectTable.load(table_path).is_current(dump_path):
+        return table_path
+    logging.info(f"Building redirect table: {table_path}")
+    RedirectTable.build(dump_path, page_index).save(table_path)
+    return table_path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the redirect table of a dump")
+    resolve_parser = subparsers.add_parser("resolve", help="Print final targets of titles")
+
+    build_parser.add_argument("-i", "--input", type=str, required=True, dest="dump_path", help="pages-articles dump")
+    build_parser.add_argument("-o", "--output", type=str, required=True, dest="table_path", help="Output table")
+    build_parser.add_argument("--index", type=str, dest="index_path", help="Page index of the dump (page_index.py)")
+    resolve_parser.add_argument("-t", "--table", type=str, required=True, dest="table_path", help="Redirect table")
+    resolve_parser.add_argument("titles", nargs="+", help="Titles (with \"_\")")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "build":
+            page_index = PageIndex(args.dump_path, args.index_path) if args.index_path else None
+            table = RedirectTable.build(args.dump_path, page_index)
+            table.save(args.table_path)
+            logging.info(f"Saved {len(table)} redirects: {args.table_path}")
+
+        if args.command == "resolve":
+            table = RedirectTable.load(args.table_path)
+            for title in args.titles:
+                print(f"{title}\t{table.resolve(title)}")
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
@@ -0,0 +1,265 @@
+#! /bin/python3
+
+# Orchestrator for the whole stats refresh
+#
+# Stages (pageviews_stats.py, backlinks_primary_stats.py, primary tags,
+# merge_stats.py, stats_to_kb.py) form a dependency graph. Independent
+# stages run in parallel. Every stage has a fingerprint of its inputs
+# (dump names/mtimes, last_update, outputs of upstream stages); a stage
+# is skipped when the fingerprint and its own outputs are unchanged
+# since its last successful run.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from os.path import realpath
+from errors import WikiStatsError
+from dumps import latest_dump
+import subprocess
+import threading
+import argparse
+import hashlib
+import json
+import sys
+import os
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from config import *
+
+
+class Stage():
+    # One node of the refresh graph
+    def __init__(self, name:str, command:list, inputs:list=(), outputs:list=(), deps:list=()):
+        self.NAME = name
+        self.COMMAND = command
+        self.INPUTS = list(inputs)
+        self.OUTPUTS = list(outputs)
+        self.DEPS = list(deps)
+
+    def fingerprint(self) -> str:
+        data = {
+            "command": self.COMMAND,
+            "inputs": [file_state(path) for path in self.INPUTS]
+        }
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def output_states(self) -> list:
+        return [file_state(path) for path in self.OUTPUTS]
+
+
+def file_state(path:str):
+    """
+    Returns [resolved path, size, mtime] of a file, None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [realpath(path), stat.st_size, stat.st_mtime_ns]
+
+def latest_stats_path(family:str, prj:str) -> str:
+    return os.path.join(STATS_DIR, f"{family}/latest_{prj}_{family}.tsv")
+
+def build_stages(projects:list) -> dict:
+    """
+    Returns the refresh graph {name: Stage}.
+    """
+    python = sys.executable
+    dumps = {prj: latest_dump(prj) for prj in projects}
+    dump_paths = [path for path in dumps.values() if path]
+
+    stages = [
+        Stage(
+            "pageviews",
+            [python, "pageviews_stats.py"],
+            inputs=dump_paths + [DATA_FILE],
+            outputs=[latest_stats_path("pageviews", prj) for prj in projects]
+        ),
+        Stage(
+            "bps",
+            [python, "backlinks_primary_stats.py"],
+            inputs=dump_paths,
+            outputs=[latest_stats_path("bps", prj) for prj in projects]
+        )
+    ]
+
+    for prj in projects:
+        if not dumps[prj]:
+            continue
+        ptags_path = os.path.join(REFRESH_DIR, f"{prj}_ptags.tsv{STATS_COMPRESSION}")
+        ptags_tmp_path = os.path.join(REFRESH_DIR, f"{prj}_ptags.tmp.tsv{STATS_COMPRESSION}")
+        merged_path = os.path.join(REFRESH_DIR, f"{prj}_merged.tsv{STATS_COMPRESSION}")
+        pw_path = latest_stats_path("pageviews", prj)
+        bps_path = latest_stats_path("bps", prj)
+
+        # Generated into a temp name, generate_primary_tags.py refuses to overwrite
+        stages.append(Stage(
+            f"ptags:{prj}",
+            ["/bin/sh", "-c", (
+                f"rm -f '{ptags_tmp_path}' && "
+                f"'{python}' generate_primary_tags.py -i '{dumps[prj]}' -o '{ptags_tmp_path}' && "
+                f"mv '{ptags_tmp_path}' '{ptags_path}'"
+            )],
+            inputs=[dumps[prj]],
+            outputs=[ptags_path]
+        ))
+        stages.append(Stage(
+            f"merge:{prj}",
+            [python, "merge_stats.py", "-bl", bps_path, "-pw", pw_path, "-pr", ptags_path, "-o", merged_path],
+            inputs=[bps_path, pw_path, ptags_path],
+            outputs=[merged_path],
+            deps=["pageviews", "bps", f"ptags:{prj}"]
+        ))
+
+        if prj in KB_FILES:
+            kb_out_path = os.path.join(REFRESH_DIR, f"{prj}_kb+stats.tsv")
+            stages.append(Stage(
+                f"kb:{prj}",
+                [python, "stats_to_kb.py", "-i", KB_FILES[prj], "-pw", pw_path, "-bps", bps_path,
+                 "-o", kb_out_path, "--workers", str(os.cpu_count())],
+                inputs=[KB_FILES[prj], pw_path, bps_path],
+                outputs=[kb_out_path],
+                deps=["pageviews", "bps"]
+            ))
+    return {stage.NAME: stage for stage in stages}
+
+
+class Refresh():
+    # Runs the graph, keeps the state of successful stages in REFRESH_STATE_FILE
+    def __init__(self, stages:dict, workers:int=2, force:list=(), dry_run:bool=False):
+        self.STAGES = stages
+        self.WORKERS = workers
+        self.FORCE = set(force)
+        self.DRY_RUN = dry_run
+        self.STATE = self.__load_state()
+        self.RESULTS = {}
+        self.__state_lock = threading.Lock()
+
+    def __load_state(self) -> dict:
+        if not os.path.exists(REFRESH_STATE_FILE):
+            return {}
+        with open(REFRESH_STATE_FILE) as state_in:
+            return json.load(state_in)
+
+    def __save_state(self) -> None:
+        tmp_path = REFRESH_STATE_FILE + ".tmp"
+        with open(tmp_path, "w") as state_out:
+            json.dump(self.STATE, state_out, indent=2)
+        os.replace(tmp_path, REFRESH_STATE_FILE)
+
+    # Stage can be skipped if inputs and outputs are as after its last run
+    def __is_unchanged(self, stage:Stage) -> bool:
+        if stage.NAME in self.FORCE or "all" in self.FORCE:
+            return False
+        prev = self.STATE.get(stage.NAME)
+        return (
+            prev is not None
+            and prev["fingerprint"] == stage.fingerprint()
+            and prev["outputs"] == stage.output_states()
+        )
+
+    def __run_stage(self, stage:Stage) -> bool:
+        print(f"Running {stage.NAME}")
+        log_path = os.path.join(REFRESH_DIR, "logs", f"{stage.NAME.replace(':', '_')}.log")
+        with open(log_path, "w") as log_out:
+            prcs = subprocess.run(stage.COMMAND, stdout=log_out, stderr=subprocess.STDOUT)
+        if prcs.returncode != 0:
+            sys.stderr.write(f"Error: stage {stage.NAME} failed (see {log_path})\n")
+            return False
+
+        # Fingerprint taken after the run (stages may update their inputs, e.g. last_update)
+        with self.__state_lock:
+            self.STATE[stage.NAME] = {
+                "fingerprint": stage.fingerprint(),
+                "outputs": stage.output_states(),
+                "finished": datetime.now().strftime(FILE_DATE_FORMAT)
+            }
+            self.__save_state()
+        print(f"Finished {stage.NAME}")
+        return True
+
+    # Returns {stage name: done|skipped|failed|blocked|would run}
+    def run(self) -> dict:
+        os.makedirs(os.path.join(REFRESH_DIR, "logs"), exist_ok=True)
+        pending = dict(self.STAGES)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    dep_results = [self.RESULTS.get(dep) for dep in stage.DEPS]
+                    if any(result in ("failed", "blocked") for result in dep_results):
+                        print(f"Blocked {name} (upstream stage failed)")
+                        self.RESULTS[name] = "blocked"
+                    elif any(result is None for result in dep_results):
+                        if all(dep in self.STAGES for dep in stage.DEPS):
+                            continue
+                        print(f"Blocked {name} (unknown upstream stage)")
+                        self.RESULTS[name] = "blocked"
+                    elif "would run" not in dep_results and self.__is_unchanged(stage):
+                        print(f"Skipping {name} (unchanged)")
+                        self.RESULTS[name] = "skipped"
+                    elif self.DRY_RUN:
+                        print(f"Would run {name}")
+                        self.RESULTS[name] = "would run"
+                    else:
+                        running[executor.submit(self.__run_stage, stage)] = name
+                    del pending[name]
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.RESULTS[name] = "done" if future.result() else "failed"
+        return self.RESULTS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=2,
+        dest="jobs",
+        help="Number of stages run in parallel"
+    )
+
+    parser.add_argument(
+        "--projects",
+        nargs="+",
+        default=list(PROJECTS.keys()),
+        dest="prj_list",
+        help="List of projects"
+    )
+
+    parser.add_argument(
+        "--force",
+        nargs="+",
+        default=[],
+        dest="force",
+        help="Stages to run even if unchanged ('all' for every stage)"
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        dest="dry_run",
+        help="Only print which stages would run"
+    )
+    args = parser.parse_args()
+
+    try:
+        stages = build_stages(args.prj_list)
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
+
+    results = Refresh(stages, args.jobs, args.force, args.dry_run).run()
+
+    print("Summary:")
+    for name, result in results.items():
+        print(f"  {name}: {result}")
+
+    if any(result in ("failed", "blocked") for result in results.values()):
+        exit(1)
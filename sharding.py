@@ -0,0 +1,267 @@
+#! /bin/python3
+
+# Hash-sharded layout of stats files
+#
+# A sharded stats file is a dir:
+#   manifest.json      -> number of shards, hash, head flag, records per shard
+#   part-00000.tsv     -> rows whose title hashes to shard 0 (crc32(title) % N)
+#   ...
+# Every part repeats the head block of the source (if it has one), so a part
+# is a valid stats file on its own. The same title always lands in the same
+# shard number, shard i of two files with the same N can be joined alone.
+#
+#   sharding.py split -i latest_en_pageviews.tsv -o en_pageviews.shards -n 16 --head
+#   sharding.py join -i en_pageviews.shards -o en_pageviews.tsv
+
+from concurrent.futures import ThreadPoolExecutor
+from errors import WikiStatsError, InputError, DataError
+from stats_io import open_stats, read_head
+import argparse
+import logging
+import shutil
+import json
+import zlib
+import sys
+import os
+
+MANIFEST_FILE = "manifest.json"
+HASH_NAME = "crc32"
+
+# Parts written at the same time (compression runs outside the GIL)
+WRITE_THREADS = 4
+
+# Rows buffered by ShardWriter before they are written out
+FLUSH_ROWS = 100000
+
+
+def shard_of(title:str, shards:int) -> int:
+    """
+    Returns the shard number of a title (stable across runs and hosts).
+    """
+    return zlib.crc32(title.encode()) % shards
+
+def part_name(idx:int, compression:str="") -> str:
+    return f"part-{idx:05d}.tsv{compression}"
+
+def shards_dir_of(stats_dir:str, family:str, prj:str) -> str:
+    """
+    Returns the dir of the sharded latest snapshot of a project.
+    """
+    return os.path.join(stats_dir, family, "shards", f"latest_{prj}_{family}")
+
+def is_sharded(path:str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+def read_manifest(path:str) -> dict:
+    """
+    Returns the manifest of a sharded stats dir.
+    Raises InputError if the path is not sharded.
+    """
+    if not is_sharded(path):
+        raise InputError(f"Not a sharded stats dir: {path}")
+    with open(os.path.join(path, MANIFEST_FILE)) as manifest_in:
+        manifest = json.load(manifest_in)
+    if manifest.get("hash") != HASH_NAME:
+        raise DataError(f"Unknown shard hash '{manifest.get('hash')}' in {path}")
+    return manifest
+
+def shard_paths(path:str) -> list:
+    """
+    Returns the part files of a sharded dir, [path] for a plain file.
+    """
+    if not is_sharded(path):
+        return [path]
+    manifest = read_manifest(path)
+    return [os.path.join(path, part["name"]) for part in manifest["parts"]]
+
+def shards_num(path:str) -> int:
+    """
+    Returns the number of shards, 0 for a plain file.
+    """
+    return read_manifest(path)["shards"] if is_sharded(path) else 0
+
+
+class ShardWriter():
+    # Writes rows into N parts of a new sharded dir
+    # (written to a temp dir, moved into place by close())
+    # Rows are buffered per part and written out once FLUSH_ROWS rows are
+    # buffered in total, the memory use does not grow with the input.
+    def __init__(self, out_dir:str, shards:int, head:str="", compression:str=""):
+        if shards < 1:
+            raise InputError("Number of shards must be at least 1")
+        self.OUT_DIR = out_dir.rstrip("/")
+        self.SHARDS = shards
+        self.HEAD = head
+        self.COMPRESSION = compression
+        self.RECORDS = [0] * shards
+        self.__tmp_dir = tmp_dir_of(self.OUT_DIR)
+        self.__buffers = [[] for _ in range(shards)]
+        self.__buffered = 0
+
+        shutil.rmtree(self.__tmp_dir, ignore_errors=True)
+        os.makedirs(self.__tmp_dir)
+        self.__parts = [
+            open_stats(os.path.join(self.__tmp_dir, part_name(idx, compression)), "w")
+            for idx in range(shards)
+        ]
+        if head:
+            for part_out in self.__parts:
+                part_out.write(head)
+                part_out.write("\n")
+        self.__executor = ThreadPoolExecutor(max_workers=min(WRITE_THREADS, shards))
+
+    # Adds one row ("title\t...\n"), title is the first column
+    def write(self, title:str, line:str) -> None:
+        idx = shard_of(title, self.SHARDS)
+        self.__buffers[idx].append(line)
+        self.RECORDS[idx] += 1
+        self.__buffered += 1
+        if self.__buffered >= FLUSH_ROWS:
+            self.__flush()
+
+    # Appends the buffer of one part to its file
+    def __write_part(self, idx:int) -> None:
+        self.__parts[idx].writelines(self.__buffers[idx])
+        self.__buffers[idx] = []
+
+    # Writes out all buffers (parts in parallel)
+    def __flush(self) -> None:
+        list(self.__executor.map(self.__write_part, range(self.SHARDS)))
+        self.__buffered = 0
+
+    # Writes the rest of the rows and the manifest, replaces out_dir
+    def close(self) -> dict:
+        try:
+            self.__flush()
+        finally:
+            self.__executor.shutdown()
+            for part_out in self.__parts:
+                part_out.close()
+        parts = [
+            {"name": part_name(idx, self.COMPRESSION), "records": self.RECORDS[idx]}
+            for idx in range(self.SHARDS)
+        ]
+        return finish_shards(self.__tmp_dir, self.OUT_DIR, parts, bool(self.HEAD))
+
+def tmp_dir_of(out_dir:str) -> str:
+    return f"{out_dir.rstrip('/')}.tmp{os.getpid()}"
+
+def finish_shards(tmp_dir:str, out_dir:str, parts:list, head:bool) -> dict:
+    """
+    Writes the manifest of parts written into tmp_dir
+    ([{"name": .., "records": ..}] in shard order) and moves tmp_dir to out_dir.
+    """
+    manifest = {
+        "shards": len(parts),
+        "hash": HASH_NAME,
+        "head": head,
+        "records": sum(part["records"] for part in parts),
+        "parts": parts
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as manifest_out:
+        json.dump(manifest, manifest_out, indent=2)
+
+    # Swap in the new dir (readers see the old or the new one)
+    out_dir = out_dir.rstrip("/")
+    old_dir = f"{out_dir}.old{os.getpid()}"
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+def split_stats(in_path:str, out_dir:str, shards:int, head:bool=False, compression:str="") -> dict:
+    """
+    Splits a stats file (or re-splits a sharded dir) into a sharded dir,
+    returns the manifest.
+    head -> the file starts with a head block (copied into every part),
+            taken from the manifest for a sharded dir
+    """
+    head_text = ""
+    if is_sharded(in_path):
+        head = read_manifest(in_path)["head"]
+        if head:
+            with open_stats(shard_paths(in_path)[0]) as first_in:
+                head_text = read_head(first_in)
+    elif head:
+        with open_stats(in_path) as file_in:
+            head_text = read_head(file_in)
+
+    writer = ShardWriter(out_dir, shards, head_text, compression)
+    for line in iter_lines(in_path, head):
+        title = line.split("\t", 1)[0].strip()
+        if title:
+            writer.write(title, line)
+    return writer.close()
+
+def iter_lines(path:str, head:bool=False):
+    """
+    Yields the data lines of a plain or sharded stats file
+    (head blocks are skipped if head is set or the manifest says so).
+    """
+    skip_head = head or (is_sharded(path) and read_manifest(path)["head"])
+    for part_path in shard_paths(path):
+        with open_stats(part_path) as file_in:
+            if skip_head:
+                read_head(file_in)
+            yield from file_in
+
+def join_stats(in_dir:str, out_path:str) -> int:
+    """
+    Joins the parts of a sharded dir into one stats file, returns the number of rows.
+    """
+    manifest = read_manifest(in_dir)
+    rows_num = 0
+    with open_stats(out_path, "w") as file_out:
+        if manifest["head"]:
+            with open_stats(shard_paths(in_dir)[0]) as first_in:
+                file_out.write(read_head(first_in))
+            file_out.write("\n")
+        for line in iter_lines(in_dir):
+            file_out.write(line)
+            rows_num += 1
+    return rows_num
+
+def publish_shards(in_path:str, out_dir:str, shards:int, compression:str="") -> dict:
+    """
+    Writes a sharded copy of a stats snapshot (with head) for parallel consumers.
+    """
+    logging.info(f"Sharding {os.path.basename(in_path)} into {shards} parts: {out_dir}")
+    return split_stats(in_path, out_dir, shards, head=True, compression=compression)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = subparsers.add_parser("split", help="Split a stats file into shards")
+    join_parser = subparsers.add_parser("join", help="Join shards into one stats file")
+    info_parser = subparsers.add_parser("info", help="Print the manifest of a sharded dir")
+
+    split_parser.add_argument("-i", "--input", type=str, required=True, dest="in_path", help="Stats file")
+    split_parser.add_argument("-o", "--output", type=str, required=True, dest="out_dir", help="Output dir")
+    split_parser.add_argument("-n", "--shards", type=int, required=True, dest="shards", help="Number of shards")
+    split_parser.add_argument("--head", action="store_true", dest="head", help="Input starts with a head block")
+    split_parser.add_argument("--compress", choices=["gz", "zst"], dest="compress", help="Compress the parts")
+    join_parser.add_argument("-i", "--input", type=str, required=True, dest="in_dir", help="Sharded dir")
+    join_parser.add_argument("-o", "--output", type=str, required=True, dest="out_path", help="Output file")
+    info_parser.add_argument("-i", "--input", type=str, required=True, dest="in_dir", help="Sharded dir")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "split":
+            compression = f".{args.compress}" if args.compress else ""
+            manifest = split_stats(args.in_path, args.out_dir, args.shards, args.head, compression)
+            logging.info(f"{manifest['records']} rows in {manifest['shards']} shards: {args.out_dir}")
+
+        if args.command == "join":
+            rows_num = join_stats(args.in_dir, args.out_path)
+            logging.info(f"{rows_num} rows: {args.out_path}")
+
+        if args.command == "info":
+            print(json.dumps(read_manifest(args.in_dir), indent=2))
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
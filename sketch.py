@@ -0,0 +1,126 @@
+# Fixed-memory approximate counting (used by the top-N pageviews mode)
+#
+# CountMinSketch  -> overestimates any count by at most eps*N
+#                    (eps = e/width) with probability 1 - e^-depth
+# HeavyHitters    -> bounded set of candidate top titles with exact
+#                    lower/upper bounds of their counts (Space-Saving style)
+
+from array import array
+import hashlib
+import heapq
+import math
+
+
+def hash_pair(key:str) -> tuple:
+    """
+    Returns two 64-bit hashes of a key (stable across processes),
+    used for double hashing: h1 + i*h2.
+    """
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class CountMinSketch():
+    def __init__(self, width:int=2**16, depth:int=4):
+        self.WIDTH = width
+        self.DEPTH = depth
+        self.TOTAL = 0
+        self.TABLE = array("q", bytes(8 * width * depth))
+
+    # Row indexes of a key
+    def __indexes(self, key:str):
+        h1, h2 = hash_pair(key)
+        return [row * self.WIDTH + (h1 + row * h2) % self.WIDTH for row in range(self.DEPTH)]
+
+    def add(self, key:str, count:int=1) -> None:
+        self.TOTAL += count
+        for idx in self.__indexes(key):
+            self.TABLE[idx] += count
+
+    def estimate(self, key:str) -> int:
+        return min(self.TABLE[idx] for idx in self.__indexes(key))
+
+    # Max overestimation with probability 1 - e^-depth
+    def error_bound(self) -> int:
+        return math.ceil(math.e / self.WIDTH * self.TOTAL)
+
+    def merge(self, other:"CountMinSketch") -> None:
+        if (self.WIDTH, self.DEPTH) != (other.WIDTH, other.DEPTH):
+            raise ValueError("Cannot merge sketches of different dimensions")
+        self.TOTAL += other.TOTAL
+        for idx, value in enumerate(other.TABLE):
+            self.TABLE[idx] += value
+
+
+class HeavyHitters():
+    # Keeps at most 2*capacity counters, prunes back to capacity.
+    # FLOOR is the highest count ever pruned, every title not tracked
+    # has a true count <= FLOOR.
+    def __init__(self, capacity:int):
+        self.CAPACITY = capacity
+        self.FLOOR = 0
+        self.COUNTS = {}
+        self.ERRORS = {}
+
+    def add(self, key:str, count:int=1) -> None:
+        if key in self.COUNTS:
+            self.COUNTS[key] += count
+            return
+        self.COUNTS[key] = self.FLOOR + count
+        self.ERRORS[key] = self.FLOOR
+        if len(self.COUNTS) > 2 * self.CAPACITY:
+            self.__prune()
+
+    def __prune(self) -> None:
+        kept = heapq.nlargest(self.CAPACITY, self.COUNTS.items(), key=lambda item: item[1])
+        kept_keys = {key for key, _ in kept}
+        for key, value in self.COUNTS.items():
+            if key not in kept_keys:
+                self.FLOOR = max(self.FLOOR, value)
+        self.COUNTS = dict(kept)
+        self.ERRORS = {key: self.ERRORS[key] for key in kept_keys}
+
+    # Merges a summary of a disjoint part of the stream
+    def merge(self, other:"HeavyHitters") -> None:
+        for key in self.COUNTS.keys() - other.COUNTS.keys():
+            self.COUNTS[key] += other.FLOOR
+            self.ERRORS[key] += other.FLOOR
+        for key, value in other.COUNTS.items():
+            if key in self.COUNTS:
+                self.COUNTS[key] += value
+                self.ERRORS[key] += other.ERRORS[key]
+            else:
+                self.COUNTS[key] = self.FLOOR + value
+                self.ERRORS[key] = self.FLOOR + other.ERRORS[key]
+        self.FLOOR += other.FLOOR
+        if len(self.COUNTS) > self.CAPACITY:
+            self.__prune()
+
+    # Returns [(key, upper bound, lower bound)] of the n largest counts
+    def top(self, n:int) -> list:
+        top = heapq.nlargest(n, self.COUNTS.items(), key=lambda item: item[1])
+        return [(key, value, value - self.ERRORS[key]) for key, value in top]
+
+
+class TopN():
+    # Count-min sketch + heavy hitters for one stream
+    def __init__(self, n:int, width:int=2**16, depth:int=4, capacity_factor:int=10):
+        self.N = n
+        self.SKETCH = CountMinSketch(width, depth)
+        self.HITTERS = HeavyHitters(n * capacity_factor)
+
+    def add(self, key:str, count:int=1) -> None:
+        self.SKETCH.add(key, count)
+        self.HITTERS.add(key, count)
+
+    def merge(self, other:"TopN") -> None:
+        self.SKETCH.merge(other.SKETCH)
+        self.HITTERS.merge(other.HITTERS)
+
+    # Returns [(key, estimate, lower bound)] ordered by estimate,
+    # the estimate is also the upper bound of the true count
+    def top(self) -> list:
+        results = []
+        for key, upper, lower in self.HITTERS.top(self.N):
+            results.append((key, min(upper, self.SKETCH.estimate(key)), lower))
+        return sorted(results, key=lambda item: item[1], reverse=True)
@@ -0,0 +1,272 @@
+#! /bin/python3
+
+# Delta-encoded history of stats snapshots
+#
+# STATS_DIR/{family}/history/{prj}/
+#   manifest.json        -> {"versions": [oldest, ..., newest]}
+#   base_{version}       -> full snapshot of the oldest version
+#   delta_{version}      -> changes against the preceding version:
+#                           head block, empty line, then
+#                           "+\t{row}" (new/changed row) or "-\t{title}"
+#
+# Versions are named by the snapshot file names
+# ({date}_{prj}_{family}.tsv). Any stored version can be reconstructed,
+# the base is rolled forward (compaction) once the history holds
+# SNAPSHOT_COMPACT_EVERY versions more than SNAPSHOT_HISTORY.
+
+from os.path import realpath
+from errors import WikiStatsError, InputError, DataError
+from stats_io import read_head, open_stats
+from symlink import symlink
+from config import *
+import argparse
+import logging
+import shutil
+import json
+import sys
+import os
+
+MANIFEST_FILE = "manifest.json"
+
+
+def read_rows(file_in) -> dict:
+    """
+    Reads data lines of a stats file, returns {title: whole line}.
+    """
+    rows = {}
+    for line in file_in:
+        line = line.rstrip("\n")
+        if line:
+            rows[line.split("\t", 1)[0]] = line
+    return rows
+
+def write_snapshot(path:str, head:str, rows:dict) -> None:
+    with open_stats(path, "w") as file_out:
+        file_out.write(head)
+        file_out.write("\n")
+        for line in rows.values():
+            file_out.write(line + "\n")
+
+
+class SnapshotStore():
+    # History of one stats family (pageviews, bps) of one project
+    def __init__(self, family:str, prj:str, store_dir:str=None):
+        self.FAMILY = family
+        self.PRJ = prj
+        self.STORE_DIR = store_dir or os.path.join(STATS_DIR, family, "history", prj)
+        self.MANIFEST_PATH = os.path.join(self.STORE_DIR, MANIFEST_FILE)
+        self.VERSIONS = []
+        if os.path.exists(self.MANIFEST_PATH):
+            with open(self.MANIFEST_PATH) as manifest_in:
+                self.VERSIONS = json.load(manifest_in)["versions"]
+
+    def __save_manifest(self) -> None:
+        tmp_path = self.MANIFEST_PATH + ".tmp"
+        with open(tmp_path, "w") as manifest_out:
+            json.dump({"versions": self.VERSIONS}, manifest_out, indent=2)
+        os.replace(tmp_path, self.MANIFEST_PATH)
+
+    def __base_path(self) -> str:
+        return os.path.join(self.STORE_DIR, f"base_{self.VERSIONS[0]}")
+
+    def __delta_path(self, version:str) -> str:
+        return os.path.join(self.STORE_DIR, f"delta_{version}")
+
+    # Loads a version, returns (head, {title: line})
+    # Rows follow the order of the base, new rows are appended
+    def load(self, version:str=None) -> tuple:
+        if not self.VERSIONS:
+            raise InputError(f"No stored snapshots ({self.STORE_DIR})")
+        version = version or self.VERSIONS[-1]
+        if version not in self.VERSIONS:
+            raise InputError(f"Unknown snapshot version: {version}")
+
+        with open_stats(self.__base_path()) as base_in:
+            head = read_head(base_in)
+            rows = read_rows(base_in)
+
+        for delta_version in self.VERSIONS[1:self.VERSIONS.index(version) + 1]:
+            with open_stats(self.__delta_path(delta_version)) as delta_in:
+                head = read_head(delta_in)
+                for line in delta_in:
+                    line = line.rstrip("\n")
+                    if not line:
+                        continue
+                    op, row = line.split("\t", 1)
+                    if op == "+":
+                        rows[row.split("\t", 1)[0]] = row
+                    elif op == "-":
+                        rows.pop(row, None)
+                    else:
+                        raise DataError(f"Corrupt delta {delta_version}: {line}")
+        return head, rows
+
+    # Writes a stored version as a full snapshot file
+    def checkout(self, version:str, out_path:str) -> None:
+        head, rows = self.load(version)
+        write_snapshot(out_path, head, rows)
+
+    # Adds a new snapshot file as the newest version
+    # prev_path -> full file of the current newest version (saves its reconstruction)
+    def add(self, path:str, prev_path:str=None) -> None:
+        version = os.path.basename(path)
+        if version in self.VERSIONS:
+            raise InputError(f"Snapshot version already stored: {version}")
+        os.makedirs(self.STORE_DIR, exist_ok=True)
+
+        if not self.VERSIONS:
+            self.VERSIONS = [version]
+            shutil.copyfile(path, self.__base_path())
+            self.__save_manifest()
+            return
+
+        if prev_path:
+            with open_stats(prev_path) as prev_in:
+                read_head(prev_in)
+                prev_rows = read_rows(prev_in)
+        else:
+            _, prev_rows = self.load()
+
+        changed = 0
+        with open_stats(path) as file_in, open_stats(self.__delta_path(version), "w") as delta_out:
+            delta_out.write(read_head(file_in))
+            delta_out.write("\n")
+            for line in file_in:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                title = line.split("\t", 1)[0]
+                if prev_rows.pop(title, None) != line:
+                    delta_out.write(f"+\t{line}\n")
+                    changed += 1
+            # Rows missing in the new snapshot
+            for title in prev_rows:
+                delta_out.write(f"-\t{title}\n")
+                changed += 1
+
+        self.VERSIONS.append(version)
+        self.__save_manifest()
+        logging.info(f"Stored {version} ({changed} changed rows)")
+
+    # Rolls the base forward so that only the newest `keep` versions remain
+    # Raises InputError if keep < 1 (the newest version is always kept)
+    def compact(self, keep:int) -> None:
+        if keep < 1:
+            raise InputError("Number of kept versions must be at least 1")
+        if len(self.VERSIONS) <= keep:
+            return
+        old_base_path = self.__base_path()
+        dropped = self.VERSIONS[:-keep]
+        new_base = self.VERSIONS[-keep]
+
+        # New base is swapped in complete, the manifest is switched only then
+        head, rows = self.load(new_base)
+        new_base_path = os.path.join(self.STORE_DIR, f"base_{new_base}")
+        tmp_path = f"{new_base_path}.tmp{os.getpid()}"
+        write_snapshot(tmp_path, head, rows)
+        os.replace(tmp_path, new_base_path)
+        self.VERSIONS = self.VERSIONS[-keep:]
+        self.__save_manifest()
+
+        if old_base_path != new_base_path:
+            os.remove(old_base_path)
+        for version in dropped[1:] + [new_base]:
+            os.remove(self.__delta_path(version))
+        logging.info(f"Compacted {self.PRJ} {self.FAMILY} history, base {new_base}")
+
+
+def rotate_snapshot(family:str, prj:str, new_file_path:str) -> None:
+    """
+    Makes a new snapshot the latest one.
+    SNAPSHOT_HISTORY == 0 -> latest/previous/second_previous symlinks
+    (three full generations), otherwise the replaced snapshot is kept
+    only in the delta history and the previous/second_previous symlinks
+    are removed.
+    """
+    latest_path = os.path.join(STATS_DIR, f"{family}/latest_{prj}_{family}.tsv")
+
+    if not SNAPSHOT_HISTORY:
+        # Update symlinks (keep only last three versions of file)
+        previous_path = os.path.join(STATS_DIR, f"{family}/previous_{prj}_{family}.tsv")
+        second_previous_path = os.path.join(STATS_DIR, f"{family}/second_previous_{prj}_{family}.tsv")
+
+        # Delete the last version
+        os.remove(realpath(second_previous_path)) if os.path.exists(realpath(second_previous_path)) else None
+
+        # Shift symlinks
+        symlink(realpath(previous_path), second_previous_path)
+        symlink(realpath(latest_path), previous_path)
+        symlink(realpath(new_file_path), latest_path)
+        return
+
+    # previous/second_previous symlinks are not kept with the history
+    # (the files they point to are left in place), drop them before
+    # the replaced snapshot is removed
+    for name in ("previous", "second_previous"):
+        link_path = os.path.join(STATS_DIR, f"{family}/{name}_{prj}_{family}.tsv")
+        if os.path.islink(link_path):
+            os.remove(link_path)
+
+    store = SnapshotStore(family, prj)
+    prev_path = realpath(latest_path) if os.path.exists(latest_path) else None
+    # First use, the current snapshot becomes the base
+    if not store.VERSIONS and prev_path:
+        store.add(prev_path)
+    store.add(new_file_path, prev_path)
+    symlink(realpath(new_file_path), latest_path)
+
+    if prev_path and prev_path != realpath(new_file_path):
+        os.remove(prev_path)
+    if len(store.VERSIONS) >= SNAPSHOT_HISTORY + SNAPSHOT_COMPACT_EVERY:
+        store.compact(SNAPSHOT_HISTORY)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List stored versions")
+    checkout_parser = subparsers.add_parser("checkout", help="Reconstruct a version as a full snapshot")
+    compact_parser = subparsers.add_parser("compact", help="Drop versions older than the newest N")
+
+    for sub in (list_parser, checkout_parser, compact_parser):
+        sub.add_argument("--family", choices=["pageviews", "bps"], required=True, dest="family", help="Stats family")
+        sub.add_argument("--project", type=str, required=True, dest="prj", help="Project")
+
+    checkout_parser.add_argument(
+        "-v", "--version",
+        type=str,
+        required=True,
+        dest="version",
+        help="Version name, or -N for the N-th version before the newest (-0 -> newest)"
+    )
+    checkout_parser.add_argument("-o", "--output", type=str, required=True, dest="out_path", help="Output file")
+    compact_parser.add_argument("-k", "--keep", type=int, default=SNAPSHOT_HISTORY or 3, dest="keep", help="Versions to keep")
+    args = parser.parse_args()
+
+    if args.command == "compact" and args.keep < 1:
+        sys.stderr.write("Error: Number of kept versions must be at least 1\n")
+        exit(1)
+
+    store = SnapshotStore(args.family, args.prj)
+    try:
+        if args.command == "list":
+            for version in store.VERSIONS:
+                print(version)
+
+        if args.command == "checkout":
+            version = args.version
+            if version.startswith("-") and version[1:].isdigit():
+                back = int(version[1:])
+                if back >= len(store.VERSIONS):
+                    raise InputError(f"Only {len(store.VERSIONS)} versions stored")
+                version = store.VERSIONS[-1 - back]
+            store.checkout(version, args.out_path)
+
+        if args.command == "compact":
+            store.compact(args.keep)
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
@@ -0,0 +1,136 @@
+# Local staging tier of the drivers (STAGING_DIR)
+#
+# STATS_DIR and the default temp dir may sit on network mounts, every
+# write of an intermediate file is then a network round trip. With
+# STAGING_DIR set:
+#   STAGING_DIR/tmp/       -> temp dirs of the drivers (make_tmp_dir)
+#   STAGING_DIR/outgoing/  -> new snapshots, written locally (staged_path)
+# A staged snapshot is copied to STATS_DIR by a write-back step
+# (WriteBack, background threads), its size is verified and only then
+# the latest/previous symlinks are rotated (on_done callback).
+#
+# Staging is skipped (with a warning) if the local disk has less than
+# STAGING_MIN_FREE_GB free space left after the expected file size.
+
+from errors import DataError
+from metrics import stage
+from config import *
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import logging
+import shutil
+import os
+
+# Buffer of the write-back copy
+COPY_BUFFER = 16 * 1024 * 1024
+
+
+def has_free_space(path:str, expected_bytes:int=0) -> bool:
+    """
+    True if a dir has STAGING_MIN_FREE_GB free space left after expected_bytes.
+    """
+    os.makedirs(path, exist_ok=True)
+    return shutil.disk_usage(path).free - expected_bytes >= STAGING_MIN_FREE_GB * 2**30
+
+def make_tmp_dir(prefix:str) -> str:
+    """
+    Creates a temp dir in the staging tier (default temp dir without staging
+    or without enough free space).
+    """
+    if STAGING_DIR:
+        tmp_root = os.path.join(STAGING_DIR, "tmp")
+        if has_free_space(tmp_root):
+            return tempfile.mkdtemp(prefix=prefix, dir=tmp_root)
+        logging.warning(f"WARNING: Not enough free space in {tmp_root}, using the default temp dir")
+    return tempfile.mkdtemp(prefix=prefix)
+
+def staged_path(final_path:str, expected_bytes:int=0) -> str:
+    """
+    Returns the local path to write a file of STATS_DIR to
+    (final_path itself without staging or without enough free space).
+    """
+    if not STAGING_DIR:
+        return final_path
+    outgoing_dir = os.path.join(STAGING_DIR, "outgoing")
+    if not has_free_space(outgoing_dir, expected_bytes):
+        logging.warning(f"WARNING: Not enough free space in {outgoing_dir}, writing to {final_path}")
+        return final_path
+    return os.path.join(outgoing_dir, os.path.basename(final_path))
+
+def size_of(path:str) -> int:
+    """
+    Returns the size of a file behind a symlink, 0 if missing.
+    """
+    path = os.path.realpath(path)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def copy_verified(staged:str, final_path:str) -> int:
+    """
+    Copies a staged file to its final path (atomically) and removes it.
+    Returns the size of the file.
+    Raises DataError if the copy fails or its size does not match
+    (the staged file is kept).
+    """
+    if os.path.abspath(staged) == os.path.abspath(final_path):
+        return os.path.getsize(final_path)
+
+    tmp_path = f"{final_path}.tmp{os.getpid()}"
+    try:
+        size = os.path.getsize(staged)
+        with open(staged, "rb") as file_in, open(tmp_path, "wb") as file_out:
+            shutil.copyfileobj(file_in, file_out, COPY_BUFFER)
+            file_out.flush()
+            os.fsync(file_out.fileno())
+        copied = os.path.getsize(tmp_path)
+        if copied != size:
+            raise DataError(f"Write-back of {staged} incomplete ({copied}/{size} bytes)")
+        os.replace(tmp_path, final_path)
+    except OSError as e:
+        raise DataError(f"Write-back of {staged} to {final_path} failed ({e})")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    os.remove(staged)
+    return size
+
+
+class WriteBack():
+    # Copies staged files to STATS_DIR in background threads
+    # (threads=0 -> in the calling thread)
+    def __init__(self, threads:int=1):
+        self.THREADS = threads
+        self.ERRORS = {}
+        self.__executor = ThreadPoolExecutor(max_workers=threads) if threads else None
+        self.__futures = []
+
+    # Copies one file, then calls on_done(final_path) (e.g. symlink rotation),
+    # on_exit() is called in any case (e.g. lock release)
+    # A failed copy is recorded in ERRORS under name, the staged file is kept
+    def __run(self, name:str, staged:str, final_path:str, on_done, on_exit) -> None:
+        try:
+            if staged != final_path:
+                with stage(f"write_back:{name}") as metrics:
+                    size = copy_verified(staged, final_path)
+                    metrics.RECORDS += 1
+                logging.info(f"Written back {os.path.basename(final_path)} ({size} bytes)")
+            if on_done:
+                on_done(final_path)
+        except Exception as e:
+            self.ERRORS[name] = str(e)
+        finally:
+            if on_exit:
+                on_exit()
+
+    def submit(self, name:str, staged:str, final_path:str, on_done=None, on_exit=None) -> None:
+        if self.__executor:
+            self.__futures.append(self.__executor.submit(self.__run, name, staged, final_path, on_done, on_exit))
+        else:
+            self.__run(name, staged, final_path, on_done, on_exit)
+
+    # Waits for all write-backs, returns {name: error} of the failed ones
+    def wait(self) -> dict:
+        if self.__executor:
+            for future in self.__futures:
+                future.result()
+            self.__executor.shutdown()
+        return self.ERRORS
@@ -0,0 +1,225 @@
+#! /bin/python3
+
+# SQLite backend of cumulative pageview totals (PAGEVIEWS_BACKEND = "sqlite")
+#
+# One database file per project:
+#   stats    (title PRIMARY KEY, count)  -> count NULL = "NF"
+#   meta     (key, value)                -> head of the stats file, name of
+#                                           the snapshot the db matches
+#   applied  (batch PRIMARY KEY)         -> date ranges already added
+#
+# New counts of a date range are added by batched upserts in one
+# transaction (cost of the new range, not of all titles). A range is
+# recorded in "applied" in the same transaction, so a range kept pending
+# after a failed export or rotation is never added twice. If the latest
+# snapshot is not the one the db matches (written by the TSV backend),
+# the db is imported from it again. Rows are exported in insertion order,
+# which is the order of the TSV merge.
+#
+# The export of a full snapshot can be left out of some runs
+# (PAGEVIEWS_DB_EXPORT_EVERY), the db then stays ahead of the latest
+# snapshot it matches. Runs since the last export are counted in meta.
+#
+#   stats_db.py import -d en_pageviews.sqlite -i latest_en_pageviews.tsv
+#   stats_db.py export -d en_pageviews.sqlite -o en_pageviews.tsv
+
+from errors import WikiStatsError, InputError, DataError
+from stats_io import open_stats, read_head
+from metrics import RunReport, REPORT
+import argparse
+import logging
+import sqlite3
+import sys
+import os
+
+# Rows per executemany() call
+BATCH_ROWS = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats (title TEXT PRIMARY KEY, count INTEGER);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS applied (batch TEXT PRIMARY KEY);
+"""
+
+UPSERT = (
+    "INSERT INTO stats (title, count) VALUES (?, ?) "
+    "ON CONFLICT (title) DO UPDATE SET count = coalesce(stats.count, 0) + excluded.count"
+)
+
+
+def iter_counts(file_in):
+    """
+    Yields (title, count) of "title \\t count" lines, skips invalid counts.
+    """
+    for line in file_in:
+        values = [val.strip() for val in line.split("\t")]
+        try:
+            yield values[0], int(values[1])
+        except (ValueError, IndexError):
+            continue
+
+def batches(rows, size:int=BATCH_ROWS):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class StatsDB():
+    # Cumulative counts of one project
+    # (stages are measured in report, e.g. the report of a worker process)
+    def __init__(self, path:str, report:RunReport=REPORT):
+        self.PATH = path
+        self.REPORT = report
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        try:
+            self.__db = sqlite3.connect(path, isolation_level=None)
+            self.__db.execute("PRAGMA journal_mode = WAL")
+            self.__db.execute("PRAGMA synchronous = NORMAL")
+            self.__db.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            raise DataError(f"Unable to open stats database {path} ({e})")
+
+    def close(self) -> None:
+        self.__db.close()
+
+    def __enter__(self) -> "StatsDB":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_meta(self, key:str, default:str=None) -> str:
+        row = self.__db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def __set_meta(self, key:str, value:str) -> None:
+        self.__db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    # True if the db holds the counts of the given snapshot file
+    def matches(self, snapshot_path:str) -> bool:
+        return self.get_meta("snapshot") == os.path.basename(snapshot_path)
+
+    def is_applied(self, batch:str) -> bool:
+        return self.__db.execute("SELECT 1 FROM applied WHERE batch = ?", (batch,)).fetchone() is not None
+
+    # Replaces the content of the db with a stats file, returns the number of rows
+    # (ranges not in the file are added again, e.g. pending ones)
+    def import_tsv(self, path:str) -> int:
+        if not os.path.exists(path):
+            raise InputError(f"Stats file not found: {path}")
+        rows_num = 0
+        with self.REPORT.stage("db:import") as metrics, open_stats(path) as file_in:
+            head = read_head(file_in)
+            try:
+                self.__db.execute("BEGIN")
+                self.__db.execute("DELETE FROM stats")
+                self.__db.execute("DELETE FROM applied")
+                for batch in batches(
+                    (values[0], int(values[1]) if values[1].isdecimal() else None)
+                    for values in ([val.strip() for val in line.split("\t")] for line in file_in)
+                    if len(values) > 1 and values[0]
+                ):
+                    self.__db.executemany(
+                        "INSERT INTO stats (title, count) VALUES (?, ?) "
+                        "ON CONFLICT (title) DO UPDATE SET count = excluded.count",
+                        batch
+                    )
+                    rows_num += len(batch)
+                self.__set_meta("head", head)
+                self.__set_meta("snapshot", os.path.basename(path))
+                self.__set_meta("unexported_runs", "0")
+                self.__db.execute("COMMIT")
+            except sqlite3.Error as e:
+                self.__db.execute("ROLLBACK")
+                raise DataError(f"Import of {path} failed ({e})")
+            metrics.RECORDS += rows_num
+        return rows_num
+
+    # Adds counts of a "title \t count" file in one transaction
+    # Returns the number of lines added (0 if the batch was applied before)
+    def upsert_file(self, path:str, batch:str) -> int:
+        if self.is_applied(batch):
+            logging.warning(f"WARNING: {batch} already in {self.PATH}, skipped")
+            return 0
+        rows_num = 0
+        with self.REPORT.stage("db:upsert") as metrics, open_stats(path) as file_in:
+            try:
+                self.__db.execute("BEGIN")
+                for rows in batches(iter_counts(file_in)):
+                    self.__db.executemany(UPSERT, rows)
+                    rows_num += len(rows)
+                self.__db.execute("INSERT INTO applied (batch) VALUES (?)", (batch,))
+                self.__db.execute("COMMIT")
+            except sqlite3.Error as e:
+                self.__db.execute("ROLLBACK")
+                raise DataError(f"Upsert of {path} failed ({e})")
+            metrics.LINES += rows_num
+        return rows_num
+
+    # Writes the counts as a stats file (head + "title \t count"), returns the number of rows
+    def export_tsv(self, path:str) -> int:
+        rows_num = 0
+        with self.REPORT.stage("db:export") as metrics, open_stats(path, "w") as file_out:
+            head = self.get_meta("head", "")
+            file_out.write(head)
+            if not head.endswith("\n\n"):
+                file_out.write("\n")
+            cursor = self.__db.execute("SELECT title, count FROM stats ORDER BY rowid")
+            while rows := cursor.fetchmany(BATCH_ROWS):
+                file_out.write("".join(
+                    f"{title}\t{'NF' if count is None else count}\n" for title, count in rows
+                ))
+                rows_num += len(rows)
+            metrics.RECORDS += rows_num
+        return rows_num
+
+    # Records the snapshot the db matches (once it replaced the latest one)
+    def set_snapshot(self, snapshot_path:str) -> None:
+        self.__set_meta("snapshot", os.path.basename(snapshot_path))
+        self.__set_meta("unexported_runs", "0")
+
+    # Number of runs whose counts were added but not exported yet
+    def unexported_runs(self) -> int:
+        return int(self.get_meta("unexported_runs", "0"))
+
+    def set_unexported_runs(self, runs:int) -> None:
+        self.__set_meta("unexported_runs", str(runs))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Load a stats file into a database")
+    upsert_parser = subparsers.add_parser("upsert", help="Add counts of a \"title \\t count\" file")
+    export_parser = subparsers.add_parser("export", help="Write a database as a stats file")
+
+    for sub in (import_parser, upsert_parser, export_parser):
+        sub.add_argument("-d", "--db", type=str, required=True, dest="db_path", help="Database file")
+    import_parser.add_argument("-i", "--input", type=str, required=True, dest="in_path", help="Stats file")
+    upsert_parser.add_argument("-i", "--input", type=str, required=True, dest="in_path", help="Counts file")
+    upsert_parser.add_argument("-b", "--batch", type=str, required=True, dest="batch", help="Name of the batch (e.g. date range)")
+    export_parser.add_argument("-o", "--output", type=str, required=True, dest="out_path", help="Output stats file")
+    args = parser.parse_args()
+
+    try:
+        with StatsDB(args.db_path) as db:
+            if args.command == "import":
+                logging.info(f"Imported {db.import_tsv(args.in_path)} rows: {args.db_path}")
+            if args.command == "upsert":
+                logging.info(f"Added {db.upsert_file(args.in_path, args.batch)} rows: {args.db_path}")
+            if args.command == "export":
+                logging.info(f"Exported {db.export_tsv(args.out_path)} rows: {args.out_path}")
+    except WikiStatsError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        exit(1)
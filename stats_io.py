@@ -0,0 +1,98 @@
+# Helpers for reading stats files from STATS_DIR
+# (head block terminated by an empty line, then TSV data)
+#
+# Stats and intermediate files may be compressed: writers choose the
+# compression by the file extension (.gz, .zst), readers detect it from
+# the file content, so the pipeline logic does not change.
+
+from errors import InputError
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Fast compression levels (the jobs are I/O-bound)
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+def compression_of(path:str, mode:str="r") -> str:
+    """
+    Returns "gz", "zst" or "" for a file, by content when reading
+    and by extension when writing.
+    """
+    if "r" in mode:
+        try:
+            with open(path, "rb") as file_in:
+                magic = file_in.read(len(ZSTD_MAGIC))
+        except FileNotFoundError:
+            return ""
+        if magic.startswith(GZIP_MAGIC):
+            return "gz"
+        if magic == ZSTD_MAGIC:
+            return "zst"
+        return ""
+    if path.endswith(".gz"):
+        return "gz"
+    if path.endswith(".zst"):
+        return "zst"
+    return ""
+
+def open_stats(path:str, mode:str="r"):
+    """
+    Opens a (possibly compressed) file like open().
+    Raises InputError for .zst files without the zstandard module.
+    """
+    compression = compression_of(path, mode)
+    if compression and "b" not in mode and "t" not in mode:
+        mode += "t"
+
+    if compression == "gz":
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    if compression == "zst":
+        if zstandard is None:
+            raise InputError(f"zstandard module required for {path} (pip install zstandard)")
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL))
+    return open(path, mode)
+
+def read_head(file_in) -> str:
+    """
+    Reads the stats head (everything up to the first empty line).
+    The file object is left positioned at the first data line.
+    """
+    head = ""
+    while (line := file_in.readline()).strip() != "":
+        head += line
+    return head
+
+def iter_rows(file_in):
+    """
+    Yields stripped TSV columns of every data line, skips empty lines.
+    """
+    for line in file_in:
+        values = [val.strip() for val in line.split("\t")]
+        if values == [""]:
+            continue
+        yield values
+
+def load_stats(path:str) -> tuple:
+    """
+    Loads a whole stats file, returns (head, {title: [values]}).
+    Sharded stats dirs (sharding.py) are loaded from all their parts.
+    """
+    # Imported here, sharding is built on top of this module
+    from sharding import shard_paths
+
+    data = {}
+    head = None
+    for part_path in shard_paths(path):
+        with open_stats(part_path, "r") as file_in:
+            part_head = read_head(file_in)
+            head = part_head if head is None else head
+            for values in iter_rows(file_in):
+                data[values[0]] = values[1:]
+    return head, data
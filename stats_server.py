@@ -0,0 +1,348 @@
+#! /usr/bin/python3
+
+# Local read-only query service over the latest stats snapshots
+#
+# For every project the latest pageviews and bps snapshots are joined once
+# into a memory-mapped stats table (see kb_enrich.StatsTable), top-K lists
+# are precomputed. The `latest_*` symlinks are watched and the data are
+# reloaded in the background when they rotate.
+#
+# Endpoints (JSON responses):
+#   GET  /lookup?project=en&title=A&title=B
+#   POST /lookup   {"project": "en", "titles": ["A", "B"]}
+#   GET  /top?project=en&stat=pageviews&k=10
+#   GET  /status
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+from os.path import realpath
+from kb_enrich import StatsTable
+from sharding import shard_paths
+from errors import InputError
+from stats_io import read_head, iter_rows, open_stats
+from config import *
+import threading
+import argparse
+import tempfile
+import logging
+import shutil
+import heapq
+import json
+import time
+import sys
+import os
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# Stats served by the service (columns of the stats table)
+STATS = ["backlinks", "pageviews", "primary"]
+TOP_K_STATS = ["backlinks", "pageviews"]
+
+# Max K precomputed for top-K queries
+TOP_K_MAX = 1000
+
+# Seconds between checks of the latest_* symlinks
+RELOAD_INTERVAL = 60
+
+
+def latest_paths(prj:str) -> tuple:
+    """
+    Returns paths to the latest pageviews and bps snapshots of a project.
+    """
+    return (
+        os.path.join(STATS_DIR, f"pageviews/latest_{prj}_pageviews.tsv"),
+        os.path.join(STATS_DIR, f"bps/latest_{prj}_bps.tsv")
+    )
+
+def top_k(path:str, column:int, k:int) -> list:
+    """
+    Returns the k largest [title, value] pairs of a stats file column
+    (sharded stats dirs are read from all their parts, as load_stats does).
+    """
+    def values():
+        for part_path in shard_paths(path):
+            with open_stats(part_path, "r") as file_in:
+                read_head(file_in)
+                for row in iter_rows(file_in):
+                    try:
+                        yield int(row[column]), row[0]
+                    except (ValueError, IndexError):
+                        continue
+    return [[title, value] for value, title in heapq.nlargest(k, values())]
+
+
+class ProjectSnapshot():
+    # Stats of one project loaded from the latest snapshots
+    def __init__(self, prj:str, cache_dir:str):
+        self.PROJECT = prj
+        pw_path, bps_path = latest_paths(prj)
+        self.SOURCES = (realpath(pw_path), realpath(bps_path))
+
+        table_path = os.path.join(cache_dir, f"{prj}_{time.time_ns()}.table")
+        StatsTable.build(self.SOURCES[0], self.SOURCES[1], table_path)
+        self.TABLE = StatsTable(table_path)
+        # The mapping stays valid after unlink
+        os.remove(table_path)
+
+        self.TOP = {
+            "pageviews": top_k(self.SOURCES[0], 1, TOP_K_MAX),
+            "backlinks": top_k(self.SOURCES[1], 1, TOP_K_MAX)
+        }
+        self.LOADED = time.time()
+        # Requests using the table, it is closed once retired and unused
+        self.__readers = 0
+        self.__retired = False
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.__lock:
+            self.__readers += 1
+
+    def release(self) -> None:
+        with self.__lock:
+            self.__readers -= 1
+            close = self.__retired and not self.__readers
+        if close:
+            self.close()
+
+    # Replaced by a newer snapshot, closed by the last running request
+    def retire(self) -> None:
+        with self.__lock:
+            self.__retired = True
+            close = not self.__readers
+        if close:
+            self.close()
+
+    # Returns stats of a title, None if not found
+    def lookup(self, title:str):
+        record = self.TABLE.get(title.encode())
+        if record is None:
+            return None
+        values = record.decode().split("\t")
+        return {
+            stat: int(value) if value.lstrip("-").isdigit() else None
+            for stat, value in zip(STATS, values)
+        }
+
+    def is_current(self) -> bool:
+        return tuple(realpath(path) for path in latest_paths(self.PROJECT)) == self.SOURCES
+
+    def close(self):
+        self.TABLE.close()
+
+
+class StatsService():
+    # Holds the snapshots of all projects, reloads rotated ones
+    # reload_interval -> seconds between checks (at least 1)
+    def __init__(self, projects:list, cache_dir:str, reload_interval:int=RELOAD_INTERVAL):
+        if reload_interval < 1:
+            raise InputError("Reload interval must be at least 1 second")
+        self.PROJECTS = projects
+        self.CACHE_DIR = cache_dir
+        self.RELOAD_INTERVAL = reload_interval
+        self.SNAPSHOTS = {}
+        # Guards the swap of a snapshot against requests picking it up
+        self.__swap_lock = threading.Lock()
+        for prj in projects:
+            logging.info(f"Loading {prj}..")
+            self.SNAPSHOTS[prj] = ProjectSnapshot(prj, cache_dir)
+        self.__stop = threading.Event()
+        self.__watcher = threading.Thread(target=self.__watch, daemon=True)
+        self.__watcher.start()
+
+    # Replaces snapshots whose latest_* symlinks have rotated
+    def reload(self):
+        for prj, snapshot in list(self.SNAPSHOTS.items()):
+            if snapshot.is_current():
+                continue
+            logging.info(f"Snapshot rotated, reloading {prj}..")
+            try:
+                new_snapshot = ProjectSnapshot(prj, self.CACHE_DIR)
+            except Exception as e:
+                logging.error(f"ERROR: Reload of {prj} failed ({e}), keeping previous data")
+                continue
+            with self.__swap_lock:
+                self.SNAPSHOTS[prj] = new_snapshot
+            # Closed once running requests are done with the old table
+            snapshot.retire()
+
+    # Returns the current snapshot of a project for one request
+    # (released by the caller)
+    def __acquire(self, prj:str) -> ProjectSnapshot:
+        with self.__swap_lock:
+            snapshot = self.SNAPSHOTS[prj]
+            snapshot.acquire()
+        return snapshot
+
+    def __watch(self):
+        while not self.__stop.wait(self.RELOAD_INTERVAL):
+            self.reload()
+
+    def stop(self):
+        self.__stop.set()
+
+    def lookup(self, prj:str, titles:list) -> dict:
+        snapshot = self.__acquire(prj)
+        try:
+            return {title: snapshot.lookup(title) for title in titles}
+        finally:
+            snapshot.release()
+
+    def top(self, prj:str, stat:str, k:int) -> list:
+        snapshot = self.__acquire(prj)
+        try:
+            return snapshot.TOP[stat][:k]
+        finally:
+            snapshot.release()
+
+    def status(self) -> dict:
+        return {
+            prj: {"sources": snapshot.SOURCES, "records": snapshot.TABLE.SIZE, "loaded": snapshot.LOADED}
+            for prj, snapshot in self.SNAPSHOTS.items()
+        }
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    SERVICE = None
+
+    def __send(self, code:int, data) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __project(self, prj):
+        if prj not in self.SERVICE.SNAPSHOTS:
+            self.__send(404, {"error": f"Unknown project: {prj}"})
+            return None
+        return prj
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        prj = query.get("project", [None])[0]
+
+        if url.path == "/status":
+            self.__send(200, self.SERVICE.status())
+
+        elif url.path == "/lookup":
+            if self.__project(prj):
+                self.__send(200, self.SERVICE.lookup(prj, query.get("title", [])))
+
+        elif url.path == "/top":
+            stat = query.get("stat", ["pageviews"])[0]
+            try:
+                k = min(int(query.get("k", [10])[0]), TOP_K_MAX)
+            except ValueError:
+                self.__send(400, {"error": "k must be a number"})
+                return
+            if stat not in TOP_K_STATS:
+                self.__send(400, {"error": f"stat must be one of {TOP_K_STATS}"})
+            elif self.__project(prj):
+                self.__send(200, self.SERVICE.top(prj, stat, k))
+        else:
+            self.__send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/lookup":
+            self.__send(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            prj = request["project"]
+            titles = list(request["titles"])
+        except (ValueError, KeyError, TypeError):
+            self.__send(400, {"error": "Expected {\"project\": ..., \"titles\": [...]}"})
+            return
+        if self.__project(prj):
+            self.__send(200, self.SERVICE.lookup(prj, titles))
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    # Needed by BaseHTTPRequestHandler
+    server_name = "localhost"
+    server_port = 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=8765,
+        dest="port",
+        help="Port on localhost (default 8765)"
+    )
+
+    parser.add_argument(
+        "--socket",
+        type=str,
+        required=False,
+        dest="socket_path",
+        help="Listen on a Unix socket instead of a TCP port"
+    )
+
+    parser.add_argument(
+        "--projects",
+        nargs="+",
+        default=list(PROJECTS.keys()),
+        dest="prj_list",
+        help="List of projects"
+    )
+
+    parser.add_argument(
+        "--reload-interval",
+        type=int,
+        default=RELOAD_INTERVAL,
+        dest="reload_interval",
+        help="Seconds between checks of the latest_* symlinks"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        required=False,
+        dest="cache_dir",
+        help="Dir for the memory-mapped tables (local disk recommended)"
+    )
+    args = parser.parse_args()
+
+    if args.reload_interval < 1:
+        sys.stderr.write("Error: Reload interval must be at least 1 second\n")
+        exit(1)
+
+    cache_dir = tempfile.mkdtemp(prefix="ws_srv_", dir=args.cache_dir)
+    service = StatsService(args.prj_list, cache_dir, args.reload_interval)
+    StatsRequestHandler.SERVICE = service
+
+    if args.socket_path:
+        if os.path.exists(args.socket_path):
+            os.remove(args.socket_path)
+        server = ThreadingUnixHTTPServer(args.socket_path, StatsRequestHandler)
+        logging.info(f"Serving on {args.socket_path}")
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), StatsRequestHandler)
+        logging.info(f"Serving on http://127.0.0.1:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
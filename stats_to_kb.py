@@ -3,7 +3,10 @@
 import os
 import sys
 import argparse
-from kb_metrics.metrics_knowledge_base import KnowledgeBase
+import logging
+from kb_enrich import insert_stats, CHUNK_SIZE
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 if __name__ == "__main__":
 
@@ -25,7 +28,7 @@ if __name__ == "__main__":
         required=True,
         action="store",
         dest="pw_file",
-        help = "Stats file with pageviews",
+        help = "Stats file with pageviews (or a sharded stats dir, sharding.py)",
     )
 
     io_parser.add_argument(
@@ -34,7 +37,7 @@ if __name__ == "__main__":
         required=True,
         action="store",
         dest="bps_file",
-        help = "Stats file with backlinks and primary tags (bps)",
+        help = "Stats file with backlinks and primary tags (bps) (or a sharded stats dir, sharding.py)",
     )
 
     io_parser.add_argument(
@@ -46,6 +49,26 @@ if __name__ == "__main__":
         help = "Output file",
     )
 
+    io_parser.add_argument(
+        "-w","--workers", 
+        type = int, 
+        required=False,
+        action="store",
+        dest="workers",
+        help = "Enrich the KB in chunks using N worker processes (1 = serial chunked path), "
+               "a separate writer (kb_enrich.py) instead of kb_metrics, only for KBs without stats",
+    )
+
+    io_parser.add_argument(
+        "--chunk-size", 
+        type = int, 
+        required=False,
+        default=CHUNK_SIZE,
+        action="store",
+        dest="chunk_size",
+        help = "Size of one KB chunk in bytes (only with --workers)",
+    )
+
     args = io_parser.parse_args()
 
     input_kb = args.input_kb
@@ -73,6 +96,26 @@ if __name__ == "__main__":
     if output_file is None:
         output_file = ""
 
+    # Chunked enrichment (shared memory-mapped stats table)
+    if args.workers:
+        if not output_file:
+            output_file = f"{input_kb}+stats.tsv"
+        try:
+            insert_stats(
+                kb_path=input_kb,
+                pw_path=pw_file,
+                bps_path=bps_file,
+                output_path=output_file,
+                workers=args.workers,
+                chunk_size=args.chunk_size
+            )
+        except ValueError as e:
+            sys.stderr.write(f"Error: {e}\n")
+            exit(1)
+        exit(0)
+
+    from kb_metrics.metrics_knowledge_base import KnowledgeBase
+
     # Knowledge base class 
     kb = KnowledgeBase(path_to_kb=input_kb)
     
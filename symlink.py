@@ -12,13 +12,15 @@ import errno
 def symlink(target, link_name):
     """
     Equivalent to `ln -sf target link_name`. 
+    An existing link is replaced atomically (readers never miss it).
     """
     try:
         os.symlink(target, link_name)
     except OSError as e:
         if e.errno == errno.EEXIST:
-            os.remove(link_name)
-            os.symlink(target, link_name)
+            tmp_link_name = f"{link_name}.{os.getpid()}.tmp"
+            os.symlink(target, tmp_link_name)
+            os.replace(tmp_link_name, link_name)
         else:
             raise e
         
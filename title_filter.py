@@ -0,0 +1,166 @@
+# Title-membership filter built from a pages-articles dump
+# (every <title> entry, XML entities decoded, as pageview titles are)
+#
+# Stored either as an exact title list (one title per line)
+# or as a compact Bloom filter file (no false negatives,
+# false positive rate chosen when building).
+
+from sketch import hash_pair
+from stats_io import open_stats
+import argparse
+import logging
+import struct
+import html
+import math
+import re
+import sys
+import os
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# Bloom filter file: header (magic, bits, hashes, items) + bit array
+BLOOM_MAGIC = b"WSBLOOM1"
+BLOOM_HEADER = struct.Struct("<8sQQQ")
+
+# Default false positive rate of the Bloom filter
+FP_RATE = 0.01
+
+TITLE_REGEX = re.compile(r"<title>(.*)</title>")
+
+
+class BloomFilter():
+    def __init__(self, bits:int, hashes:int, data:bytearray=None, items:int=0):
+        self.BITS = bits
+        self.HASHES = hashes
+        self.ITEMS = items
+        self.DATA = data if data is not None else bytearray((bits + 7) // 8)
+
+    # Filter sized for the expected number of items and false positive rate
+    @classmethod
+    def for_capacity(cls, items:int, fp_rate:float=FP_RATE) -> "BloomFilter":
+        items = max(items, 1)
+        bits = max(int(-items * math.log(fp_rate) / math.log(2) ** 2), 8)
+        hashes = max(round(bits / items * math.log(2)), 1)
+        return cls(bits, hashes)
+
+    def __positions(self, key:str):
+        h1, h2 = hash_pair(key)
+        return ((h1 + i * h2) % self.BITS for i in range(self.HASHES))
+
+    def add(self, key:str) -> None:
+        for pos in self.__positions(key):
+            self.DATA[pos >> 3] |= 1 << (pos & 7)
+        self.ITEMS += 1
+
+    def __contains__(self, key:str) -> bool:
+        return all(self.DATA[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key))
+
+    def save(self, path:str) -> None:
+        with open(path, "wb") as file_out:
+            file_out.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.BITS, self.HASHES, self.ITEMS))
+            file_out.write(self.DATA)
+
+    @classmethod
+    def load(cls, path:str) -> "BloomFilter":
+        with open(path, "rb") as file_in:
+            magic, bits, hashes, items = BLOOM_HEADER.unpack(file_in.read(BLOOM_HEADER.size))
+            if magic != BLOOM_MAGIC:
+                raise ValueError(f"Not a Bloom filter file: {path}")
+            return cls(bits, hashes, bytearray(file_in.read()), items)
+
+
+def extract_titles(dump_path:str):
+    """
+    Yields all titles of a pages-articles dump (entities decoded).
+    """
+    with open_stats(dump_path) as dump_file:
+        for line in dump_file:
+            match = TITLE_REGEX.match(line.strip())
+            if match:
+                yield html.unescape(match.group(1)).replace(" ", "_")
+
+def build_title_filter(dump_path:str, output_path:str, bloom:bool=False, fp_rate:float=FP_RATE) -> int:
+    """
+    Builds a title filter file from a dump, returns the number of titles.
+    """
+    titles = set(extract_titles(dump_path))
+    if bloom:
+        bloom_filter = BloomFilter.for_capacity(len(titles), fp_rate)
+        for title in titles:
+            bloom_filter.add(title)
+        bloom_filter.save(output_path)
+    else:
+        with open_stats(output_path, "w") as file_out:
+            for title in sorted(titles):
+                file_out.write(f"{title}\n")
+    return len(titles)
+
+def load_title_filter(path:str):
+    """
+    Loads a title filter file (exact title list or Bloom filter),
+    the result supports the `in` operator.
+    """
+    with open_stats(path, "rb") as file_in:
+        is_bloom = file_in.read(len(BLOOM_MAGIC)) == BLOOM_MAGIC
+    if is_bloom:
+        return BloomFilter.load(path)
+    with open_stats(path) as file_in:
+        return {line.rstrip("\n") for line in file_in}
+
+
+if __name__ == "__main__":
+    io_parser = argparse.ArgumentParser()
+
+    io_parser.add_argument(
+        "-i","--input",
+        type = str,
+        required=True,
+        action="store",
+        dest="input_file",
+        help = "Input dump file (pages-articles XML)",
+    )
+
+    io_parser.add_argument(
+        "-o","--output",
+        type = str,
+        required=True,
+        action="store",
+        dest="output_file",
+        help = "Output filter file",
+    )
+
+    io_parser.add_argument(
+        "--bloom",
+        required=False,
+        action="store_true",
+        dest="bloom",
+        help = "Store a Bloom filter instead of the exact title list",
+    )
+
+    io_parser.add_argument(
+        "--fp-rate",
+        type = float,
+        required=False,
+        default=FP_RATE,
+        action="store",
+        dest="fp_rate",
+        help = "False positive rate of the Bloom filter",
+    )
+
+    args = io_parser.parse_args()
+
+    if not os.path.exists(args.input_file):
+        logging.error("ERROR: Input file not found")
+        exit(1)
+
+    if os.path.exists(args.output_file):
+        logging.error(f"ERROR: Output file '{args.output_file}' already exists")
+        exit(1)
+
+    if not 0 < args.fp_rate < 1:
+        sys.stderr.write("Error: False positive rate must be between 0 and 1\n")
+        exit(1)
+
+    logging.info("Building title filter..")
+    titles_num = build_title_filter(args.input_file, args.output_file, args.bloom, args.fp_rate)
+    logging.info(f"Stored {titles_num} titles.")
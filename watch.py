@@ -0,0 +1,187 @@
+#! /bin/python3
+
+# Long-running watch mode
+#
+# Polls the pageview sources and the DUMP_DIR directories:
+#   - every pageview day is ingested (pageviews_stats.py --end DAY)
+#     as soon as all of its 24 hourly files are published
+#   - bps of a project are refreshed (backlinks_primary_stats.py --projects PRJ)
+#     as soon as a new pages-articles dump of that project lands
+
+from datetime import datetime
+from generate_pageviews import get_backend
+from errors import WikiStatsError
+from dumps import latest_dump
+import subprocess
+import argparse
+import requests
+import json
+import time
+import sys
+import os
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from config import *
+
+# Seconds between polls
+POLL_INTERVAL = 15 * 60
+
+WATCH_STATE_FILE = DATA_DIR + "watch_state.json"
+
+
+def load_state() -> dict:
+    if not os.path.exists(WATCH_STATE_FILE):
+        return {}
+    with open(WATCH_STATE_FILE) as state_in:
+        return json.load(state_in)
+
+def save_state(state:dict) -> None:
+    tmp_path = WATCH_STATE_FILE + ".tmp"
+    with open(tmp_path, "w") as state_out:
+        json.dump(state, state_out, indent=2)
+    os.replace(tmp_path, WATCH_STATE_FILE)
+
+def next_pageviews_day() -> datetime:
+    """
+    Returns the first day not yet ingested (from last_update).
+    """
+    with open(DATA_FILE) as file_in:
+        return datetime.strptime(file_in.readline().strip(), DATE_FORMAT)
+
+def day_available(day:datetime, backends:list) -> bool:
+    """
+    Checks if all hourly files of a day are published in some source.
+    """
+    year_month = f"{day.year}/{day.year}-{str(day.month).zfill(2)}"
+    missing = [f"pageviews-{day.strftime('%Y%m%d')}-{str(hour).zfill(2)}0000.gz" for hour in range(24)]
+    for backend in backends:
+        available = backend.available(year_month, missing)
+        missing = [file_name for file_name in missing if file_name not in available]
+        if not missing:
+            return True
+    return False
+
+def run_script(command:list) -> bool:
+    print(f"Running: {' '.join(command)}")
+    prcs = subprocess.run([sys.executable] + command)
+    if prcs.returncode != 0:
+        sys.stderr.write(f"Error: {command[0]} failed ({prcs.returncode})\n")
+    return prcs.returncode == 0
+
+# Ingests published pageview days one by one
+# Returns the number of ingested days
+def poll_pageviews(backends:list) -> int:
+    days_num = 0
+    while True:
+        day = next_pageviews_day()
+        if day.date() >= datetime.now().date():
+            break
+        try:
+            if not day_available(day, backends):
+                break
+        except requests.RequestException as e:
+            sys.stderr.write(f"Error: Unable to check pageviews of {day.strftime(DATE_FORMAT)} ({e})\n")
+            break
+
+        print(f"New pageviews day: {day.strftime(DATE_FORMAT)}")
+        if not run_script(["pageviews_stats.py", "--end", day.strftime(DATE_FORMAT)]):
+            break
+        days_num += 1
+    return days_num
+
+def bps_time(prj:str) -> float:
+    """
+    Returns the creation time of the latest bps snapshot of a project
+    (from its file name, mtime as a fallback), None without a snapshot.
+    """
+    latest_path = os.path.realpath(os.path.join(STATS_DIR, f"bps/latest_{prj}_bps.tsv"))
+    if not os.path.exists(latest_path):
+        return None
+    try:
+        created = os.path.basename(latest_path).split(f"_{prj}_bps")[0]
+        return datetime.strptime(created, FILE_DATE_FORMAT).timestamp()
+    except ValueError:
+        return os.path.getmtime(latest_path)
+
+def is_processed(prj:str, dump_path:str) -> bool:
+    """
+    Checks if the latest bps snapshot of a project was made after a dump landed
+    (True without a snapshot, backlinks_primary_stats.py merges into an existing one).
+    """
+    created = bps_time(prj)
+    return created is None or os.path.getmtime(dump_path) <= created
+
+# Refreshes bps of projects with a new dump
+# Returns the list of refreshed projects
+def poll_dumps(state:dict) -> list:
+    refreshed = []
+    seen = state.setdefault("dumps", {})
+    for prj in PROJECTS:
+        try:
+            dump_path = latest_dump(prj)
+        except WikiStatsError as e:
+            sys.stderr.write(f"Error: {e}\n")
+            continue
+
+        if dump_path is None or seen.get(prj) == dump_path:
+            continue
+        # First poll (no state yet) compares the dump with the latest bps
+        # snapshot, a dump that landed while the watcher was down is refreshed
+        if prj not in seen and is_processed(prj, dump_path):
+            seen[prj] = dump_path
+            continue
+
+        print(f"New dump ({prj}): {dump_path}")
+        if run_script(["backlinks_primary_stats.py", "--projects", prj]):
+            seen[prj] = dump_path
+            refreshed.append(prj)
+    save_state(state)
+    return refreshed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=POLL_INTERVAL,
+        dest="interval",
+        help="Seconds between polls"
+    )
+
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        dest="once",
+        help="Poll only once and exit"
+    )
+
+    parser.add_argument(
+        "--no-pageviews",
+        action="store_true",
+        dest="no_pageviews",
+        help="Do not ingest pageview days"
+    )
+
+    parser.add_argument(
+        "--no-dumps",
+        action="store_true",
+        dest="no_dumps",
+        help="Do not refresh bps on new dumps"
+    )
+    args = parser.parse_args()
+
+    backends = [get_backend(source, os.path.join(DATA_DIR, "pw_manifest")) for source in PAGEVIEWS_SOURCES]
+    state = load_state()
+
+    while True:
+        print(f"Polling ({datetime.now().strftime(FILE_DATE_FORMAT)})")
+        if not args.no_dumps:
+            poll_dumps(state)
+        if not args.no_pageviews:
+            poll_pageviews(backends)
+        if args.once:
+            break
+        time.sleep(args.interval)